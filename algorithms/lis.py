@@ -27,6 +27,27 @@ def patience_sort(xs):
         yield x, pile
 
 
+def patience_extend(pile_tops, xs):
+    '''Continue patience sort with xs on existing pile tops (modified in
+    place), so that sorting can resume from a saved state. Returns the number
+    of piles, i.e. length of the longest increasing subsequence so far.
+
+    >>> tops = []
+    >>> patience_extend(tops, (4, 5, 1))
+    2
+    >>> patience_extend(tops, (2, 3))
+    3
+    '''
+    bisect_left = bisect.bisect_left
+    for x in xs:
+        pile = bisect_left(pile_tops, x)
+        if pile == len(pile_tops):
+            pile_tops.append(x)
+        else:
+            pile_tops[pile] = x
+    return len(pile_tops)
+
+
 def longest_monotonic_subseq_length(xs):
     '''Return the length of the longest monotonic subsequence of xs, second
     return value is the difference between increasing and decreasing lengths.
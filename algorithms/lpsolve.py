@@ -190,6 +190,163 @@ class SCIPSolver(AbstractMIPSolver):
         return results
 
 
+class PackingSolver(object):
+    """
+    In-process solver for 0/1 packing problems, with no LP file or external
+    program involved:
+
+        Maximize sum(w_i x_i) subject to sum(x_i for i in C) <= capacity(C)
+
+    The solution is built greedily by descending weight, then improved by
+    local search that either adds one rejected item, evicting the lightest
+    conflicting item in each saturated constraint, or drops one selected item
+    and refills the space it frees, whenever that gains weight.
+    With `exact=True`, the problem is solved to optimality with an in-process
+    MIP binding (gurobipy, or scipy.optimize.milp) if one is importable.
+
+    >>> PackingSolver([5, 3, 2], [((1, 2), 1)]).results
+    [0, 1]
+    >>> PackingSolver([2, 3, 2], [((0, 1), 1), ((1, 2), 1)]).results
+    [0, 2]
+    """
+    def __init__(self, weights, constraints, exact=False, verbose=False):
+        self.weights = weights
+        self.constraints = constraints
+        self.verbose = verbose
+
+        results = None
+        if exact:
+            results = self.solve_exact()
+        if results is None:
+            results = self.solve_greedy()
+
+        self.results = sorted(results)
+        self.obj_val = sum(weights[i] for i in self.results)
+        logging.debug("optimized objective value ({0})".format(self.obj_val))
+
+    def solve_greedy(self, maxrounds=100):
+        weights, constraints = self.weights, self.constraints
+        n = len(weights)
+        incident = [[] for i in xrange(n)]
+        for k, (members, capacity) in enumerate(constraints):
+            for i in members:
+                incident[i].append(k)
+        capacities = [c for members, c in constraints]
+        load = [0] * len(constraints)
+        selected = [False] * n
+        order = sorted(xrange(n), key=lambda i: (-weights[i], i))
+
+        def fits(i):
+            return all(load[k] < capacities[k] for k in incident[i])
+
+        def toggle(i, flag):
+            selected[i] = flag
+            delta = 1 if flag else -1
+            for k in incident[i]:
+                load[k] += delta
+
+        for i in order:
+            if fits(i):
+                toggle(i, True)
+
+        nswaps = 0
+        for r in xrange(maxrounds):
+            improved = False
+            for i in order:
+                if selected[i]:
+                    continue
+                # Lightest selected item to evict in each saturated constraint
+                evict = set()
+                for k in incident[i]:
+                    if load[k] < capacities[k]:
+                        continue
+                    members = constraints[k][0]
+                    if any(j in evict for j in members):
+                        continue
+                    evict.add(min((j for j in members if selected[j]),
+                                  key=lambda j: (weights[j], -j)))
+                if sum(weights[j] for j in evict) >= weights[i]:
+                    continue
+                for j in evict:
+                    toggle(j, False)
+                toggle(i, True)
+                # Evictions may leave room for other items
+                for k in set(k for j in evict for k in incident[j]):
+                    for j in constraints[k][0]:
+                        if not selected[j] and fits(j):
+                            toggle(j, True)
+                nswaps += 1
+                improved = True
+
+            # Drop one item if the space it frees takes more weight
+            for j in order:
+                if not selected[j]:
+                    continue
+                toggle(j, False)
+                added = []
+                neighbors = set(i for k in incident[j] \
+                                  for i in constraints[k][0])
+                for i in sorted(neighbors, key=lambda i: (-weights[i], i)):
+                    if not selected[i] and i != j and fits(i):
+                        toggle(i, True)
+                        added.append(i)
+                if sum(weights[i] for i in added) > weights[j]:
+                    nswaps += 1
+                    improved = True
+                    continue
+                for i in added:
+                    toggle(i, False)
+                toggle(j, True)
+
+            if not improved:
+                break
+
+        if self.verbose:
+            logging.debug("Greedy packing improved by {0} swaps.".\
+                          format(nswaps))
+        return [i for i in xrange(n) if selected[i]]
+
+    def solve_exact(self):
+        weights, constraints = self.weights, self.constraints
+        n = len(weights)
+        try:
+            from gurobipy import Model, GRB, quicksum
+        except ImportError:
+            pass
+        else:
+            m = Model()
+            m.params.OutputFlag = int(self.verbose)
+            x = [m.addVar(obj=w, vtype=GRB.BINARY) for w in weights]
+            m.update()
+            for members, capacity in constraints:
+                m.addConstr(quicksum(x[i] for i in members) <= capacity)
+            m.ModelSense = GRB.MAXIMIZE
+            m.optimize()
+            return [i for i in xrange(n) if x[i].x > .5]
+
+        try:
+            from scipy.optimize import milp, LinearConstraint, Bounds
+            from scipy.sparse import lil_matrix
+        except ImportError:
+            logging.debug("No in-process MIP solver found, using greedy.")
+            return None
+
+        import numpy as np
+
+        A = lil_matrix((len(constraints), n))
+        for k, (members, capacity) in enumerate(constraints):
+            for i in members:
+                A[k, i] = 1
+        ub = [capacity for members, capacity in constraints]
+        res = milp(-np.array(weights, dtype=float),
+                   constraints=LinearConstraint(A.tocsr(), -np.inf, ub) \
+                               if constraints else None,
+                   integrality=np.ones(n), bounds=Bounds(0, 1))
+        if res.x is None:
+            return None
+        return [i for i in xrange(n) if res.x[i] > .5]
+
+
 class LPInstance (object):
     """
     CPLEX LP format commonly contains three blocks:
@@ -88,6 +88,24 @@ def symmetrize(M):
     return M + M.T - np.diag(M.diagonal())
 
 
+def floyd_warshall(D):
+    """
+    All-pairs shortest path lengths on a dense distance matrix, missing edges
+    are np.inf. One row-column relaxation per node, vectorized in numpy.
+
+    >>> D = np.array([[0, 1, np.inf], [1, 0, 2], [np.inf, 2, 0]])
+    >>> print floyd_warshall(D)
+    [[ 0.  1.  3.]
+     [ 1.  0.  2.]
+     [ 3.  2.  0.]]
+    """
+    D = np.array(D, dtype=float)
+    np.fill_diagonal(D, 0)
+    for k in xrange(D.shape[0]):
+        np.minimum(D, D[:, k, None] + D[k], out=D)
+    return D
+
+
 def get_signs(M, cutoff=1e-10, validate=True):
     """
     Given a numpy array M that contains pairwise orientations, find the largest
@@ -3,7 +3,8 @@
 
 """
 TSP solver using Concorde. This is much faster than the LP-formulation in
-algorithms.lpsolve.tsp().
+algorithms.lpsolve.tsp(). A native heuristic solver (nearest neighbour tour
+improved by 2-opt and Or-opt) is available when Concorde is not installed.
 """
 
 import os.path as op
@@ -14,9 +15,10 @@ import numpy as np
 
 from collections import defaultdict
 from itertools import combinations
+from tempfile import mkdtemp
 
-from jcvi.formats.base import FileShredder, must_open
-from jcvi.utils.iter import pairwise
+from jcvi.formats.base import must_open
+from jcvi.utils.iter import flatten, pairwise
 from jcvi.apps.base import mkdir, which, sh
 
 
@@ -26,25 +28,31 @@ Work_dir = "tsp_work"
 
 
 class Concorde (object):
-
-    def __init__(self, edges, work_dir=Work_dir, clean=True, verbose=False,
+    """
+    Run concorde inside `work_dir`, which gets the instance, the solution and
+    the residual files concorde writes to its current directory. Without
+    `work_dir`, each instance uses its own temporary directory, so that
+    concurrent calls do not clobber each other.
+    """
+    def __init__(self, edges, work_dir=None, clean=True, verbose=False,
                        precision=0, seed=666):
 
-        self.work_dir = work_dir
+        if work_dir is None:
+            work_dir = mkdtemp(prefix=Work_dir)
+        else:
+            mkdir(work_dir)
+        self.work_dir = work_dir = op.abspath(work_dir)
         self.clean = clean
         self.verbose = verbose
 
-        mkdir(work_dir)
-        tspfile = op.join(work_dir, "data.tsp")
-        self.print_to_tsplib(edges, tspfile, precision=precision)
-        retcode, outfile = self.run_concorde(tspfile, seed=seed)
-        self.tour = self.parse_output(outfile)
-
-        if clean:
-            shutil.rmtree(work_dir)
-            residual_output = ["data.sol", "data.res", "Odata.res"]
-            FileShredder(residual_output)
-
+        try:
+            tspfile = op.join(work_dir, "data.tsp")
+            self.print_to_tsplib(edges, tspfile, precision=precision)
+            retcode, outfile = self.run_concorde(tspfile, seed=seed)
+            self.tour = self.parse_output(outfile)
+        finally:
+            if clean:
+                shutil.rmtree(work_dir, ignore_errors=True)
 
     def print_to_tsplib(self, edges, tspfile, precision=0):
         """
@@ -62,7 +70,7 @@ class Concorde (object):
         (... numbers ...)
         """
         fw = must_open(tspfile, "w")
-        incident, nodes = node_to_edge(edges, directed=False)
+        nodes = edges_to_nodes(edges)
         self.nodes = nodes
         nodes_indices = dict((n, i) for i, n in enumerate(nodes))
         self.nnodes = nnodes = len(nodes)
@@ -104,7 +112,8 @@ class Concorde (object):
         cc = "concorde"
         assert which(cc), "You must install `concorde` on your PATH" + \
                           " [http://www.math.uwaterloo.ca/tsp/concorde.html]"
-        cmd = "{0} -s {1} -x -o {2} {3}".format(cc, seed, outfile, tspfile)
+        cmd = "cd {0} && {1} -s {2} -x -o {3} {4}".\
+                format(self.work_dir, cc, seed, outfile, tspfile)
 
         outf = None if self.verbose else "/dev/null"
         retcode = sh(cmd, outfile=outf, errfile=outf)
@@ -121,6 +130,196 @@ class Concorde (object):
         return tour
 
 
+class NativeTSP (object):
+    """
+    Heuristic TSP solver that runs in-process on a distance matrix. Initial
+    tour is built by nearest neighbour, then improved by 2-opt and Or-opt moves
+    (relocate a segment of up to `maxseg` nodes, optionally reversed) until no
+    move shortens the tour. Missing edges are infeasible, as in Concorde: each
+    costs more than any tour without them, and the search is restarted from
+    the next city, up to `restarts` times, while the tour still uses one.
+
+    Cities paired with their dummy city by reformulate_atsp_as_tsp() are merged
+    back, so that the search runs on the asymmetric matrix where reversing a
+    segment is still a valid move. The tour is returned in the paired form.
+    """
+    def __init__(self, edges, maxseg=3, restarts=5):
+        nodes = edges_to_nodes(edges)
+        self.maxseg = maxseg
+        self.paired = is_atsp_reformulation(nodes)
+        if self.paired:
+            nodes = [x for x in nodes if not is_dummy_city(x)]
+            edges = [(a[0], b, w) for a, b, w in edges if is_dummy_city(a)]
+        self.nodes = nodes
+        self.nnodes = len(nodes)
+        self.D = self.distance_matrix(edges)
+
+        # Local search can get stuck on a missing edge in sparse graphs, build
+        # the initial tour from other cities until the tour is feasible
+        if not self.may_be_feasible():
+            restarts = 1
+        best = None
+        for start in xrange(min(restarts, self.nnodes)):
+            tour = self.nearest_neighbour(start)
+            self.improve(tour)
+            cost = self.tour_cost(tour)
+            if best is None or cost < best[0]:
+                best = cost, tour
+            if cost < self.inf:
+                break
+        cost, tour = best
+
+        # Canonical form: start from the first node, lower neighbour next
+        i = tour.index(0)
+        tour = tour[i:] + tour[:i]
+        if not self.paired and len(tour) > 2 and tour[1] > tour[-1]:
+            tour[1:] = tour[1:][::-1]
+        tour = [nodes[x] for x in tour]
+        if self.paired:
+            tour = list(flatten((x, (x, '*')) for x in tour))
+        self.tour = tour
+
+    def distance_matrix(self, edges):
+        nodes_indices = dict((n, i) for i, n in enumerate(self.nodes))
+        nnodes = self.nnodes
+        # A single missing edge must outweigh any difference between tours
+        self.inf = inf = 2 * sum(abs(x[-1]) for x in edges) + 1
+        D = np.ones((nnodes, nnodes), dtype=float) * inf
+        for a, b, w in edges:
+            ia, ib = nodes_indices[a], nodes_indices[b]
+            D[ia, ib] = w
+            if not self.paired:
+                D[ib, ia] = w
+        return D
+
+    def may_be_feasible(self):
+        """
+        Every city needs a way in and a way out, otherwise every tour uses a
+        missing edge and restarting does not help.
+        """
+        finite = self.D < self.inf
+        np.fill_diagonal(finite, False)
+        if self.paired:
+            return finite.any(axis=0).all() and finite.any(axis=1).all()
+        return (finite.sum(axis=1) >= min(2, self.nnodes - 1)).all()
+
+    def tour_cost(self, tour):
+        return self.D[tour, np.roll(tour, -1)].sum()
+
+    def improve(self, tour):
+        if self.nnodes <= 2:
+            return
+        while True:
+            improved = self.two_opt(tour)
+            improved |= self.or_opt(tour)
+            if not improved:
+                break
+
+    def nearest_neighbour(self, start=0):
+        D = self.D
+        n = self.nnodes
+        visited = np.zeros(n, dtype=bool)
+        tour = [start]
+        visited[start] = True
+        for i in xrange(n - 1):
+            d = np.where(visited, np.inf, D[tour[-1]])
+            b = int(d.argmin())
+            tour.append(b)
+            visited[b] = True
+        return tour
+
+    def two_opt(self, tour, eps=1e-9):
+        """
+        Replace edges (a, b) and (c, d) with (a, c) and (b, d) by reversing
+        the tour between b and c. Tour is modified in place.
+        """
+        D = self.D
+        n = len(tour)
+        improved = False
+        moved = True
+        i = 0
+        while i < n - 2:
+            if moved:  # Only rebuilt after the tour changes
+                t = np.array(tour)
+                nt = np.roll(t, -1)
+                # Cost of the path from position 0, traversed either way
+                fwd = np.concatenate(([0], np.cumsum(D[t, nt])))
+                rev = np.concatenate(([0], np.cumsum(D[nt, t])))
+                moved = False
+            a, b = t[i], t[i + 1]
+            js = np.arange(i + 2, n if i else n - 1)  # (c, d) not touching a
+            c, d = t[js], nt[js]
+            delta = D[a, c] + D[b, d] - D[a, b] - D[c, d] + \
+                    (rev[js] - rev[i + 1]) - (fwd[js] - fwd[i + 1])
+            k = int(delta.argmin()) if len(delta) else 0
+            if len(delta) and delta[k] < -eps:
+                j = js[k]
+                tour[i + 1:j + 1] = tour[i + 1:j + 1][::-1]
+                improved = moved = True
+                continue
+            i += 1
+        return improved
+
+    def or_opt(self, tour, eps=1e-9):
+        """
+        Move a segment of 1 to `maxseg` nodes to the best position elsewhere
+        in the tour, in either orientation. Tour is modified in place.
+        """
+        D = self.D
+        n = len(tour)
+        improved = False
+        t = np.array(tour)
+        for L in xrange(1, min(self.maxseg, n - 2) + 1):
+            i = 0
+            while i < n:
+                r = np.concatenate((t[i:], t[:i]))
+                seg, rest = r[:L], r[L:]
+                s0, s1 = seg[0], seg[-1]
+                # Removal joins the two neighbours of the segment
+                gain = D[rest[-1], s0] + D[s1, rest[0]] - D[rest[-1], rest[0]]
+                turn = D[seg[1:], seg[:-1]].sum() - D[seg[:-1], seg[1:]].sum()
+                p, q = rest[:-1], rest[1:]
+                base = D[p, q]
+                fwd = D[p, s0] + D[s1, q] - base
+                rev = D[p, s1] + D[s0, q] - base + turn
+                kf, kr = int(fwd.argmin()), int(rev.argmin())
+                if min(fwd[kf], rev[kr]) < gain - eps:
+                    if fwd[kf] <= rev[kr]:
+                        k, seg = kf, seg
+                    else:
+                        k, seg = kr, seg[::-1]
+                    t = np.concatenate((rest[:k + 1], seg, rest[k + 1:]))
+                    tour[:] = t.tolist()
+                    improved = True
+                    continue
+                i += 1
+        return improved
+
+
+def is_dummy_city(n):
+    return isinstance(n, tuple) and len(n) == 2 and n[1] == '*'
+
+
+def is_atsp_reformulation(nodes):
+    """
+    Check if every city comes with its dummy city, as generated by
+    reformulate_atsp_as_tsp().
+    """
+    dummies = set(x[0] for x in nodes if is_dummy_city(x))
+    cities = set(x for x in nodes if not is_dummy_city(x))
+    return bool(cities) and dummies == cities
+
+
+def edges_to_nodes(edges):
+    """
+    Sorted nodes of the edges, for when node_to_edge() incidences are not
+    needed.
+    """
+    nodes = set(e[0] for e in edges)
+    nodes.update(e[1] for e in edges)
+    return sorted(nodes)
+
+
 def node_to_edge(edges, directed=True):
     """
     From list of edges, record per node, incoming and outgoing edges
@@ -154,7 +353,8 @@ def populate_edge_weights(edges):
     return new_edges
 
 
-def hamiltonian(edges, directed=False, precision=0):
+def hamiltonian(edges, directed=False, precision=0, solver="concorde",
+                work_dir=None):
     """
     Calculates shortest path that traverses each node exactly once. Convert
     Hamiltonian path problem to TSP by adding one dummy point that has a distance
@@ -166,16 +366,26 @@ def hamiltonian(edges, directed=False, precision=0):
     [1, 2, 4, 3, 5]
     >>> hamiltonian([(1, 2), (2, 3)], directed=True)
     [1, 2, 3]
+    >>> hamiltonian(g, solver="native")
+    [1, 2, 4, 3, 5]
+    >>> hamiltonian([(1, 2), (2, 3)], directed=True, solver="native")
+    [1, 2, 3]
+    >>> g = [(0, 4, 56), (0, 5, 16), (2, 0, 31), (2, 1, 29), (2, 3, 52),
+    ...      (2, 4, 8), (2, 5, 54), (3, 0, 87), (3, 2, 94), (3, 4, 95),
+    ...      (4, 1, 59), (4, 3, 6), (4, 5, 79), (5, 0, 82)]
+    >>> hamiltonian(g, directed=True, solver="native")
+    [5, 0, 4, 3, 2, 1]
     """
     edges = populate_edge_weights(edges)
-    incident, nodes = node_to_edge(edges, directed=False)
+    nodes = edges_to_nodes(edges)
     DUMMY = "DUMMY"
     dummy_edges = edges + [(DUMMY, x, 0) for x in nodes]
     if directed:
         dummy_edges += [(x, DUMMY, 0) for x in nodes]
         dummy_edges = reformulate_atsp_as_tsp(dummy_edges)
 
-    tour = tsp(dummy_edges, precision=precision)
+    tour = tsp(dummy_edges, precision=precision, solver=solver,
+               work_dir=work_dir)
 
     dummy_index = tour.index(DUMMY)
     tour = tour[dummy_index:] + tour[:dummy_index]
@@ -193,8 +403,12 @@ def hamiltonian(edges, directed=False, precision=0):
     return path
 
 
-def tsp(edges, precision=0):
-    c = Concorde(edges, precision=precision)
+def tsp(edges, precision=0, solver="concorde", work_dir=None):
+    assert solver in ("concorde", "native")
+    if solver == "native":
+        c = NativeTSP(edges)
+    else:
+        c = Concorde(edges, work_dir=work_dir, precision=precision)
     return c.tour
 
 
@@ -210,7 +424,7 @@ def reformulate_atsp_as_tsp(edges):
     from the city. The distances between all cities and the distances between
     all dummy cities are set to infeasible.
     """
-    incident, nodes = node_to_edge(edges, directed=False)
+    nodes = edges_to_nodes(edges)
     new_edges = []
     for a, b, w in edges:
         new_edges.append(((a, '*'), b, w))
@@ -19,15 +19,28 @@ from jcvi.formats.base import BaseFile, must_open
 from jcvi.apps.base import OptionParser, ActionDispatcher
 
 
+DTYPES = {"uint8": np.uint8, "uint16": np.uint16, "uint32": np.uint32}
+
+
 class BinFile (BaseFile):
     """
     The binfile contains per base count, fastafile provides the coordinate
-    system.
+    system. When dtype is not given, it is inferred from the file size if
+    fastafile is given, else defaults to uint8.
     """
-    def __init__(self, binfile, fastafile=None, dtype=np.uint8):
+    def __init__(self, binfile, fastafile=None, dtype=None):
         super(BinFile, self).__init__(binfile)
         assert op.exists(binfile), \
             "Binary file `{0}` not found. Rerun depth.count().".format(binfile)
+        if dtype is None:
+            dtype = np.uint8
+            if fastafile:
+                fastasize, sizes, offsets = get_offsets(fastafile)
+                itemsize, r = divmod(op.getsize(binfile), fastasize)
+                assert r == 0 and itemsize in (1, 2, 4), \
+                    "Size of `{0}` does not match `{1}`".\
+                    format(binfile, fastafile)
+                dtype = np.dtype("uint{0}".format(itemsize * 8)).type
         self.dtype = dtype
 
     @property
@@ -41,6 +54,43 @@ class BinFile (BaseFile):
         return np.memmap(binfile, dtype=self.dtype, mode="r")
 
 
+def set_dtype(p, default="uint8"):
+    p.add_option("--dtype", default=default, choices=sorted(DTYPES.keys()),
+            help="Count array type, counts are capped at its max "
+                 "[default: %default]")
+
+
+def saturating_add(ar, idx, counts):
+    """
+    Add counts to ar[idx], capped at the max of ar.dtype. Counts of positions
+    repeated in an index array add up.
+
+    >>> ar = np.zeros(4, dtype=np.uint8)
+    >>> saturating_add(ar, np.array([1, 3, 1]), np.array([2, 5, 250]))
+    >>> ar
+    array([  0, 252,   0,   5], dtype=uint8)
+    """
+    cap = np.iinfo(ar.dtype).max
+    if not isinstance(idx, slice):
+        idx, inv = np.unique(idx, return_inverse=True)
+        counts = np.bincount(inv, weights=counts,
+                             minlength=len(idx)).astype(np.int64)
+    newcounts = ar[idx].astype(np.int64) + counts
+    np.minimum(newcounts, cap, out=newcounts)
+    ar[idx] = newcounts
+
+
+def find_runs(mask):
+    """
+    Start and end (0-based, end exclusive) of the runs of True in mask.
+
+    >>> find_runs(np.array([0, 1, 1, 0, 1], dtype=bool))
+    (array([1, 4]), array([3, 5]))
+    """
+    d = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.flatnonzero(d == 1), np.flatnonzero(d == -1)
+
+
 def main():
 
     actions = (
@@ -74,41 +124,43 @@ def bed(args):
     cutoff = opts.cutoff
     assert cutoff >= 0, "Need non-negative cutoff"
 
-    b = BinFile(binfile)
-    ar = b.array
+    b = BinFile(binfile, fastafile)
+    ar = b.mmarray
 
     fastasize, sizes, offsets = get_offsets(fastafile)
     s = Sizes(fastafile)
     for ctg, ctglen in s.iter_sizes():
         offset = offsets[ctg]
         subarray = ar[offset:offset + ctglen]
-        key = lambda x: x[1] >= cutoff
-        for tf, array_elements in groupby(enumerate(subarray), key=key):
-            array_elements = list(array_elements)
-            if not tf:
-                continue
-
-            # 0-based system => 1-based system
-            start = array_elements[0][0] + 1
-            end = array_elements[-1][0] + 1
-
-            mean_depth = sum([x[1] for x in array_elements]) / \
-                len(array_elements)
-            mean_depth = int(mean_depth)
-
-            name = "na"
+        starts, ends = find_runs(subarray >= cutoff)
+        if not len(starts):
+            continue
+
+        # reduceat() sums from each bound to the next, so the even slots hold
+        # the runs and the odd slots the gaps between them
+        bounds = np.column_stack((starts, ends)).ravel()
+        if bounds[-1] == ctglen:
+            bounds = bounds[:-1]
+        sums = np.add.reduceat(subarray, bounds, dtype=np.int64)[::2]
+        mean_depths = sums / (ends - starts)
+
+        name = "na"
+        for start, end, mean_depth in zip(starts, ends, mean_depths):
             print >> fw, "\t".join(str(x) for x in (ctg, \
-                    start - 1, end, name, mean_depth))
+                    start, end, name, mean_depth))
 
 
 def merge(args):
     """
     %prog merge *.bin merged.bin
 
-    Merge several count arrays into one. Overflows will be capped at uint8_max
-    (255).
+    Merge several count arrays into one. Overflows will be capped at the max of
+    --dtype, e.g. 255 for uint8.
     """
     p = OptionParser(merge.__doc__)
+    set_dtype(p)
+    p.add_option("--inputdtype", default="uint8", choices=sorted(DTYPES.keys()),
+            help="Type of the input count arrays [default: %default]")
     opts, args = p.parse_args(args)
 
     if len(args) < 2:
@@ -121,22 +173,22 @@ def merge(args):
                 .format(mergedbin))
         return
 
-    b = BinFile(binfiles[0])
+    inputdtype, dtype = DTYPES[opts.inputdtype], DTYPES[opts.dtype]
+    b = BinFile(binfiles[0], dtype=inputdtype)
     ar = b.mmarray
     fastasize, = ar.shape
-    logging.debug("Initialize array of uint16 with size {0}".format(fastasize))
+    logging.debug("Initialize array of {0} with size {1}".\
+                    format(opts.dtype, fastasize))
 
-    merged_ar = np.zeros(fastasize, dtype=np.uint16)
+    merged_ar = np.memmap(mergedbin, dtype=dtype, mode="w+", shape=fastasize)
+    chunksize = 1 << 24
     for binfile in binfiles:
-        b = BinFile(binfile)
-        merged_ar += b.array
+        ar = BinFile(binfile, dtype=inputdtype).mmarray
+        for i in xrange(0, fastasize, chunksize):
+            idx = slice(i, i + chunksize)
+            saturating_add(merged_ar, idx, ar[idx])
 
-    logging.debug("Resetting the count max to 255.")
-    merged_ar[merged_ar > 255] = 255
-
-    logging.debug("Compact array back to uint8 with size {0}".format(fastasize))
-    merged_ar = np.array(merged_ar, dtype=np.uint8)
-    merged_ar.tofile(mergedbin)
+    merged_ar.flush()
     logging.debug("Merged array written to `{0}`".format(mergedbin))
 
 
@@ -161,28 +213,33 @@ def query(args):
     print "\t".join((ctgID, baseID, str(ar[oi])))
 
 
-def update_array(ar, coveragefile, sizes, offsets):
+def update_array(ar, coveragefile, sizes, offsets, chunksize=1 << 24):
+    """
+    Add the counts in per-base coverage file (ctgID, 1-based baseID, count)
+    to ar, reading about `chunksize` bytes of lines at a time. Rows are
+    expected to be grouped by ctgID.
+    """
     fp = open(coveragefile)
     logging.debug("Parse file `{0}`".format(coveragefile))
-    for k, rows in groupby(fp, key=(lambda x: x.split()[0])):
-        rows = list(rows)
-        offset = offsets[k]
-        ctglen = len(rows)
-
-        if ctglen < 100000:
-            sys.stdout.write(".")
-        else:
-            print k, offset
-
-        #assert ctglen == sizes[k]
-        for i, row in enumerate(rows):
-            ctgID, baseID, count = row.split()
-            oi = offset + i
-            newcount = ar[oi] + int(count)
-            if newcount > 255:
-                newcount = 255
-
-            ar[oi] = newcount
+    while True:
+        lines = fp.readlines(chunksize)
+        if not lines:
+            break
+
+        tokens = "".join(lines).split()
+        assert len(tokens) == 3 * len(lines), \
+            "Expect 3 columns in `{0}`".format(coveragefile)
+        pos = np.fromstring(" ".join(tokens[1::3]), dtype=np.int64, sep=" ")
+        counts = np.fromstring(" ".join(tokens[2::3]), dtype=np.int64, sep=" ")
+
+        i = 0
+        for k, rows in groupby(tokens[0::3]):
+            j = i + len(list(rows))
+            ctgpos = pos[i:j] - 1
+            assert ctgpos.min() >= 0 and ctgpos.max() < sizes[k], \
+                "Position out of range on `{0}`".format(k)
+            saturating_add(ar, offsets[k] + ctgpos, counts[i:j])
+            i = j
 
 
 def get_offsets(fastafile):
@@ -201,6 +258,7 @@ def count(args):
     will be based on the fastafile.
     """
     p = OptionParser(count.__doc__)
+    set_dtype(p)
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
@@ -215,12 +273,14 @@ def count(args):
         return
 
     fastasize, sizes, offsets = get_offsets(fastafile)
-    logging.debug("Initialize array of uint8 with size {0}".format(fastasize))
-    ar = np.zeros(fastasize, dtype=np.uint8)
+    logging.debug("Initialize array of {0} with size {1}".\
+                    format(opts.dtype, fastasize))
+    ar = np.memmap(countsfile, dtype=DTYPES[opts.dtype], mode="w+",
+                   shape=fastasize)
 
     update_array(ar, coveragefile, sizes, offsets)
 
-    ar.tofile(countsfile)
+    ar.flush()
     logging.debug("Array written to `{0}`".format(countsfile))
 
 
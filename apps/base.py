@@ -196,6 +196,15 @@ class OptionParser (OptionP):
         self.add_option("-T", "--tmpdir", default=tmpdir,
                 help="Use temp directory instead of $TMP [default: %default]")
 
+    def set_sort(self, memory=256):
+        """
+        Add options for formats.base.external_sort()
+        """
+        self.set_tmpdir()
+        self.set_cpus(cpus=1)
+        self.add_option("--memory", default=memory, type="int",
+                help="Megabytes of lines to sort at a time per CPU [default: %default]")
+
     def set_cpus(self, cpus=0):
         """
         Add --cpus options to specify how many threads to use.
@@ -10,13 +10,16 @@ import os
 import os.path as op
 import csv
 import logging
+import cStringIO
 
 import numpy as np
 
 from math import log, sqrt, pi, exp
-from itertools import product, combinations
+from itertools import product, combinations, permutations, izip
 from functools import partial
 from collections import namedtuple
+from multiprocessing import Pool
+from tempfile import mkdtemp
 
 from Bio import SeqIO
 from Bio import AlignIO
@@ -206,6 +209,10 @@ def multireport(args):
         data = read_ks_file(lo.ksfile)
         data = [x.ng_ks for x in data]
         data = [x for x in data if ks_min <= x <= ks_max]
+        if not data:
+            logging.debug("No ng_ks values in `{0}`, skipped.".\
+                            format(lo.ksfile))
+            continue
         kp.add_data(data, lo.components, label=lo.label, \
                     color=lo.color, marker=lo.marker,
                     fill=fill, fitted=fitted)
@@ -434,8 +441,17 @@ def calc(args):
         1. Fetches a protein pair.
         2. Aligns the protein pair with clustalw (default) or muscle.
         3. Convert the output to Fasta format.
-        4. Use this alignment info to align gene sequences using PAL2NAL
-        5. Run PAML yn00 to calculate synonymous mutation rates.
+        4. Use this alignment info to align gene sequences codon by codon,
+           in-process or with pal2nal when --pal2nal is set.
+        5. Calculate Nei-Gojobori synonymous mutation rates, or run PAML yn00
+           when --yang is set, to get both Yang-Nielsen and Nei-Gojobori.
+
+    Pairs are distributed to --cpus workers, each in its own scratch directory
+    under syn_analysis/, and rows are written as soon as they finish. Row order
+    therefore follows completion, not the input, and may change between runs.
+    Match rows to pairs by the `name` column, as read_ks_file() does, rather
+    than pairing them with the input by position.
+    Yang-Nielsen columns are NA without --yang.
     """
     from jcvi.formats.fasta import translate
 
@@ -445,6 +461,14 @@ def calc(args):
                       "e.g. ESTs [default: %default]")
     p.add_option("--msa", default="clustalw", choices=("clustalw", "muscle"),
                  help="software used to align the proteins [default: %default]")
+    p.add_option("--yang", default=False, action="store_true",
+                 help="Run PAML yn00 for Yang-Nielsen estimates. Rows come "
+                      "out in completion order, match them by name "
+                      "[default: %default]")
+    p.add_option("--pal2nal", default=False, action="store_true",
+                 help="Thread CDS onto the protein alignment with pal2nal "
+                      "instead of in-process [default: %default]")
+    p.set_cpus()
     p.set_outfile()
 
     opts, args = p.parse_args(args)
@@ -459,6 +483,7 @@ def calc(args):
 
     output_h = must_open(opts.outfile, "w")
     print >> output_h, header
+    output_h.flush()
     work_dir = op.join(os.getcwd(), "syn_analysis")
     mkdir(work_dir)
 
@@ -471,28 +496,81 @@ def calc(args):
 
     prot_iterator = SeqIO.parse(open(protein_file), "fasta")
     dna_iterator = SeqIO.parse(open(dna_file), "fasta")
-    for p_rec_1, p_rec_2, n_rec_1, n_rec_2 in \
-            zip(prot_iterator, prot_iterator, dna_iterator, dna_iterator):
-
-        print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
-        if opts.msa == "clustalw":
-            align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
-        elif opts.msa == "muscle":
-            align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
-        mrtrans_fasta = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir)
-        if mrtrans_fasta:
-            ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
-                    find_synonymous(mrtrans_fasta, work_dir)
-            if ds_subs_yn is not None:
-                pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
-                output_h.write("%s\n" % (",".join(str(x) for x in (pair_name,
-                        ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))))
-                output_h.flush()
+    pairs = izip(prot_iterator, prot_iterator, dna_iterator, dna_iterator)
+
+    pool = Pool(opts.cpus, initializer=ks_init,
+                initargs=(work_dir, opts.msa, opts.yang, opts.pal2nal))
+    npairs = 0
+    for row in pool.imap_unordered(ks_pair, pairs):
+        if row is None:
+            continue
+        output_h.write(row + "\n")
+        output_h.flush()
+        npairs += 1
+    pool.close()
+    pool.join()
+    logging.debug("A total of {0} pairs written.".format(npairs))
 
     # Clean-up
     sh("rm -rf 2YN.t 2YN.dN 2YN.dS rst rub rst1 syn_analysis")
 
 
+ks_state = {}
+
+
+def ks_init(work_dir, msa, yang, pal2nal):
+    """
+    Pool initializer for `calc`. Each worker runs in its own scratch directory
+    since yn00 writes its files to the current directory.
+    """
+    scratch = mkdtemp(prefix="worker", dir=work_dir)
+    os.chdir(scratch)
+    ks_state.update(work_dir=scratch, msa=msa, yang=yang, pal2nal=pal2nal)
+
+
+def ks_pair(recs):
+    """
+    Align one protein pair, thread the CDS onto the alignment and return the
+    output row, or None if the pair fails.
+    """
+    p_rec_1, p_rec_2, n_rec_1, n_rec_2 = recs
+    work_dir = ks_state["work_dir"]
+    print >>sys.stderr, "--------", p_rec_1.name, p_rec_2.name
+    if ks_state["msa"] == "clustalw":
+        align_fasta = clustal_align_protein((p_rec_1, p_rec_2), work_dir)
+    elif ks_state["msa"] == "muscle":
+        align_fasta = muscle_align_protein((p_rec_1, p_rec_2), work_dir)
+    prot_aligned = [str(x.seq) for x in \
+                        SeqIO.parse(cStringIO.StringIO(align_fasta), "fasta")]
+    if len(prot_aligned) != 2:
+        return None
+    if ks_state["pal2nal"]:
+        nuc_file = run_mrtrans(align_fasta, (n_rec_1, n_rec_2), work_dir,
+                               outfmt="fasta")
+        codons = [str(x.seq) for x in SeqIO.parse(nuc_file, "fasta")] \
+                    if nuc_file else None
+    else:
+        codons = codon_align(prot_aligned, (n_rec_1.seq, n_rec_2.seq))
+    if codons is None:
+        print >>sys.stderr, "***CDS could not be aligned to protein"
+        return None
+
+    if ks_state["yang"]:
+        paml_file = write_paml_alignment(codons, work_dir)
+        ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng = \
+                find_synonymous(paml_file, work_dir)
+        if ds_subs_yn is None:
+            return None
+    else:
+        ds_subs_yn = dn_subs_yn = "NA"
+        ds_subs_ng, dn_subs_ng = ["NA" if x is None else "{0:.4f}".format(x) \
+                                  for x in nei_gojobori(*codons)]
+
+    pair_name = "%s;%s" % (p_rec_1.name, p_rec_2.name)
+    return ",".join(str(x) for x in (pair_name,
+                    ds_subs_yn, dn_subs_yn, ds_subs_ng, dn_subs_ng))
+
+
 def find_synonymous(input_file, work_dir):
     """Run yn00 to find the synonymous subsitution rate for the alignment.
     """
@@ -562,6 +640,149 @@ def extract_subs_value(text):
     return value
 
 
+def codon_align(prot_aligned, cds):
+    """
+    Thread each CDS onto its aligned protein, codon by codon, as pal2nal does.
+    Returns None if the CDS is too short for the protein.
+
+    >>> codon_align(["M-K", "MRK"], ["ATGAAA", "ATGCGTAAG"])
+    ['ATG---AAA', 'ATGCGTAAG']
+    """
+    aligned = []
+    for pa, nuc in zip(prot_aligned, cds):
+        nuc = str(nuc).upper()
+        if len(pa.replace("-", "")) * 3 > len(nuc):
+            return None
+        codons = []
+        i = 0
+        for aa in pa:
+            if aa == "-":
+                codons.append("---")
+            else:
+                codons.append(nuc[i:i + 3])
+                i += 3
+        aligned.append("".join(codons))
+    return aligned
+
+
+def write_paml_alignment(codons, work_dir):
+    nuc_file = op.join(work_dir, "nuc-align.paml")
+    fw = open(nuc_file, "w")
+    print >> fw, " {0} {1}".format(len(codons), len(codons[0]))
+    for i, seq in enumerate(codons):
+        print >> fw, "seq{0}\n{1}".format(i + 1, seq)
+    fw.close()
+    return nuc_file
+
+
+NG86 = {}
+
+
+def ng86_tables():
+    """
+    Per-codon synonymous sites, and synonymous and nonsynonymous differences
+    between every pair of codons averaged over the mutational pathways that do
+    not go through a stop codon (Nei & Gojobori 1986). Codons are indexed
+    16 * i + 4 * j + k over ACGT; stop codons are marked invalid.
+    """
+    if NG86:
+        return NG86["tables"]
+
+    from Bio.Data.CodonTable import standard_dna_table as table
+
+    bases = "ACGT"
+    codons = ["".join(x) for x in product(bases, repeat=3)]
+    aa = [table.forward_table.get(x) for x in codons]  # None for stop codons
+    valid = np.array([x is not None for x in aa])
+
+    sites = np.zeros(64)
+    for c, codon in enumerate(codons):
+        if not valid[c]:
+            continue
+        for pos, b in product(xrange(3), bases):
+            if b == codon[pos]:
+                continue
+            mutant = codon[:pos] + b + codon[pos + 1:]
+            if aa[codons.index(mutant)] == aa[c]:
+                sites[c] += 1 / 3.
+
+    sdiffs = np.zeros((64, 64))
+    ndiffs = np.zeros((64, 64))
+    for a, b in product(xrange(64), repeat=2):
+        if not (valid[a] and valid[b]) or a == b:
+            continue
+        diffs = [i for i in xrange(3) if codons[a][i] != codons[b][i]]
+        paths = []
+        for order in permutations(diffs):
+            codon, steps = codons[a], []
+            for pos in order:
+                codon = codon[:pos] + codons[b][pos] + codon[pos + 1:]
+                steps.append(codons.index(codon))
+            paths.append(steps)
+        paths = [x for x in paths if valid[x].all()] or paths
+        for steps in paths:
+            prev = a
+            for x in steps:
+                if aa[prev] == aa[x]:
+                    sdiffs[a, b] += 1. / len(paths)
+                else:
+                    ndiffs[a, b] += 1. / len(paths)
+                prev = x
+
+    lut = np.empty(256, dtype=int)
+    lut.fill(64)
+    for i, b in enumerate(bases):
+        lut[ord(b)] = lut[ord(b.lower())] = i
+
+    NG86["tables"] = tables = (lut, valid, sites, sdiffs, ndiffs)
+    return tables
+
+
+def codon_indices(seq, lut):
+    """
+    Codon indices of a CDS, -1 for codons with gaps or ambiguous bases.
+    """
+    seq = str(seq)
+    seq = np.fromstring(seq[:len(seq) / 3 * 3], dtype=np.uint8)
+    c = lut[seq].reshape(-1, 3)
+    idx = 16 * c[:, 0] + 4 * c[:, 1] + c[:, 2]
+    idx[(c > 3).any(axis=1)] = -1
+    return idx
+
+
+def jukes_cantor(p):
+    if 1 - 4 * p / 3 <= 0:
+        return None
+    return -3 * log(1 - 4 * p / 3) / 4
+
+
+def nei_gojobori(seq1, seq2):
+    """
+    Nei-Gojobori dS and dN between two codon-aligned CDS, as the NG86 estimate
+    in yn00. Codons with gaps, ambiguous bases or stops are skipped. Returns
+    None for a value where the Jukes-Cantor correction is undefined.
+
+    >>> a = "ATGAAACTTGGGCCCTTTAGCGATCAAGTTACGTGGAAACGT"
+    >>> b = "ATGAAGCTTGGACCCTTCAGCGAACAAATTACGTGGAGACGT"
+    >>> print "{0:.4f} {1:.4f}".format(*nei_gojobori(a, b))
+    0.5199 0.0939
+    """
+    lut, valid, sites, sdiffs, ndiffs = ng86_tables()
+    a, b = codon_indices(seq1, lut), codon_indices(seq2, lut)
+    n = min(len(a), len(b))
+    a, b = a[:n], b[:n]
+    ok = (a >= 0) & (b >= 0)
+    ok[ok] = valid[a[ok]] & valid[b[ok]]
+    a, b = a[ok], b[ok]
+    S = (sites[a] + sites[b]).sum() / 2
+    N = 3 * len(a) - S
+    if S == 0 or N == 0:
+        return None, None
+    ds = jukes_cantor(sdiffs[a, b].sum() / S)
+    dn = jukes_cantor(ndiffs[a, b].sum() / N)
+    return ds, dn
+
+
 def run_mrtrans(align_fasta, recs, work_dir, outfmt="paml"):
     """Align nucleotide sequences with mrtrans and the protein alignment.
     """
@@ -922,6 +1143,10 @@ def report(args):
             continue
 
         columndata = [x for x in columndata if ks_min <= x <= ks_max]
+        if not columndata:  # e.g. yn_ks is NA unless calc was run with --yang
+            logging.debug("No {0} values in [{1}, {2}], skipped.".\
+                            format(f, ks_min, ks_max))
+            continue
 
         st = SummaryStats(columndata)
         title = "{0} ({1}): ".format(descriptions[f], ks_file)
@@ -941,6 +1166,10 @@ def report(args):
     components = opts.components
     data = [x.ng_ks for x in data]
     data = [x for x in data if ks_min <= x <= ks_max]
+    if not data:
+        logging.error("No ng_ks values in [{0}, {1}] to plot.".\
+                        format(ks_min, ks_max))
+        return
 
     fig = plt.figure(1, (iopts.w, iopts.h))
     ax = fig.add_axes([.12, .1, .8, .8])
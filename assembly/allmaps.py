@@ -8,19 +8,20 @@ Scaffold Ordering with Weighted Maps.
 import os.path as op
 import sys
 import logging
+import time
 
 import numpy as np
-import networkx as nx
 
 from itertools import combinations, product
 from collections import defaultdict
+from multiprocessing import Pool
 
 from jcvi import __version__ as version
 from jcvi.algorithms.formula import reject_outliers, spearmanr
 from jcvi.algorithms.lis import longest_monotonic_subseq_length as lms, \
-            longest_monotonic_subsequence as lmseq
+            longest_monotonic_subsequence as lmseq, patience_extend
 from jcvi.algorithms.tsp import hamiltonian
-from jcvi.algorithms.matrix import determine_signs
+from jcvi.algorithms.matrix import determine_signs, floyd_warshall
 from jcvi.algorithms.ec import GA_setup, GA_run
 from jcvi.formats.agp import AGP, order_to_agp, build as agp_build, reindex
 from jcvi.formats.base import DictFile, FileMerger, must_open
@@ -33,7 +34,7 @@ from jcvi.utils.grouper import Grouper
 from jcvi.utils.iter import flatten, pairwise
 from jcvi.utils.table import tabulate
 from jcvi.apps.base import OptionParser, ActionDispatcher, sh, \
-            need_update, get_today, SUPPRESS_HELP
+            need_update, get_today, which, SUPPRESS_HELP
 
 
 START, END = "START", "END"
@@ -96,24 +97,13 @@ class LinkageGroup (object):
         self.rho = 0
 
     def populate_pairwise_distance(self):
-        distances = {}
-        series = self.series
+        """
+        Linkage distances between scaffolds in path order, as a matrix.
+        """
         linkage = self.linkage
-        for a, b in combinations(self.path, 2):
-            d = linkage_distance(series[a], series[b], linkage=linkage)
-            distances[a, b] = distances[b, a] = d
-
-        for p in self.path:
-            adist = linkage_distance([0], series[p], linkage=linkage)
-            bdist = linkage_distance(series[p], [self.length], linkage=linkage)
-            if self.rho < 0:
-                adist, bdist = bdist, adist
-            distances[START, p] = distances[p, START] = adist
-            distances[END, p] = distances[p, END] = bdist
-
-        self.distances = distances
-
-        return distances
+        X = padded_series(self.series, self.path)
+        self.distances = linkage_matrix(X, X, linkage=linkage)
+        return self.distances
 
 
 class ScaffoldOO (object):
@@ -149,8 +139,9 @@ class ScaffoldOO (object):
             scaffolds_oo = dict(tour)
             scfs, tour, ww = self.prepare_ec(scaffolds, tour, weights)
             toolbox = GA_setup(tour)
-            toolbox.register("evaluate", colinear_evaluate_multi,
-                                         scfs=scfs, weights=ww)
+            evaluator = ColinearEvaluator(scfs, ww)
+            toolbox.register("evaluate", evaluator)
+            toolbox.register("map", evaluator.map)
             tour, fitness = GA_run(toolbox, ngen=ngen, npop=npop, cpus=cpus)
             tour = [scaffolds[x] for x in tour]
             tour = [(x, scaffolds_oo[x]) for x in tour]
@@ -225,37 +216,52 @@ class ScaffoldOO (object):
             self.linkage_groups.append(LG)
 
     def distances_to_tour(self):
+        """
+        Distances is a dense matrix over scaffolds, START and END (the last two
+        rows), NaN for missing pairs. Scaffold pairs not linked in any map are
+        filled with their shortest path lengths before solving the TSP.
+        """
         scaffolds = self.scaffolds
         distances = self.distances
-        G = nx.DiGraph()
-        for (a, b), v in distances.items():
-            d = self.weighted_mean(v)
-            G.add_edge(a, b, weight=d)
-            if a == START or b == END:
-                continue
-            G.add_edge(b, a, weight=d)
-
-        logging.debug("Graph size: |V|={0}, |E|={1}.".format(len(G), G.size()))
-
-        L = nx.all_pairs_dijkstra_path_length(G)
-        for a, b in combinations(scaffolds, 2):
-            if G.has_edge(a, b):
-                continue
-            l = L[a][b]
-            G.add_edge(a, b, weight=l)
-            G.add_edge(b, a, weight=l)
-
+        n = len(scaffolds)
+        start, end = n, n + 1
+
+        M = distances[:n, :n]
+        missing = np.isnan(M)
+        np.fill_diagonal(missing, False)
+        nedges = (~missing).sum() - n + 2 * (~np.isnan(distances[start])).sum()
+        logging.debug("Graph size: |V|={0}, |E|={1}.".format(n + 2, nedges))
+
+        t0 = time.time()
+        if missing.any():
+            M = np.where(missing, floyd_warshall(np.where(missing, np.inf, M)),
+                         M)
+        logging.debug("Shortest paths filled in {0:.2f}s.".\
+                        format(time.time() - t0))
+
+        nodes = list(scaffolds) + [START, END]
         edges = []
-        for a, b, d in G.edges(data=True):
-            edges.append((a, b, d['weight']))
-
+        for a, b in zip(*np.nonzero(np.isfinite(M))):
+            if a != b:
+                edges.append((nodes[a], nodes[b], M[a, b]))
+        for p in np.flatnonzero(np.isfinite(distances[start, :n])):
+            edges.append((START, nodes[p], distances[start, p]))
+        for p in np.flatnonzero(np.isfinite(distances[:n, end])):
+            edges.append((nodes[p], END, distances[p, end]))
+
+        solver = "concorde" if which("concorde") else "native"
+        t0 = time.time()
         try:
-            tour = hamiltonian(edges, directed=True, precision=2)
+            tour = hamiltonian(edges, directed=True, precision=2,
+                               solver=solver)
             assert tour[0] == START and tour[-1] == END
             tour = tour[1:-1]
         except:
-            logging.debug("concorde-TSP failed. Use default scaffold ordering.")
+            logging.debug("{0}-TSP failed. Use default scaffold ordering.".\
+                            format(solver))
             tour = scaffolds[:]
+        logging.debug("{0}-TSP on {1} scaffolds in {2:.2f}s.".\
+                        format(solver, n, time.time() - t0))
         return tour
 
     def assign_order(self):
@@ -284,27 +290,33 @@ class ScaffoldOO (object):
             if mlg.rho < 0:
                 mlg.path = mlg.path[::-1]
 
+            t0 = time.time()
             mlg.populate_pairwise_distance()
-
-        # Preparation of TSP
-        distances = defaultdict(list)
+            logging.debug("{0}: {1} scaffolds, pairwise distances in {2:.2f}s.".\
+                            format(mlg.lg, len(mlg.path), time.time() - t0))
+
+        # Preparation of TSP, weighted mean of distances across maps
+        scaffolds_ii = dict((s, i) for i, s in enumerate(self.scaffolds))
+        n = len(self.scaffolds)
+        start, end = n, n + 1
+        total = np.zeros((n + 2, n + 2))
+        wsum = np.zeros((n + 2, n + 2))
         for mlg in linkage_groups:
-            mapname = mlg.mapname
-            position = mlg.position
-            length = mlg.length
-            path = mlg.path
-            rho = mlg.rho
-            dd = mlg.distances
-            for a, b in combinations(path, 2):
-                d = dd[a, b]
-                distances[a, b].append((d, mapname))
-            for p in path:
-                adist, bdist = position[p], length - position[p]
-                if rho < 0:
-                    adist, bdist = bdist, adist
-                distances[START, p].append((adist, mapname))
-                distances[p, END].append((bdist, mapname))
-
+            w = float(self.weights[mlg.mapname])
+            ii = np.array([scaffolds_ii[x] for x in mlg.path])
+            pos = np.array([mlg.position[x] for x in mlg.path])
+            adist, bdist = pos, mlg.length - pos
+            if mlg.rho < 0:
+                adist, bdist = bdist, adist
+            total[np.ix_(ii, ii)] += w * mlg.distances
+            wsum[np.ix_(ii, ii)] += w
+            total[start, ii] += w * adist
+            wsum[start, ii] += w
+            total[ii, end] += w * bdist
+            wsum[ii, end] += w
+
+        with np.errstate(invalid="ignore"):
+            distances = total / wsum  # NaN where no map links the pair
         self.distances = distances
         tour = self.distances_to_tour()
         return tour
@@ -709,6 +721,126 @@ class GapEstimator (object):
             self.gapsizes.append(gapsize)
 
 
+class ColinearEvaluator (object):
+    """
+    Same fitness as colinear_evaluate_multi(), for repeated evaluation of
+    tours in the GA. Series of each scaffold are looked up once, fitness is
+    memoized per tour, and the patience sort states (one per map) are kept at
+    checkpoints along the tour. The longest increasing run is resumed from the
+    longest cached prefix and the longest decreasing run, which is sorted from
+    the end, from the longest cached suffix. Inversion and insertion mutants
+    share both with their parents.
+    """
+    def __init__(self, scfs, weights, checkpoints=16, cachesize=5000):
+        self.weights = weights
+        self.forward = [dict((k, v) for k, v in scf.items() if v) \
+                            for scf in scfs]
+        self.reverse = [dict((k, v[::-1]) for k, v in scf.items() if v) \
+                            for scf in scfs]
+        self.checkpoints = checkpoints
+        self.cachesize = cachesize
+        self.clear()
+
+    def clear(self):
+        self.fitness = {}
+        self.prefixes = {}
+        self.suffixes = {}
+
+    def __getstate__(self):
+        # Caches stay in the process that built them
+        state = self.__dict__.copy()
+        state.update(fitness={}, prefixes={}, suffixes={})
+        return state
+
+    def __call__(self, tour):
+        tour = tuple(tour)
+        fitness = self.fitness.get(tour)
+        if fitness is None:
+            if len(self.fitness) > 50 * self.cachesize:
+                self.fitness = {}
+            fitness = self.fitness[tour] = self.evaluate(tour)
+        return fitness
+
+    def map(self, func, individuals):
+        """
+        Evaluate a population in one batch, used as toolbox.map. Duplicated
+        tours are scored once, and tours are scored in sorted order so that
+        the ones sharing prefixes follow each other.
+        """
+        if getattr(func, "func", func) is not self:  # toolbox wraps in partial
+            return map(func, individuals)
+
+        tours = [tuple(x) for x in individuals]
+        for tour in sorted(set(tours)):
+            self(tour)
+        return [self.fitness[x] for x in tours]
+
+    def resume(self, cache, keys):
+        for key in keys:
+            states = cache.get(key)
+            if states is not None:
+                return len(key), [list(x) for x in states]
+        return 0, [[] for x in self.weights]
+
+    def run(self, cache, tour, series):
+        """
+        Patience sort the series of the scaffolds in tour, starting from the
+        state of the longest cached prefix, and return the LIS lengths.
+        """
+        n = len(tour)
+        step = max(1, n / self.checkpoints)
+        marks = range(step, n, step)
+        done, states = self.resume(cache, (tour[:c] for c in marks[::-1]))
+        if len(cache) > self.cachesize:
+            cache.clear()
+
+        bounds = [done] + [x for x in marks if x > done] + [n]
+        empty = ()
+        for a, b in pairwise(bounds):
+            segment = tour[a:b]
+            for tops, scf in zip(states, series):
+                patience_extend(tops, [x for t in segment \
+                                         for x in scf.get(t, empty)])
+            if b < n:
+                cache[tour[:b]] = [tuple(x) for x in states]
+        return [len(x) for x in states]
+
+    def evaluate(self, tour):
+        inc = self.run(self.prefixes, tour, self.forward)
+        dec = self.run(self.suffixes, tour[::-1], self.reverse)
+        weighted_score = 0
+        for li, ld, w in zip(inc, dec, self.weights):
+            weighted_score += max(li, ld) * w
+        return (weighted_score,)
+
+
+oo_state = {}
+
+
+def oo_init(mapc, pivot, weights, sizes, function, linkage, ngen, npop, cpus):
+    """
+    Pool initializer for `path`, shared inputs are handed to each worker
+    once rather than pickled with every partition.
+    """
+    oo_state.update(mapc=mapc, pivot=pivot, weights=weights, sizes=sizes,
+                    function=function, linkage=linkage,
+                    ngen=ngen, npop=npop, cpus=cpus)
+
+
+def oo_partition(task):
+    """
+    Order and orient the scaffolds in one partition, returns the index of the
+    task along with the chromosome name and the tour.
+    """
+    i, lgs, scaffolds = task
+    st = oo_state
+    logging.debug("Working on {0} ...".format("|".join(lgs)))
+    s = ScaffoldOO(lgs, scaffolds, st["mapc"], st["pivot"], st["weights"],
+                   st["sizes"], function=st["function"], linkage=st["linkage"],
+                   ngen=st["ngen"], npop=st["npop"], cpus=st["cpus"])
+    return i, s.object, s.tour
+
+
 def colinear_evaluate_multi(tour, scfs, weights):
     weighted_score = 0
     for scf, w in zip(scfs, weights):
@@ -735,6 +867,62 @@ def linkage_distance(a, b, linkage=min):
     return linkage([abs(i - j) for i, j in product(a, b)])
 
 
+def padded_series(series, keys):
+    """
+    Marker series of keys as rows of a float array, padded with NaN.
+    """
+    lengths = [len(series[k]) for k in keys]
+    X = np.empty((len(keys), max(lengths)))
+    X.fill(np.nan)
+    for i, k in enumerate(keys):
+        X[i, :lengths[i]] = series[k]
+    return X
+
+
+def double_linkage_rows(P):
+    P = np.sort(P, axis=1)  # NaN goes last
+    counts = (~np.isnan(P)).sum(axis=1)
+    if P.shape[1] == 1:
+        return P[:, 0]
+    return np.where(counts > 1, (P[:, 0] + P[:, 1]) / 2., P[:, 0])
+
+
+linkage_reducers = {
+    min: lambda P: np.nanmin(P, axis=1),
+    max: lambda P: np.nanmax(P, axis=1),
+    np.mean: lambda P: np.nanmean(P, axis=1),
+    np.median: lambda P: np.nanmedian(P, axis=1),
+}
+
+
+def linkage_matrix(X, Y, linkage=min, blocksize=1 << 22):
+    """
+    Same as linkage_distance() between every row of X and every row of Y, for
+    NaN-padded series. Marker differences are broadcast for a block of rows in
+    Y at a time, and reduced with the NaN-aware version of the linkage.
+    """
+    reduce = linkage_reducers.get(linkage)
+    if linkage is double_linkage:
+        reduce = double_linkage_rows
+    nrows, ny = X.shape[0], Y.shape[0]
+    D = np.empty((nrows, ny))
+    if reduce is None:  # Unknown linkage, compute pair by pair
+        xs = [x[~np.isnan(x)] for x in X]
+        ys = [y[~np.isnan(y)] for y in Y]
+        for i, j in product(xrange(nrows), xrange(ny)):
+            D[i, j] = linkage_distance(xs[i], ys[j], linkage=linkage)
+        return D
+
+    step = max(1, blocksize / (X.shape[1] * Y.shape[1]))
+    for i, x in enumerate(X):
+        x = x[~np.isnan(x)]
+        for j in xrange(0, ny, step):
+            block = Y[j:j + step]
+            P = np.abs(block[:, None, :] - x[None, :, None])
+            D[i, j:j + step] = reduce(P.reshape(len(block), -1))
+    return D
+
+
 def double_linkage(L):
     if len(L) == 1:
         return L[0]
@@ -1065,7 +1253,7 @@ def path(args):
     sizes = Sizes(fastafile).mapping
     fwagp = must_open(agpfile, "w")
     fwtour = must_open(tourfile, "w")
-    solutions = []
+    tasks = []
     for lgs, scaffolds in sorted(partitions.items()):
         if oseqid and oseqid not in lgs:
             continue
@@ -1074,15 +1262,37 @@ def path(args):
         if pivot not in lgs_maps:
             logging.debug("Skipping {0} ...".format(tag))
             continue
-        logging.debug("Working on {0} ...".format(tag))
-        s = ScaffoldOO(lgs, scaffolds, cc, pivot, weights, sizes,
-                       function=function, linkage=linkage,
-                       ngen=ngen, npop=npop, cpus=cpus)
-
+        tasks.append((len(tasks), lgs, scaffolds))
+
+    # One partition per task, GA runs serially within each worker
+    ntasks = len(tasks)
+    pool = None
+    if cpus > 1 and ntasks > 1:
+        pool = Pool(min(cpus, ntasks), initializer=oo_init,
+                    initargs=(cc, pivot, weights, sizes, function, linkage,
+                              ngen, npop, 1))
+        results = pool.imap_unordered(oo_partition, tasks)
+    else:
+        oo_init(cc, pivot, weights, sizes, function, linkage,
+                ngen, npop, cpus)
+        results = (oo_partition(x) for x in tasks)
+
+    solutions = {}
+    for k, (i, chrom, tour) in enumerate(results):
+        tag = "|".join(tasks[i][1])
+        logging.debug("Finished {0} ({1}) [{2}/{3}]".\
+                        format(chrom, tag, k + 1, ntasks))
+        solutions[i] = (chrom, tour)
+    if pool:
+        pool.close()
+        pool.join()
+
+    # Report in partition order regardless of completion order
+    solutions = [solutions[i] for i in sorted(solutions)]
+    for (chrom, tour), (i, lgs, scaffolds) in zip(solutions, tasks):
         for fw in (sys.stderr, fwtour):
-            print >> fw, ">{0} ({1})".format(s.object, tag)
-            print >> fw, " ".join("".join(x) for x in s.tour)
-        solutions.append(s)
+            print >> fw, ">{0} ({1})".format(chrom, "|".join(lgs))
+            print >> fw, " ".join("".join(x) for x in tour)
     fwtour.close()
 
     # meta-data about the run parameters
@@ -1092,8 +1302,8 @@ def path(args):
                      format(version, get_today(), command)
     AGP.print_header(fwagp, comment=comment)
 
-    for s in sorted(solutions, key=lambda x: x.object):
-        order_to_agp(s.object, s.tour, sizes, fwagp, gapsize=gapsize,
+    for chrom, tour in sorted(solutions):
+        order_to_agp(chrom, tour, sizes, fwagp, gapsize=gapsize,
                      gaptype="map")
     fwagp.close()
 
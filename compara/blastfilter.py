@@ -27,8 +27,8 @@ import os.path as op
 from collections import defaultdict
 from itertools import groupby
 
-from jcvi.formats.blast import BlastLine
-from jcvi.utils.grouper import Grouper
+from jcvi.formats.blast import Blast
+from jcvi.utils.grouper import ArrayGrouper
 from jcvi.utils.cbook import gene_name
 from jcvi.compara.synteny import check_beds
 from jcvi.apps.base import OptionParser
@@ -41,13 +41,9 @@ def blastfilter_main(blast_file, p, opts):
     tandem_Nmax = opts.tandem_Nmax
     cscore = opts.cscore
 
-    fp = file(blast_file)
-    total_lines = sum(1 for line in fp)
+    blasts = sorted(Blast(blast_file), key=lambda b: b.score, reverse=True)
     logging.debug("Load BLAST file `%s` (total %d lines)" % \
-            (blast_file, total_lines))
-    fp.seek(0)
-    blasts = sorted([BlastLine(line) for line in fp], \
-            key=lambda b: b.score, reverse=True)
+            (blast_file, len(blasts)))
 
     filtered_blasts = []
     seen = set()
@@ -237,7 +233,7 @@ def tandem_grouper(bed, blast_list, tandem_Nmax=10, flip=True):
 
     simple_blast.sort()
 
-    standems = Grouper()
+    standems = ArrayGrouper(size=len(bed))
     for name, hits in groupby(simple_blast, key=lambda x: x[0]):
         # these are already sorted.
         hits = [x[1] for x in hits]
@@ -22,17 +22,26 @@ import cStringIO
 import logging
 
 from jcvi.utils.range import range_overlap
-from jcvi.utils.grouper import Grouper
-from jcvi.algorithms.lpsolve import GLPKSolver, SCIPSolver
+from jcvi.utils.grouper import ArrayGrouper
+from jcvi.algorithms.lpsolve import GLPKSolver, SCIPSolver, PackingSolver
 from jcvi.compara.synteny import AnchorFile, _score, check_beds
 from jcvi.formats.base import must_open
 from jcvi.apps.base import OptionParser
 
 
-def get_1D_overlap(eclusters, depth=1):
+def get_1D_overlap(eclusters, depth=1, maximal=True):
     """
     Find blocks that are 1D overlapping,
     returns cliques of block ids that are in conflict
+
+    With `maximal`, only the active set at each local maximum of the sweep is
+    kept, since the constraint over any of its subsets is implied by it.
+
+    >>> ec = [("1", 0, 10), ("1", 2, 12), ("1", 4, 14), ("1", 20, 30)]
+    >>> sorted(get_1D_overlap(ec, maximal=False))
+    [(0, 1), (0, 1, 2), (1, 2)]
+    >>> sorted(get_1D_overlap(ec))
+    [(0, 1, 2)]
     """
     overlap_set = set()
     active = set()
@@ -44,19 +53,30 @@ def get_1D_overlap(eclusters, depth=1):
     ends.sort()
 
     chr_last = ""
+    nsets = 0
+    grown = False
     for chr, pos, left_right, i in ends:
         if chr != chr_last:
             active.clear()
         if left_right == 0:
             active.add(i)
+            grown = True
         else:
+            if maximal and grown and len(active) > depth:
+                overlap_set.add(tuple(sorted(active)))
+            grown = False
             active.remove(i)
 
         if len(active) > depth:
-            overlap_set.add(tuple(sorted(active)))
+            nsets += 1
+            if not maximal:
+                overlap_set.add(tuple(sorted(active)))
 
         chr_last = chr
 
+    logging.debug("Overlapping sets: {0} emitted, {1} kept.".\
+                  format(nsets, len(overlap_set)))
+
     return overlap_set
 
 
@@ -70,7 +90,7 @@ def get_2D_overlap(chain, eclusters):
        also put this block in the `active` set
     3. if right end, remove block from the `active` set
     """
-    mergeables = Grouper()
+    mergeables = ArrayGrouper(size=len(eclusters))
     active = set()
 
     x_ends = []
@@ -129,7 +149,7 @@ def make_range(clusters, extend=0):
     return eclusters
 
 
-def get_constraints(clusters, quota=(1,1), Nmax=0):
+def get_constraints(clusters, quota=(1,1), Nmax=0, maximal=True):
     """
     Check pairwise cluster comparison, if they overlap then mark edge as conflict
     """
@@ -141,8 +161,8 @@ def get_constraints(clusters, quota=(1,1), Nmax=0):
     eclusters_x, eclusters_y, scores = zip(*eclusters)
 
     # represents the contraints over x-axis and y-axis
-    constraints_x = get_1D_overlap(eclusters_x, qa)
-    constraints_y = get_1D_overlap(eclusters_y, qb)
+    constraints_x = get_1D_overlap(eclusters_x, qa, maximal=maximal)
+    constraints_y = get_1D_overlap(eclusters_y, qb, maximal=maximal)
 
     return nodes, constraints_x, constraints_y
 
@@ -197,16 +217,30 @@ def format_lp(nodes, constraints_x, qa, constraints_y, qb):
 
 
 def solve_lp(clusters, quota, work_dir="work", Nmax=0,
-        self_match=False, solver="SCIP", verbose=False):
+        self_match=False, solver="SCIP", verbose=False, maximal=True):
     """
     Solve the formatted LP instance
     """
     qb, qa = quota # flip it
-    nodes, constraints_x, constraints_y = get_constraints(clusters, (qa, qb), Nmax=Nmax)
+    nodes, constraints_x, constraints_y = get_constraints(clusters, (qa, qb),
+                                                Nmax=Nmax, maximal=maximal)
 
     if self_match:
         constraints_x = constraints_y = constraints_x | constraints_y
 
+    if solver == "native":
+        # Greedy plus local search is the common case; for larger quotas an
+        # in-process MIP is used when available
+        constraints = [(c, qa) for c in constraints_x]
+        if not (constraints_x is constraints_y):
+            constraints += [(c, qb) for c in constraints_y]
+        print >> sys.stderr, "number of variables (%d), number of constraints (%d)" % \
+                (len(nodes), len(constraints))
+        weights = [score for i, score in nodes]
+        exact = max(qa, qb) > 2
+        return PackingSolver(weights, constraints, exact=exact,
+                             verbose=verbose).results
+
     lp_data = format_lp(nodes, constraints_x, qa, constraints_y, qb)
 
     if solver=="SCIP":
@@ -224,6 +258,54 @@ def solve_lp(clusters, quota, work_dir="work", Nmax=0,
     return filtered_list
 
 
+def make_synthetic_clusters(nblocks=1000, nchrs=10, chrsize=10000,
+                            maxsize=100, seed=666):
+    """
+    Random anchor clusters along nchrs x nchrs chromosome pairs, in the same
+    format as read_clusters(), for benchmarking the solvers.
+    """
+    import random
+
+    random.seed(seed)
+    clusters = []
+    for i in xrange(nblocks):
+        ca, cb = random.randrange(nchrs), random.randrange(nchrs)
+        size = random.randint(2, maxsize)
+        a = random.randrange(chrsize - size)
+        b = random.randrange(chrsize - size)
+        cluster = [((ca, a + j), (cb, b + j), 1) for j in xrange(size)]
+        clusters.append(cluster)
+
+    return clusters
+
+
+def benchmark(quotas=((1, 1), (1, 2)), nblocks=(100, 1000, 10000)):
+    """
+    Compare solution quality and wall-clock time of the `native` solver
+    against SCIP on synthetic block sets.
+    """
+    import time
+    import shutil
+    from tempfile import mkdtemp
+
+    print "\t".join(("quota", "blocks", "solver", "score", "seconds"))
+    for qa, qb in quotas:
+        for n in nblocks:
+            clusters = make_synthetic_clusters(nblocks=n)
+            for solver in ("native", "SCIP"):
+                work_dir = mkdtemp()
+                start = time.time()
+                try:
+                    selected = solve_lp(clusters, (qa, qb), solver=solver,
+                                        work_dir=work_dir)
+                    elapsed = time.time() - start
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+                score = sum(_score(clusters[i]) for i in selected)
+                print "\t".join(str(x) for x in ("{0}:{1}".format(qa, qb), n,
+                                 solver, score, "{0:.2f}".format(elapsed)))
+
+
 def read_clusters(qa_file, qorder, sorder):
     af = AnchorFile(qa_file)
     blocks = af.blocks
@@ -255,13 +337,18 @@ def main(args):
                     "slightly overlapping (cutoff for `quota mapping`) "\
                     "[default: %default units (gene or bp dist)]")
 
-    supported_solvers = ("SCIP", "GLPK")
+    supported_solvers = ("SCIP", "GLPK", "native")
     p.add_option("--self", dest="self_match",
             action="store_true", default=False,
             help="you might turn this on when screening paralogous blocks, "\
                  "esp. if you have reduced mirrored blocks into non-redundant set")
     p.add_option("--solver", default="SCIP", choices=supported_solvers,
-            help="use MIP solver [default: %default]")
+            help="use MIP solver, `native` runs in-process without "\
+                 "external programs [default: %default]")
+    p.add_option("--allsets", dest="maximal", default=True,
+            action="store_false",
+            help="emit every overlapping set as constraint, not only "\
+                 "the maximal ones")
     p.set_verbose(help="Show verbose solver output")
 
     p.add_option("--screen", default=False, action="store_true",
@@ -273,7 +360,8 @@ def main(args):
         sys.exit(not p.print_help())
 
     qa_file, = args
-    qbed, sbed, qorder, sorder, is_self = check_beds(qa_file, p, opts)
+    qbed, sbed, qorder, sorder, is_self = check_beds(qa_file, p, opts,
+                                                     frozen=True)
 
     # sanity check for the quota
     if opts.quota:
@@ -301,7 +389,7 @@ def main(args):
 
     selected_ids = solve_lp(clusters, quota, work_dir=work_dir, \
             Nmax=opts.Nmax, self_match=self_match, \
-            solver=opts.solver, verbose=opts.verbose)
+            solver=opts.solver, verbose=opts.verbose, maximal=opts.maximal)
 
     logging.debug("Selected {0} blocks.".format(len(selected_ids)))
     prefix = qa_file.rsplit(".", 1)[0]
@@ -7,12 +7,13 @@ import logging
 
 import numpy as np
 from collections import defaultdict
+from functools import partial
 
 from jcvi.algorithms.lis import heaviest_increasing_subsequence as his
-from jcvi.formats.bed import Bed
-from jcvi.formats.blast import BlastLine
+from jcvi.formats.bed import Bed, ArrayBed
+from jcvi.formats.blast import Blast
 from jcvi.formats.base import BaseFile, SetFile, read_block, must_open
-from jcvi.utils.grouper import Grouper
+from jcvi.utils.grouper import ArrayGrouper
 from jcvi.utils.cbook import gene_name, human_size
 from jcvi.utils.range import Range, range_chain
 from jcvi.apps.base import OptionParser, ActionDispatcher
@@ -256,11 +257,9 @@ def read_blast(blast_file, qorder, sorder, is_self=False, ostrip=True):
     """
     read the blast and convert name into coordinates
     """
-    fp = open(blast_file)
     filtered_blast = []
     seen = set()
-    for row in fp:
-        b = BlastLine(row)
+    for b in Blast(blast_file):
         query, subject = b.query, b.subject
         if query == subject:
             continue
@@ -326,7 +325,7 @@ def synteny_scan(points, xdist, ydist, N):
     iterate through the pairs, foreach pair we look back on the
     adjacent pairs to find links
     """
-    clusters = Grouper()
+    clusters = ArrayGrouper()
     n = len(points)
     points.sort()
     for i in xrange(n):
@@ -349,16 +348,118 @@ def synteny_scan(points, xdist, ydist, N):
     return clusters
 
 
-def batch_scan(points, xdist=20, ydist=20, N=5):
+def array_components(n, a, b):
+    """
+    Label the connected components of n nodes given the edges (a[i], b[i]),
+    using min-label propagation with pointer jumping on integer arrays. Every
+    node ends up labeled with the smallest index in its component.
+
+    >>> array_components(5, np.array([0, 3]), np.array([2, 4])).tolist()
+    [0, 1, 0, 3, 3]
+    """
+    labels = np.arange(n)
+    if not len(a):
+        return labels
+
+    while True:
+        m = np.minimum(labels[a], labels[b])
+        np.minimum.at(labels, a, m)
+        np.minimum.at(labels, b, m)
+        # Pointer jumping until every node points at a root
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels[a], labels[b]):
+            break
+
+    return labels
+
+
+def count_distinct(labels, values):
+    """
+    Number of distinct values carried by each label.
+
+    >>> count_distinct(np.array([0, 0, 0, 3]), np.array([5, 5, 6, 5])).tolist()
+    [2, 0, 0, 1]
+    """
+    order = np.lexsort((values, labels))
+    labels, values = labels[order], values[order]
+    first = np.ones(len(labels), dtype=bool)
+    first[1:] = (labels[1:] != labels[:-1]) | (values[1:] != values[:-1])
+    return np.bincount(labels[first], minlength=len(labels))
+
+
+def synteny_scan_numpy(points, xdist, ydist, N):
+    """
+    Vectorized version of synteny_scan(). Points are held as arrays sorted
+    by x; candidate links are found by comparing each point with its k-th
+    successor for increasing k until all pairs are more than `xdist` apart,
+    and the links are clustered with array_components(). Returns the same
+    clusters as synteny_scan(), ordered by their first point.
+    """
+    if not points:
+        return []
+
+    arr = np.array(points)
+    order = np.lexsort(arr.T[::-1])
+    arr = arr[order]
+    # Identical points collapse into one, as they would in a Grouper
+    keep = np.ones(len(arr), dtype=bool)
+    keep[1:] = np.any(arr[1:] != arr[:-1], axis=1)
+    duplicated = (np.cumsum(keep) - 1)[~keep]
+    arr, order = arr[keep], order[keep]
+
+    n = len(arr)
+    x, y = arr[:, 0], arr[:, 1]
+    a, b = [np.zeros(0, dtype=int)], [np.zeros(0, dtype=int)]
+    active = np.arange(n - 1)
+    k = 1
+    while len(active):
+        active = active[active + k < n]
+        active = active[x[active + k] - x[active] <= xdist]
+        linked = active[np.abs(y[active + k] - y[active]) <= ydist]
+        a.append(linked)
+        b.append(linked + k)
+        k += 1
+
+    a, b = np.concatenate(a), np.concatenate(b)
+    labels = array_components(n, a, b)
+
+    # Only points that were joined to something belong to a cluster
+    joined = np.zeros(n, dtype=bool)
+    for idx in (a, b, duplicated):
+        joined[idx] = True
+    joined = np.bincount(labels, weights=joined, minlength=n) > 0
+
+    # Score is the number of distinct x or y in the cluster, whichever smaller
+    roots = np.flatnonzero((labels == np.arange(n)) & joined)
+    scores = np.minimum(count_distinct(labels, x)[roots],
+                        count_distinct(labels, y)[roots])
+
+    sizes = np.bincount(labels, minlength=n)
+    offsets = np.cumsum(sizes) - sizes
+    members = np.argsort(labels, kind="mergesort")
+    clusters = []
+    for r in roots[scores >= N]:
+        idx = members[offsets[r]:offsets[r] + sizes[r]]
+        clusters.append([points[j] for j in order[idx]])
+
+    return clusters
+
+
+def batch_scan(points, xdist=20, ydist=20, N=5, engine="python"):
     """
     runs synteny_scan() per chromosome pair
     """
+    scanner = synteny_scan_numpy if engine == "numpy" else synteny_scan
     chr_pair_points = group_hits(points)
 
     clusters = []
     for chr_pair in sorted(chr_pair_points.keys()):
         points = chr_pair_points[chr_pair]
-        clusters.extend(synteny_scan(points, xdist, ydist, N))
+        clusters.extend(scanner(points, xdist, ydist, N))
 
     return clusters
 
@@ -385,7 +486,13 @@ def synteny_liftover(points, anchors, dist):
         yield point, tuple(anchors[idx])
 
 
-def check_beds(hintfile, p, opts):
+def check_beds(hintfile, p, opts, frozen=False):
+    """
+    Load the --qbed and --sbed of a comparison, guessed from `hintfile` if not
+    given. With `frozen`, the BEDs are loaded as read-only ArrayBed, which is
+    enough when the caller only needs indexing and the gene orders, and
+    cached next to the BED files if --bedcache is set.
+    """
 
     wd, hintfile = op.split(hintfile)
     if not (opts.qbed and opts.sbed):
@@ -405,8 +512,12 @@ def check_beds(hintfile, p, opts):
     if is_self:
         logging.debug("Looks like self-self comparison.")
 
-    qbed = Bed(opts.qbed)
-    sbed = Bed(opts.sbed)
+    if frozen:
+        BedClass = partial(ArrayBed, cache=getattr(opts, "bedcache", False))
+    else:
+        BedClass = Bed
+    qbed = BedClass(opts.qbed)
+    sbed = qbed if (frozen and is_self) else BedClass(opts.sbed)
     qorder = qbed.order
     sorder = sbed.order
 
@@ -421,6 +532,8 @@ def add_options(p, args, dist=10):
     p.set_beds()
     p.add_option("--dist", default=dist, type="int",
             help="Extent of flanking regions to search [default: %default]")
+    p.add_option("--bedcache", default=False, action="store_true",
+            help="Cache parsed BEDs as `bedfile.npz` for reuse [default: %default]")
 
     opts, args = p.parse_args(args)
 
@@ -1348,10 +1461,13 @@ def scan(args):
             help="minimum number of anchors in a cluster [default: %default]")
     p.add_option("--liftover",
             help="Scan BLAST file to find extra anchors [default: %default]")
+    p.add_option("--engine", default="python", choices=("python", "numpy"),
+            help="Single-linkage implementation [default: %default]")
     p.set_stripnames()
 
     blast_file, anchor_file, dist, opts = add_options(p, args, dist=20)
-    qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts)
+    qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts,
+                                                     frozen=True)
 
     filtered_blast = read_blast(blast_file, qorder, sorder, \
                                 is_self=is_self, ostrip=False)
@@ -1359,7 +1475,8 @@ def scan(args):
     fw = open(anchor_file, "w")
     logging.debug("Chaining distance = {0}".format(dist))
 
-    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n)
+    clusters = batch_scan(filtered_blast, xdist=dist, ydist=dist, N=opts.n,
+                          engine=opts.engine)
     for cluster in clusters:
         print >>fw, "###"
         for qi, si, score in cluster:
@@ -1374,6 +1491,8 @@ def scan(args):
         return anchor_file
 
     bedopts = ["--qbed=" + opts.qbed, "--sbed=" + opts.sbed]
+    if opts.bedcache:
+        bedopts += ["--bedcache"]
     ostrip = [] if opts.strip_names else ["--no_strip_names"]
     newanchorfile = liftover([lo, anchor_file] + bedopts + ostrip)
     return newanchorfile
@@ -1395,7 +1514,8 @@ def liftover(args):
     p.set_stripnames()
 
     blast_file, anchor_file, dist, opts = add_options(p, args)
-    qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts)
+    qbed, sbed, qorder, sorder, is_self = check_beds(blast_file, p, opts,
+                                                     frozen=True)
 
     filtered_blast = read_blast(blast_file, qorder, sorder,
                             is_self=is_self, ostrip=opts.strip_names)
@@ -383,6 +383,13 @@ class AGP (LineFile):
         """
         components = []
 
+        features = [dict(chr=line.component_id,
+                         start=line.component_beg,
+                         stop=line.component_end,
+                         strand=line.orientation) \
+                    for line in lines if not line.is_gap]
+        seqs = fasta.batch_sequences(features)
+
         total_bp = 0
         for line in lines:
 
@@ -391,10 +398,7 @@ class AGP (LineFile):
                 if newagp:
                     print >> newagp, line
             else:
-                seq = fasta.sequence(dict(chr=line.component_id,
-                        start=line.component_beg,
-                        stop=line.component_end,
-                        strand=line.orientation))
+                seq = next(seqs)
                 # Check for dangling N's
                 if newagp:
                     trimNs(seq, line, newagp)
@@ -414,7 +418,7 @@ class AGP (LineFile):
                 logging.debug("Write object %s to `%s`" % (object, fw.name))
 
     def build_all(self, componentfasta, targetfasta, newagp=None):
-        f = Fasta(componentfasta, index=False)
+        f = Fasta(componentfasta, faidx=True)
         fw = open(targetfasta, "w")
 
         for ob, lines in self.iter_object():
@@ -1838,8 +1842,8 @@ def validate(args):
         sys.exit(p.print_help())
 
     agp = AGP(agpfile)
-    build = Fasta(targetfasta)
-    bacs = Fasta(componentfasta, index=False)
+    build = Fasta(targetfasta, faidx=True)
+    bacs = Fasta(componentfasta, faidx=True)
 
     # go through this line by line
     for aline in agp:
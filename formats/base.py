@@ -5,11 +5,14 @@ import os
 import os.path as op
 import math
 import sys
+import heapq
 import logging
 
-from itertools import groupby, islice, cycle, izip
+from itertools import groupby, islice, cycle, izip, chain
+from multiprocessing import Pool
 
 from Bio import SeqIO
+from jcvi.utils.natsort import natsort_key
 from jcvi.apps.base import OptionParser, ActionDispatcher, sh, debug, need_update, \
             mkdir, popen
 debug()
@@ -488,6 +491,171 @@ def flexible_cast(s):
     return s
 
 
+class SortKey (object):
+    """
+    Sort key on the columns of a delimited line, given as a list of (column,
+    type) with 0-based columns. Types are `natural` (natsort_key, computed
+    once per distinct value), `str`, `int`, `float` and `-float` (descending).
+    Missing columns sort as None, and numeric columns that do not parse as 0.
+    Instances can be sent to worker processes.
+    """
+    def __init__(self, columns, sep="\t"):
+        self.columns = columns
+        self.sep = sep
+        self.natural = {}
+
+    def __call__(self, line):
+        atoms = line.rstrip("\r\n").split(self.sep)
+        natural = self.natural
+        key = []
+        for i, kind in self.columns:
+            if i >= len(atoms):
+                key.append(None)
+                continue
+            x = atoms[i]
+            if kind == "natural":
+                if x not in natural:
+                    natural[x] = natsort_key(x)
+                x = natural[x]
+            elif kind != "str":
+                x = number_key(x, kind)
+            key.append(x)
+        return tuple(key)
+
+
+def number_key(x, kind):
+    # non-numbers count as 0, like `sort -n`
+    try:
+        x = int(x) if kind == "int" else float(x)
+    except ValueError:
+        x = 0
+    return -x if kind == "-float" else x
+
+
+def iter_sort_chunks(fp, memory, header):
+    """
+    Cut the lines of `fp` into lists of about `memory` bytes, moving comment
+    lines into `header`.
+    """
+    chunk, size = [], 0
+    for line in fp:
+        if line[0] == "#":
+            header.append(line)
+            continue
+        if not line.endswith("\n"):
+            line += "\n"
+        chunk.append(line)
+        size += len(line)
+        if size >= memory:
+            yield chunk
+            chunk, size = [], 0
+
+    if chunk:
+        yield chunk
+
+
+def sort_run(args):
+    lines, key, runfile = args
+    lines.sort(key=key)
+    fw = open(runfile, "w")
+    fw.writelines(lines)
+    fw.close()
+    return runfile
+
+
+def iter_run(runfile, key, i):
+    for line in open(runfile):
+        yield key(line), i, line
+
+
+def merge_runs(runfiles, key):
+    """
+    Heap-merge sorted runs; on equal keys, earlier runs come first.
+    """
+    iters = [iter_run(x, key, i) for i, x in enumerate(runfiles)]
+    for k, i, line in heapq.merge(*iters):
+        yield k, line
+
+
+def external_sort(infile, outfile, key, memory=256 * 1024 ** 2, tmpdir=None,
+                  cpus=1, unique=False, maxruns=500):
+    """
+    Sort the lines of `infile` on `key` into `outfile`, which can be the same
+    file. About `memory` bytes of lines are sorted at a time, in `cpus`
+    processes in parallel; each sorted chunk is spilled to a run file in
+    `tmpdir`, and the runs are heap-merged, `maxruns` at a time. Lines
+    starting with '#' are written first. Lines with equal keys keep their
+    input order, and only the first one is kept with `unique`.
+    """
+    import shutil
+    from tempfile import mkdtemp
+
+    header = []
+    chunks = iter_sort_chunks(must_open(infile), memory, header)
+    first, second = next(chunks, []), next(chunks, None)
+    workdir = mkdtemp(dir=tmpdir)
+
+    try:
+        if second is None:  # fits in memory
+            first.sort(key=key)
+            lines = ((key(x) if unique else None, x) for x in first)
+            nruns = 1
+        else:
+            runfiles = []
+            chunks = chain([first, second], chunks)
+            pool = Pool(cpus) if cpus > 1 else None
+            while True:
+                batch = list(islice(chunks, max(cpus, 1)))
+                if not batch:
+                    break
+                tasks = [(x, key, op.join(workdir, "run{0}".\
+                                          format(len(runfiles) + i))) \
+                         for i, x in enumerate(batch)]
+                runfiles += pool.map(sort_run, tasks) if pool else \
+                            [sort_run(x) for x in tasks]
+            if pool:
+                pool.close()
+                pool.join()
+
+            nruns = len(runfiles)
+            while len(runfiles) > maxruns:
+                # merge neighboring runs, so that ties still keep input order
+                merged = []
+                for i in xrange(0, len(runfiles), maxruns):
+                    group = runfiles[i:i + maxruns]
+                    runfile = op.join(workdir, "run{0}".format(nruns))
+                    fw = open(runfile, "w")
+                    fw.writelines(line for k, line in merge_runs(group, key))
+                    fw.close()
+                    merged.append(runfile)
+                    nruns += 1
+                runfiles = merged
+            lines = merge_runs(runfiles, key)
+
+        sortedfile = op.join(workdir, "sorted") if outfile == infile \
+                     else outfile
+        fw = must_open(sortedfile, "w")
+        fw.writelines(header)
+        nlines = 0
+        previous = None
+        for k, line in lines:
+            if unique and nlines and k == previous:
+                continue
+            fw.write(line)
+            previous = k
+            nlines += 1
+        if fw not in (sys.stdout, sys.stderr):
+            fw.close()
+
+        if sortedfile != outfile:
+            shutil.move(sortedfile, outfile)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    logging.debug("Sorted {0} lines ({1} runs) into `{2}`.".\
+                    format(nlines, nruns, outfile))
+    return outfile
+
+
 def main():
 
     actions = (
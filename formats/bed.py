@@ -9,10 +9,11 @@ import math
 import logging
 import numpy as np
 
-from collections import defaultdict
-from itertools import groupby
+from collections import defaultdict, Mapping
+from itertools import groupby, islice, izip
 
-from jcvi.formats.base import LineFile, must_open, is_number, get_number
+from jcvi.formats.base import BaseFile, LineFile, must_open, is_number, \
+            get_number, SortKey, external_sort
 from jcvi.formats.sizes import Sizes
 from jcvi.utils.iter import pairwise
 from jcvi.utils.cbook import SummaryStats, thousands, percentage
@@ -91,26 +92,141 @@ class BedLine(object):
         return row
 
 
+def read_bedlines(filename, juncs=False, blocksize=100000):
+    """
+    Parse a BED file in blocks of `blocksize` lines, yielding lists of
+    BedLine. Same as calling BedLine() on every line, minus the per-line call
+    overhead; the coordinates of each block are checked in one go.
+    """
+    fp = must_open(filename)
+    new = BedLine.__new__
+    while True:
+        lines = list(islice(fp, blocksize))
+        if not lines:
+            break
+
+        block = []
+        for line in lines:
+            if line[0] == "#" or (juncs and line.startswith('track name')):
+                continue
+            args = line.strip().split("\t")
+            b = new(BedLine)
+            b.nargs = nargs = len(args)
+            b.seqid = args[0]
+            b.start = int(args[1]) + 1
+            b.end = int(args[2])
+            b.accn = args[3] if nargs > 3 else None
+            b.score = args[4] if nargs > 4 else None
+            b.strand = args[5] if nargs > 5 else None
+            b.extra = args[6:] if nargs > 6 else None
+            b.args = args
+            block.append(b)
+
+        bad = [b for b in block if b.start > b.end]
+        assert not bad, "start={0} end={1}".format(bad[0].start, bad[0].end)
+        yield block
+
+
+class BedIndex(object):
+    """
+    Per-seqid interval index over BedLines. Features on each seqid are sorted
+    by start and split into classes of length (powers of two), so that a long
+    feature never widens the search for short ones. A region query is then
+    two binary searches per class, bounded by the longest feature in the
+    class, and a vectorized filter over the candidates in between, instead
+    of a scan over every feature.
+    """
+    def __init__(self, beds):
+        groups = defaultdict(list)
+        for b in beds:
+            groups[b.seqid].append(b)
+
+        self.index = {}
+        for seqid, sbeds in groups.items():
+            sbeds.sort(key=lambda x: x.start)
+            starts = np.array([x.start for x in sbeds], dtype=np.int64)
+            ends = np.array([x.end for x in sbeds], dtype=np.int64)
+            lengths = ends - starts
+            classes = np.zeros(len(sbeds), dtype=np.int64)
+            positive = lengths > 0
+            classes[positive] = np.log2(lengths[positive]).astype(np.int64) + 1
+            bins = []
+            for c in np.unique(classes):
+                members = np.flatnonzero(classes == c)  # still sorted by start
+                bins.append((members, starts[members], ends[members],
+                             lengths[members].max()))
+            self.index[seqid] = (sbeds, starts, ends, bins)
+
+    def overlaps(self, seqid, start, end):
+        """
+        Features that overlap seqid:start-end, ordered by start.
+        """
+        if seqid not in self.index:
+            return []
+        sbeds, starts, ends, bins = self.index[seqid]
+        hits = []
+        for members, bstarts, bends, maxlength in bins:
+            # An overlapping feature starts at most `maxlength` before start
+            lo = np.searchsorted(bstarts, start - maxlength, side="left")
+            hi = np.searchsorted(bstarts, end, side="right")
+            hits.append(members[lo + np.flatnonzero(bends[lo:hi] >= start)])
+        idx = np.sort(np.concatenate(hits))
+        return [sbeds[i] for i in idx]
+
+    def contained(self, seqid, start, end):
+        """
+        Features that lie within seqid:start-end, ordered by start.
+        """
+        if seqid not in self.index:
+            return []
+        sbeds, starts, ends, bins = self.index[seqid]
+        lo = np.searchsorted(starts, start, side="left")
+        hi = np.searchsorted(starts, end, side="right")
+        idx = lo + np.flatnonzero(ends[lo:hi] <= end)
+        return [sbeds[i] for i in idx]
+
+
 class Bed(LineFile):
 
     def __init__(self, filename=None, key=None, sorted=True, juncs=False):
         super(Bed, self).__init__(filename)
+        self._index = None
 
         # the sorting key provides some flexibility in ordering the features
         # for example, user might not like the lexico-order of seqid
-        self.nullkey = lambda x: (natsort_key(x.seqid), x.start, x.accn)
+        self.seqid_keys = {}
+        self.nullkey = lambda x: (self.seqid_key(x.seqid), x.start, x.accn)
         self.key = key or self.nullkey
 
         if not filename:
             return
 
-        for line in must_open(filename):
-            if line[0] == "#" or (juncs and line.startswith('track name')):
-                continue
-            self.append(BedLine(line))
+        for block in read_bedlines(filename, juncs=juncs):
+            self.extend(block)
 
-        if sorted:
+        if not sorted:
+            return
+
+        if key:
             self.sort(key=self.key)
+        else:
+            # rank the seqids once, instead of a natsort_key per line
+            rank = self.seqid_ranks()
+            self.sort(key=lambda x: (rank[x.seqid], x.start, x.accn))
+
+    def seqid_key(self, seqid):
+        if seqid not in self.seqid_keys:
+            self.seqid_keys[seqid] = natsort_key(seqid)
+        return self.seqid_keys[seqid]
+
+    def seqid_ranks(self):
+        """
+        Integer rank of each seqid that sorts like its natsort_key, seqids
+        with identical keys sharing the same rank.
+        """
+        keys = dict((x, self.seqid_key(x)) for x in set(b.seqid for b in self))
+        ranks = dict((k, i) for i, k in enumerate(sorted(set(keys.values()))))
+        return dict((x, ranks[k]) for x, k in keys.items())
 
     def print_to_file(self, filename="stdout", sorted=False):
         if sorted:
@@ -172,15 +288,30 @@ class Bed(LineFile):
                 r.append(((a.accn, a.strand), (b.accn, b.strand)))
         return r
 
+    @property
+    def interval_index(self):
+        """
+        BedIndex built on first query, and rebuilt if features were added or
+        removed since. Call reset_index() after editing coordinates in place.
+        """
+        index = getattr(self, "_index", None)
+        if index is None or self._indexed != len(self):
+            self._index = index = BedIndex(self)
+            self._indexed = len(self)
+        return index
+
+    def reset_index(self):
+        self._index = None
+
     def extract(self, seqid, start, end):
         # get all features within certain range
-        for b in self:
-            if b.seqid != seqid:
-                continue
-            if b.start < start or b.end > end:
-                continue
+        for b in self.interval_index.contained(seqid, start, end):
             yield b
 
+    def overlaps(self, seqid, start, end):
+        # get all features overlapping certain range
+        return self.interval_index.overlaps(seqid, start, end)
+
     def sub_bed(self, seqid):
         # get all the beds on one chromosome
         for b in self:
@@ -203,6 +334,183 @@ class Bed(LineFile):
             yield seqid, ranks[0][1], ranks[-1][1]
 
 
+class ArrayBedOrder(Mapping):
+    """
+    Read-only accn => value mapping over an ArrayBed, where the value is built
+    on lookup from the position of the accn, so no BedLine is held per gene.
+    """
+    def __init__(self, bed, getter):
+        self.bed = bed
+        self.getter = getter
+
+    def __getitem__(self, accn):
+        return self.getter(self.bed.accn_index[accn])
+
+    def __iter__(self):
+        return iter(self.bed.accn_list)
+
+    def __len__(self):
+        return len(self.bed.accn_list)
+
+    def __contains__(self, accn):
+        return accn in self.bed.accn_index
+
+
+class ArrayBed(BaseFile):
+    """
+    Frozen, compact version of Bed for gene-order lookups. Features are kept
+    sorted like Bed, as NumPy arrays of seqid codes, starts, ends and strands,
+    plus tables of accns and scores; BedLines are only built when accessed.
+    `order`, `order_in_chr` and `simple_bed` are computed once. Extra columns
+    are not kept.
+
+    With `cache`, the arrays are saved to `bedfile.npz`, which is loaded
+    instead of the BED text whenever it is up to date.
+    """
+    strand_codes = ("", "+", "-", ".")
+
+    def __init__(self, filename, cache=False):
+        super(ArrayBed, self).__init__(filename)
+        cachefile = filename + ".npz"
+        if cache and op.exists(cachefile) and \
+                not need_update(filename, cachefile):
+            data = np.load(cachefile)
+            self.seqid_list = data["seqids"].tolist()
+            self.seqidx = data["seqidx"]
+            self.starts = data["starts"]
+            self.ends = data["ends"]
+            self.strands = data["strands"]
+            self.accn_list = data["accns"].tolist()
+            self.score_list = [x or None for x in data["scores"].tolist()]
+        else:
+            self.from_bed(Bed(filename))
+            if cache:
+                try:
+                    self.save(cachefile)
+                except IOError:
+                    logging.debug("Cannot write cache `{0}`.".\
+                                  format(cachefile))
+
+        self._cache = {}
+
+    def from_bed(self, bed):
+        bed.sort(key=bed.nullkey)
+        self.seqid_list = natsorted(set(b.seqid for b in bed))
+        codes = dict((x, i) for i, x in enumerate(self.seqid_list))
+        strand_codes = dict((x, i) for i, x in enumerate(self.strand_codes))
+        self.seqidx = np.array([codes[b.seqid] for b in bed], dtype=np.int32)
+        self.starts = np.array([b.start for b in bed], dtype=np.int64)
+        self.ends = np.array([b.end for b in bed], dtype=np.int64)
+        self.strands = np.array([strand_codes.get(b.strand or "", 0) \
+                                 for b in bed], dtype=np.int8)
+        self.accn_list = [b.accn for b in bed]
+        self.score_list = [b.score for b in bed]
+
+    def save(self, cachefile):
+        np.savez(cachefile, seqids=np.array(self.seqid_list),
+                 seqidx=self.seqidx, starts=self.starts, ends=self.ends,
+                 strands=self.strands, accns=np.array(self.accn_list),
+                 scores=np.array([x or "" for x in self.score_list]))
+        logging.debug("Arrays of {0} features written to `{1}`.".\
+                      format(len(self), cachefile))
+
+    def cached(self, name, func):
+        if name not in self._cache:
+            self._cache[name] = func()
+        return self._cache[name]
+
+    def __len__(self):
+        return len(self.accn_list)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[x] for x in xrange(*i.indices(len(self)))]
+
+        b = BedLine.__new__(BedLine)
+        b.seqid = self.seqid_list[self.seqidx[i]]
+        b.start = int(self.starts[i])
+        b.end = int(self.ends[i])
+        b.accn = self.accn_list[i]
+        b.strand = self.strand_codes[self.strands[i]] or None
+        b.score = self.score_list[i]
+        b.extra = None
+        b.args = [b.seqid, str(b.start - 1), str(b.end), b.accn]
+        if b.score is not None:
+            b.args += [b.score]
+            if b.strand:
+                b.args += [b.strand]
+        b.nargs = len(b.args)
+        return b
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def seqids(self):
+        present = np.unique(self.seqidx)
+        return [self.seqid_list[x] for x in present]
+
+    @property
+    def accns(self):
+        return natsorted(set(self.accn_list))
+
+    @property
+    def accn_index(self):
+        return self.cached("accn_index", lambda: \
+                dict((x, i) for i, x in enumerate(self.accn_list)))
+
+    @property
+    def runs(self):
+        # start of each run of features on the same seqid, as groupby() does
+        def get_runs():
+            if not len(self):
+                return np.zeros(0, dtype=np.int64)
+            breaks = np.flatnonzero(np.diff(self.seqidx)) + 1
+            return np.concatenate(([0], breaks)).astype(np.int64)
+
+        return self.cached("runs", get_runs)
+
+    @property
+    def chr_offsets(self):
+        # index of the first feature in the run that contains each feature
+        def get_offsets():
+            runs = self.runs
+            counts = np.diff(np.append(runs, len(self)))
+            return np.repeat(runs, counts)
+
+        return self.cached("chr_offsets", get_offsets)
+
+    @property
+    def order(self):
+        return self.cached("order", lambda: \
+                ArrayBedOrder(self, lambda i: (i, self[i])))
+
+    @property
+    def order_in_chr(self):
+        def getter(i):
+            return self.seqid_list[self.seqidx[i]], \
+                   i - int(self.chr_offsets[i]), self[i]
+
+        return self.cached("order_in_chr", lambda: ArrayBedOrder(self, getter))
+
+    @property
+    def simple_bed(self):
+        return self.cached("simple_bed", lambda: \
+                [(self.seqid_list[x], i) for i, x in \
+                 enumerate(self.seqidx.tolist())])
+
+    def sub_beds(self):
+        runs = self.runs.tolist()
+        for start, end in pairwise(runs + [len(self)]):
+            yield self.seqid_list[self.seqidx[start]], self[start:end]
+
+    def get_breaks(self):
+        for seqid, ranks in groupby(self.simple_bed, key=lambda x: x[0]):
+            ranks = list(ranks)
+            yield seqid, ranks[0][1], ranks[-1][1]
+
+
 class BedpeLine(object):
 
     def __init__(self, sline):
@@ -365,6 +673,74 @@ def bed_sum(beds, seqid=None, unique=True):
     return unique_sum if unique else raw_sum
 
 
+def benchmark_load(bedfile, juncs=False):
+    """
+    Time the block loader of Bed against parsing with BedLine() line by line
+    and sorting on natsort_key, and report throughput in lines/sec.
+    """
+    import time
+
+    start = time.time()
+    bed = []
+    for line in must_open(bedfile):
+        if line[0] == "#" or (juncs and line.startswith('track name')):
+            continue
+        bed.append(BedLine(line))
+    bed.sort(key=lambda x: (natsort_key(x.seqid), x.start, x.accn))
+    old = time.time() - start
+
+    start = time.time()
+    newbed = Bed(bedfile, juncs=juncs)
+    new = time.time() - start
+
+    assert [x.accn for x in bed] == [x.accn for x in newbed]
+    nlines = len(newbed)
+    for tag, elapsed in (("BedLine", old), ("Bed", new)):
+        print >> sys.stderr, "{0}: {1} lines in {2:.1f}s ({3:.0f} lines/sec)".\
+                format(tag, nlines, elapsed, nlines / max(elapsed, 1e-6))
+
+
+def benchmark_overlaps(nfeatures=1000000, nqueries=100000, nseqids=10,
+                       seqsize=100000000, seed=666):
+    """
+    Time overlap queries through BedIndex against a linear scan over a random
+    Bed. The linear scan runs on the first 100 queries and is extrapolated.
+    """
+    import random
+    import time
+
+    random.seed(seed)
+    bed = Bed()
+    for i in xrange(nfeatures):
+        start = random.randrange(seqsize)
+        bed.append(BedLine("chr{0}\t{1}\t{2}\tf{3}".format(\
+                random.randrange(nseqids), start,
+                start + random.randint(100, 5000), i)))
+    queries = []
+    for i in xrange(nqueries):
+        start = random.randrange(seqsize)
+        queries.append(("chr{0}".format(random.randrange(nseqids)),
+                        start, start + random.randint(100, 20000)))
+
+    start = time.time()
+    index = bed.interval_index
+    built = time.time()
+    nhits = sum(len(index.overlaps(*q)) for q in queries)
+    done = time.time()
+    print >> sys.stderr, "BedIndex: built in {0:.1f}s, {1} queries "\
+            "({2} hits) in {3:.1f}s".format(built - start, nqueries, nhits,
+                                           done - built)
+
+    nlinear = min(100, nqueries)
+    start = time.time()
+    for seqid, qstart, qend in queries[:nlinear]:
+        [b for b in bed if b.seqid == seqid and \
+                b.start <= qend and b.end >= qstart]
+    elapsed = (time.time() - start) * nqueries / nlinear
+    print >> sys.stderr, "Linear scan: {0} queries in {1:.1f}s (estimated)".\
+            format(nqueries, elapsed)
+
+
 def main():
 
     actions = (
@@ -1010,26 +1386,156 @@ def uniq(args):
     return uniqbedfile
 
 
-def subtractbins(binfile1, binfile2):
-    from jcvi.graphics.landscape import BinFile
+def bed_intervals(bedfile, scores=False):
+    """
+    Read features per seqid as 0-based, half-open NumPy arrays of starts and
+    ends (and scores if asked for, missing scores are 0), sorted by start.
+    """
+    data = defaultdict(list)
+    for block in read_bedlines(bedfile):
+        for b in block:
+            score = float(b.score) if scores and b.score and \
+                                      is_number(b.score) else 0
+            data[b.seqid].append((b.start - 1, b.end, score))
+
+    intervals = {}
+    for seqid, rows in data.iteritems():
+        a = np.array(rows, dtype=np.float64) if scores else \
+            np.array(rows, dtype=np.int64)
+        order = np.argsort(a[:, 0], kind="mergesort")
+        a = a[order]
+        starts, ends = a[:, 0].astype(np.int64), a[:, 1].astype(np.int64)
+        intervals[seqid] = (starts, ends, a[:, 2].astype(np.float64))
+    return intervals
+
+
+def merge_intervals(starts, ends, scores=None):
+    """
+    Merge overlapping or book-ended intervals (sorted by start), like
+    mergeBed. The scores of merged intervals are replaced by their median.
+
+    >>> merge_intervals(np.array([0, 5, 10]), np.array([5, 8, 12]))[:2]
+    (array([ 0, 10]), array([ 8, 12]))
+    """
+    if not len(starts):
+        return starts, ends, scores
+
+    maxends = np.maximum.accumulate(ends)
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = starts[1:] > maxends[:-1]
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(starts)) - 1
+    mstarts, mends = starts[first], maxends[last]
+    if scores is None:
+        return mstarts, mends, None
+
+    groups = np.cumsum(new) - 1
+    sscores = scores[np.lexsort((scores, groups))]
+    n = last - first + 1
+    median = (sscores[first + (n - 1) / 2] + sscores[first + n / 2]) / 2
+    return mstarts, mends, median
+
+
+def subtract_intervals(starts, ends, scores, sstarts, sends):
+    """
+    Remove the bases in the second set of intervals from the first, like
+    intersecting with the complement of the second. Both sets must be merged.
+    Pieces of the same interval keep its score.
 
-    abin = BinFile(binfile1)
-    bbin = BinFile(binfile2)
+    >>> subtract_intervals(np.array([0]), np.array([10]), np.array([1.]),
+    ...                    np.array([3]), np.array([5]))[:2]
+    (array([0, 5]), array([ 3, 10]))
+    """
+    if not len(starts) or not len(sstarts):
+        return starts, ends, scores
 
-    assert len(abin) == len(bbin)
+    bounds = np.unique(np.concatenate((starts, ends, sstarts, sends)))
+    left, right = bounds[:-1], bounds[1:]
+    i = np.searchsorted(starts, left, side="right") - 1
+    inside = (i >= 0) & (left < ends[np.maximum(i, 0)])
+    j = np.searchsorted(sstarts, left, side="right") - 1
+    inside &= ~((j >= 0) & (left < sends[np.maximum(j, 0)]))
 
-    fw = open(binfile1, "w")
+    # Kept segments are contiguous within one interval, join them into pieces
+    d = np.diff(np.concatenate(([0], inside.view(np.int8), [0])))
+    first, last = np.flatnonzero(d == 1), np.flatnonzero(d == -1) - 1
+    pstarts, pends = left[first], right[last]
+    pscores = scores[i[first]] if scores is not None else None
+    return pstarts, pends, pscores
 
-    for a, b in zip(abin, bbin):
-        assert a.chr == b.chr
-        assert a.binlen == b.binlen
 
-        a.subtract(b)
-        print >> fw, a
+def covered_bases(starts, ends, positions):
+    """
+    Number of bases in [0, position) covered by the merged intervals.
+    """
+    cumlen = np.zeros(len(starts) + 1, dtype=np.int64)
+    np.cumsum(ends - starts, out=cumlen[1:])
+    i = np.searchsorted(starts, positions, side="right")
+    last = np.maximum(i - 1, 0)
+    partial = np.clip(positions - starts[last], 0, ends[last] - starts[last])
+    return cumlen[np.maximum(i - 1, 0)] + np.where(i > 0, partial, 0)
 
-    fw.close()
 
-    return binfile1
+def bin_intervals(starts, ends, scores, chr_len, binsize):
+    """
+    Accumulate merged intervals into consecutive bins of `binsize`, the last
+    bin takes the remainder. Returns the layers span (bases covered), count
+    (intervals touching the bin) and score (sum of scores of those
+    intervals), plus bases (length of each bin).
+    """
+    nbins = chr_len / binsize
+    if chr_len % binsize:
+        nbins += 1
+
+    bounds = np.minimum(np.arange(nbins + 1, dtype=np.int64) * binsize,
+                        chr_len)
+    bases = np.diff(bounds)
+    ends = np.minimum(ends, chr_len)
+    keep = starts < ends
+    starts, ends = starts[keep], ends[keep]
+    if not len(starts):
+        zeros = np.zeros(nbins, dtype=np.int64)
+        return zeros, zeros.copy(), np.zeros(nbins), bases
+
+    span = np.diff(covered_bases(starts, ends, bounds))
+
+    firstbin = starts / binsize
+    lastbin = (ends - 1) / binsize + 1
+    count = np.cumsum(np.bincount(firstbin, minlength=nbins + 1) -
+                      np.bincount(lastbin, minlength=nbins + 1))[:nbins]
+    score = np.zeros(nbins)
+    if scores is not None:
+        scores = scores[keep]
+        score = np.cumsum(np.bincount(firstbin, weights=scores,
+                                      minlength=nbins + 1) -
+                          np.bincount(lastbin, weights=scores,
+                                      minlength=nbins + 1))[:nbins]
+    return span, count, score, bases
+
+
+class BinArray(BaseFile):
+    """
+    Binned features across all chromosomes, as written by `bed bins`. Each
+    layer (span, count, score, bases) is one array with the bins of all
+    chromosomes concatenated, `offsets` locate each chromosome.
+    """
+    layers = ("span", "count", "score", "bases")
+
+    def __init__(self, filename):
+        super(BinArray, self).__init__(filename)
+        data = np.load(filename)
+        self.binsize = int(data["binsize"])
+        self.seqids = data["seqids"].tolist()
+        self.offsets = data["offsets"]
+        self.data = dict((x, data[x]) for x in self.layers)
+        self.index = dict((x, i) for i, x in enumerate(self.seqids))
+
+    def __len__(self):
+        return len(self.seqids)
+
+    def get(self, seqid, layer="span"):
+        i = self.index[seqid]
+        return self.data[layer][self.offsets[i]:self.offsets[i + 1]]
 
 
 def bins(args):
@@ -1038,6 +1544,11 @@ def bins(args):
 
     Bin bed lengths into each consecutive window. Use --subtract to remove bases
     from window, e.g. --subtract gaps.bed ignores the gap sequences.
+
+    Features are merged first. Bins are written to a NumPy .npz file that has
+    all layers: span (bases covered), count (features touching the bin),
+    score (sum of median scores of merged features) and bases (bin size minus
+    subtracted bases).
     """
     from jcvi.formats.sizes import Sizes
 
@@ -1046,8 +1557,6 @@ def bins(args):
                  help="Size of the bins [default: %default]")
     p.add_option("--subtract",
                  help="Subtract bases from window [default: %default]")
-    p.add_option("--mode", default="span", choices=("span", "count", "score"),
-                 help="Accumulate feature based on [default: %default]")
     opts, args = p.parse_args(args)
 
     if len(args) != 2:
@@ -1055,80 +1564,51 @@ def bins(args):
 
     bedfile, fastafile = args
     subtract = opts.subtract
-    mode = opts.mode
     assert op.exists(bedfile), "File `{0}` not found".format(bedfile)
 
     binsize = opts.binsize
     binfile = bedfile + ".{0}".format(binsize)
-    binfile += ".{0}.bins".format(mode)
-
-    if not need_update(bedfile, binfile):
-        return binfile
-
-    sz = Sizes(fastafile)
-    sizesfile = sz.filename
-    sizes = sz.mapping
-    fw = open(binfile, "w")
-    scores = "median" if mode == "score" else None
-    bedfile = mergeBed(bedfile, nms=True, scores=scores)
     if subtract:
-        subtractmerge = mergeBed(subtract)
-        subtract_complement = complementBed(subtractmerge, sizesfile)
-        bedfile = intersectBed(bedfile, subtract_complement)
-
-    bedfile = sort([bedfile, "-i"])
+        binfile += ".{0}".format(op.basename(subtract).rsplit(".", 1)[0])
+    binfile += ".bins.npz"
 
-    bed = Bed(bedfile)
-    sbdict = dict(bed.sub_beds())
-    for chr, chr_len in sorted(sizes.items()):
-        chr_len = sizes[chr]
-        subbeds = sbdict.get(chr, [])
-        nbins = chr_len / binsize
-        last_bin = chr_len % binsize
-        if last_bin:
-            nbins += 1
-
-        a = np.zeros(nbins)  # values
-        b = np.zeros(nbins, dtype="int")  # bases
-        c = np.zeros(nbins, dtype="int")  # count
-        b[:-1] = binsize
-        b[-1] = last_bin
-
-        for bb in subbeds:
-
-            start, end = bb.start, bb.end
-            startbin = start / binsize
-            endbin = end / binsize
-
-            assert startbin <= endbin
-            c[startbin:endbin + 1] += 1
-
-            if mode == "score":
-                a[startbin:endbin + 1] += float(bb.score)
-
-            elif mode == "span":
-                if startbin == endbin:
-                    a[startbin] += end - start + 1
-
-                if startbin < endbin:
-                    firstsize = (startbin + 1) * binsize - start + 1
-                    lastsize = end - endbin * binsize
-                    a[startbin] += firstsize
-                    if startbin + 1 < endbin:
-                        a[startbin + 1:endbin] += binsize
-                    a[endbin] += lastsize
-
-        if mode == "count":
-            a = c
-
-        for xa, xb in zip(a, b):
-            print >> fw, "\t".join(str(x) for x in (chr, xa, xb))
-
-    fw.close()
+    if not need_update([bedfile, subtract] if subtract else bedfile, binfile):
+        return binfile
 
-    if subtract:
-        subtractbinfile = bins([subtract, fastafile, "--binsize={0}".format(binsize)])
-        binfile = subtractbins(binfile, subtractbinfile)
+    sizes = Sizes(fastafile).mapping
+    intervals = bed_intervals(bedfile, scores=True)
+    subtracts = bed_intervals(subtract) if subtract else {}
+
+    seqids = sorted(sizes.keys())
+    layers = dict((x, []) for x in BinArray.layers)
+    offsets = [0]
+    empty = np.zeros(0, dtype=np.int64)
+    for seqid in seqids:
+        starts, ends, scores = intervals.get(seqid, (empty, empty, empty))
+        starts, ends, scores = merge_intervals(starts, ends, scores)
+        sstarts, sends, sscores = subtracts.get(seqid, (empty, empty, None))
+        sstarts, sends, sscores = merge_intervals(sstarts, sends)
+        starts, ends, scores = subtract_intervals(starts, ends, scores,
+                                                  sstarts, sends)
+
+        chr_len = sizes[seqid]
+        span, count, score, bases = bin_intervals(starts, ends, scores,
+                                                  chr_len, binsize)
+        if len(sstarts):
+            sspan = bin_intervals(sstarts, sends, None, chr_len, binsize)[0]
+            bases = bases - sspan
+
+        for name, a in zip(BinArray.layers, (span, count, score, bases)):
+            layers[name].append(a)
+        offsets.append(offsets[-1] + len(span))
+
+    for name in BinArray.layers:
+        layers[name] = np.concatenate(layers[name]) if seqids else empty
+
+    np.savez(binfile, seqids=np.array(seqids), offsets=np.array(offsets),
+             binsize=binsize, **layers)
+    logging.debug("Bins of {0} seqids written to `{1}`.".\
+                    format(len(seqids), binfile))
 
     return binfile
 
@@ -1214,13 +1694,172 @@ def fastaFromBed(bedfile, fastafile, name=False, tab=False, stranded=False):
     if stranded:
         cmd += " -s"
 
-    if need_update([bedfile, fastafile], outfile):
+    if not need_update([bedfile, fastafile], outfile):
+        return outfile
+
+    from jcvi.formats.fasta import Fasta, is_indexable
+
+    if use_bedtools(bedfile) or not is_indexable(fastafile):
         sh(cmd, outfile=outfile)
+        return outfile
+
+    f = Fasta(fastafile, faidx=True)
+    bed = []
+    for b in Bed(bedfile, sorted=False):
+        if b.seqid not in f:
+            logging.error("Chromosome `{0}` not found in `{1}`. Skipped.".\
+                            format(b.seqid, fastafile))
+            continue
+        bed.append(b)
+
+    features = [dict(chr=b.seqid, start=b.start, stop=b.end,
+                     strand=b.strand if stranded else None) for b in bed]
+    fw = open(outfile, "w")
+    for b, seq in izip(bed, f.batch_sequences(features)):
+        header = b.accn if name else \
+                 "{0}:{1}-{2}".format(b.seqid, b.start - 1, b.end)
+        if tab:
+            print >> fw, "\t".join((header, seq))
+        else:
+            print >> fw, ">" + header
+            print >> fw, seq
+    fw.close()
+    logging.debug("A total of {0} sequences written to `{1}`.".\
+                    format(len(bed), outfile))
 
     return outfile
 
 
+# Inputs larger than this (in bytes) are handed to BEDTools instead of being
+# loaded as Bed objects
+BEDTOOLS_MINSIZE = 500 * 1024 ** 2
+
+
+def use_bedtools(*bedfiles):
+    return any(not op.isfile(x) or op.getsize(x) > BEDTOOLS_MINSIZE \
+               for x in bedfiles)
+
+
+def aggregate_scores(values, scores="mean"):
+    from collections import Counter
+
+    if scores == "collapse":
+        return ",".join(values)
+
+    values = [float(x) for x in values]
+    if scores in ("mode", "antimode"):
+        counts = Counter(values).most_common()
+        return counts[0][0] if scores == "mode" else counts[-1][0]
+
+    agg = {"sum": np.sum, "min": np.min, "max": np.max,
+           "median": np.median}.get(scores, np.mean)
+    return agg(values)
+
+
+def merge_bed(bed, d=0, nms=False, s=False, scores=None, delim=";"):
+    """
+    In-process equivalent of `mergeBed`: features on the same seqid (and
+    strand if `s`) that overlap, touch or are within `d` bp are merged.
+    Returns a new Bed.
+    """
+    if nms and bed and bed[0].nargs <= 3:
+        logging.debug("Only {0} columns detected... set nms=True"\
+                        .format(bed[0].nargs))
+        nms = False
+
+    groups = defaultdict(list)
+    for b in bed:
+        groups[(b.seqid, b.strand) if s else (b.seqid, None)].append(b)
+
+    merged = Bed()
+    for seqid, strand in sorted(groups.keys(),
+                                key=lambda x: (natsort_key(x[0]), x[1])):
+        beds = groups[(seqid, strand)]
+        beds.sort(key=lambda x: x.start)
+        starts = np.array([x.start - 1 for x in beds], dtype=np.int64)
+        ends = np.array([x.end for x in beds], dtype=np.int64)
+        # A new merged feature starts wherever there is a gap larger than d
+        breaks = np.ones(len(beds), dtype=bool)
+        breaks[1:] = starts[1:] > np.maximum.accumulate(ends)[:-1] + d
+        firsts = np.flatnonzero(breaks)
+        lasts = np.append(firsts[1:], len(beds))
+        mends = np.maximum.reduceat(ends, firsts)
+
+        for first, last, mend in zip(firsts, lasts, mends):
+            atoms = [seqid, starts[first], mend]
+            if nms:
+                atoms.append(delim.join(x.accn for x in beds[first:last]))
+            if scores:
+                atoms.append(aggregate_scores([x.score for x in \
+                             beds[first:last]], scores=scores))
+            if s:
+                atoms.append(strand)
+            merged.append(BedLine("\t".join(str(x) for x in atoms)))
+
+    return merged
+
+
+def complement_bed(bed, sizes):
+    """
+    In-process equivalent of `complementBed`: regions of each sequence in
+    `sizes` (a Sizes object) not covered by any feature. Returns a new Bed.
+    """
+    merged = defaultdict(list)
+    for b in merge_bed(bed):
+        merged[b.seqid].append((b.start - 1, b.end))
+
+    complement = Bed()
+    for seqid, size in zip(sizes.ctgs, sizes.sizes):
+        ends = [0] + [x for r in merged[seqid] for x in r] + [size]
+        for start, end in zip(ends[::2], ends[1::2]):
+            if start < end:
+                complement.append(BedLine("\t".join(str(x) for x in \
+                                  (seqid, start, end))))
+
+    return complement
+
+
+def intersect_bed_wao(abed, bbed, minOverlap=0):
+    """
+    In-process equivalent of `intersectBed -wao`: yields every overlapping
+    pair of features (a, b), or (a, None) when `a` overlaps nothing. Each `a`
+    is a fresh copy so that callers can modify it.
+    """
+    for a in abed:
+        bs = bbed.overlaps(a.seqid, a.start, a.end)
+        if not bs:
+            if minOverlap <= 0:
+                yield BedLine(str(a)), None
+            continue
+        for b in bs:
+            c = min(a.end, b.end) - max(a.start, b.start) + 1
+            if c < minOverlap:
+                continue
+            yield BedLine(str(a)), b
+
+
+def intersect_bed(abed, bbed):
+    """
+    In-process equivalent of `intersectBed`: features in `abed` clipped to
+    each overlap with `bbed`. Returns a new Bed.
+    """
+    intersected = Bed()
+    for a, b in intersect_bed_wao(abed, bbed, minOverlap=1):
+        a.start, a.end = max(a.start, b.start), min(a.end, b.end)
+        intersected.append(a)
+
+    return intersected
+
+
 def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=";"):
+    if not use_bedtools(bedfile):
+        mergebedfile = op.basename(bedfile).rsplit(".", 1)[0] + ".merge.bed"
+        if need_update(bedfile, mergebedfile):
+            merged = merge_bed(Bed(bedfile), d=d, nms=nms, s=s,
+                               scores=scores, delim=delim)
+            merged.print_to_file(mergebedfile)
+        return mergebedfile
+
     if not sorted:
         bedfile = sort([bedfile, "-i"])
     cmd = "mergeBed -i {0}".format(bedfile)
@@ -1252,25 +1891,36 @@ def mergeBed(bedfile, d=0, sorted=False, nms=False, s=False, scores=None, delim=
 
 
 def complementBed(bedfile, sizesfile):
-    cmd = "complementBed"
-    cmd += " -i {0} -g {1}".format(bedfile, sizesfile)
     complementbedfile = "complement_" + op.basename(bedfile)
+    if not need_update([bedfile, sizesfile], complementbedfile):
+        return complementbedfile
 
-    if need_update([bedfile, sizesfile], complementbedfile):
-        sh(cmd, outfile=complementbedfile)
+    if not use_bedtools(bedfile):
+        complement = complement_bed(Bed(bedfile), Sizes(sizesfile))
+        complement.print_to_file(complementbedfile)
+        return complementbedfile
+
+    cmd = "complementBed"
+    cmd += " -i {0} -g {1}".format(bedfile, sizesfile)
+    sh(cmd, outfile=complementbedfile)
     return complementbedfile
 
 
 def intersectBed(bedfile1, bedfile2):
-    cmd = "intersectBed"
-    cmd += " -a {0} -b {1}".format(bedfile1, bedfile2)
     suffix = ".intersect.bed"
-
     intersectbedfile = ".".join((op.basename(bedfile1).split(".")[0],
             op.basename(bedfile2).split(".")[0])) + suffix
+    if not need_update([bedfile1, bedfile2], intersectbedfile):
+        return intersectbedfile
+
+    if not use_bedtools(bedfile1, bedfile2):
+        intersected = intersect_bed(Bed(bedfile1), Bed(bedfile2))
+        intersected.print_to_file(intersectbedfile)
+        return intersectbedfile
 
-    if need_update([bedfile1, bedfile2], intersectbedfile):
-        sh(cmd, outfile=intersectbedfile)
+    cmd = "intersectBed"
+    cmd += " -a {0} -b {1}".format(bedfile1, bedfile2)
+    sh(cmd, outfile=intersectbedfile)
     return intersectbedfile
 
 
@@ -1354,6 +2004,11 @@ def intersectBed_wao(abedfile, bbedfile, minOverlap=0):
     print >> sys.stderr, "`{0}` has {1} features.".format(abedfile, len(abed))
     print >> sys.stderr, "`{0}` has {1} features.".format(bbedfile, len(bbed))
 
+    if not use_bedtools(abedfile, bbedfile):
+        for a, b in intersect_bed_wao(abed, bbed, minOverlap=minOverlap):
+            yield a, b
+        return
+
     cmd = "intersectBed -wao -a {0} -b {1}".format(abedfile, bbedfile)
     acols = abed[0].nargs
     bcols = bbed[0].nargs
@@ -1779,8 +2434,8 @@ def sort(args):
     """
     %prog sort bedfile
 
-    Sort bed file to have ascending order of seqid, then start. It uses the
-    `sort` command.
+    Sort bed file to have ascending order of seqid, then start, the same order
+    as Bed. Large files are sorted in chunks that are merged on disk.
     """
     p = OptionParser(sort.__doc__)
     p.add_option("-i", "--inplace", dest="inplace",
@@ -1792,7 +2447,7 @@ def sort(args):
     p.add_option("--accn", default=False, action="store_true",
             help="Sort based on the accessions [default: %default]")
     p.set_outfile(outfile=None)
-    p.set_tmpdir()
+    p.set_sort()
     opts, args = p.parse_args(args)
 
     if len(args) != 1:
@@ -1807,15 +2462,13 @@ def sort(args):
     elif opts.outfile is None:
         sortedbed = op.basename(bedfile).rsplit(".", 1)[0] + ".sorted.bed"
 
-    sortopt = "-k1,1 -k2,2n -k4,4" if not opts.accn else \
-              "-k4,4 -k1,1 -k2,2n"
-    cmd = "sort"
-    if opts.tmpdir:
-        cmd += " -T {0}".format(opts.tmpdir)
-    if opts.unique:
-        cmd += " -u"
-    cmd += " {0} {1} -o {2}".format(sortopt, bedfile, sortedbed)
-    sh(cmd)
+    # same as Bed.nullkey: seqid in natural order, start, accn
+    columns = [(0, "natural"), (1, "int"), (3, "str")]
+    if opts.accn:
+        columns = columns[2:] + columns[:2]
+    external_sort(bedfile, sortedbed, SortKey(columns),
+                  memory=opts.memory * 1024 ** 2, tmpdir=opts.tmpdir,
+                  cpus=opts.cpus, unique=opts.unique)
 
     return sortedbed
 
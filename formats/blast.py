@@ -4,19 +4,24 @@ parses tabular BLAST -m8 (-format 6 in BLAST+) format
 
 import os.path as op
 import sys
+import time
 import logging
 
-from itertools import groupby
+import numpy as np
+
+from itertools import groupby, izip
 from collections import defaultdict
 
-from jcvi.formats.base import LineFile, BaseFile, must_open
+from jcvi.formats.base import LineFile, BaseFile, must_open, SortKey, \
+            external_sort
 from jcvi.formats.bed import Bed
 from jcvi.formats.coords import print_stats
 from jcvi.formats.sizes import Sizes
 from jcvi.utils.grouper import Grouper
 from jcvi.utils.orderedcollections import OrderedDict
 from jcvi.utils.range import range_distance
-from jcvi.apps.base import OptionParser, ActionDispatcher, sh, popen
+from jcvi.apps.base import OptionParser, ActionDispatcher, popen, \
+            need_update, mkdir
 
 
 class BlastLine(object):
@@ -45,6 +50,32 @@ class BlastLine(object):
         else:
             self.orientation = '+'
 
+    @classmethod
+    def from_columns(cls, query, subject, pctid, hitlen, nmismatch, ngaps,
+                     qstart, qstop, sstart, sstop, evalue, score):
+        """
+        Build a BlastLine from already typed values of the 12 -m8 columns.
+        """
+        self = cls.__new__(cls)
+        self.query = query
+        self.subject = subject
+        self.pctid = pctid
+        self.hitlen = hitlen
+        self.nmismatch = nmismatch
+        self.ngaps = ngaps
+        self.qstart = qstart
+        self.qstop = qstop
+        self.evalue = evalue
+        self.score = score
+
+        if sstart > sstop:
+            self.sstart, self.sstop = sstop, sstart
+            self.orientation = '-'
+        else:
+            self.sstart, self.sstop = sstart, sstop
+            self.orientation = '+'
+        return self
+
     def __repr__(self):
         return "BlastLine('%s' to '%s', eval=%.3f, score=%.1f)" % \
                 (self.query, self.subject, self.evalue, self.score)
@@ -75,15 +106,111 @@ class BlastLine(object):
                  self.score, self.orientation))
 
 
+class BlastIndex (BaseFile):
+    """
+    Columnar binary sidecar of a tabular BLAST file, written by `blast index`
+    next to the text file as directory `blastfile.idx/`, with one `.npy` per
+    column. Query and subject names are interned into `ids.npy`, which is the
+    only table read into memory; the other columns are memory-mapped, and
+    BlastLine members are only built when iterated.
+    """
+    columns = BlastLine.__slots__[:12]
+    dtypes = ("i4", "i4", "f8", "i4", "i4", "i4",
+              "i8", "i8", "i8", "i8", "f8", "f8")
+    typecodes = ("l", "l", "d", "l", "l", "l",
+                 "l", "l", "l", "l", "d", "d")
+
+    def __init__(self, filename):
+        super(BlastIndex, self).__init__(filename)
+        self.ids = np.load(op.join(filename, "ids.npy")).tolist()
+        self.arrays = [np.load(op.join(filename, x + ".npy"), mmap_mode="r") \
+                       for x in self.columns]
+        self.nrows = len(self.arrays[0])
+
+    def __len__(self):
+        return self.nrows
+
+    def __iter__(self, chunksize=100000):
+        ids = self.ids
+        columns = self.arrays
+        for i in xrange(0, self.nrows, chunksize):
+            chunk = [x[i:i + chunksize].tolist() for x in columns]
+            for row in izip(*chunk):
+                yield BlastLine.from_columns(ids[row[0]], ids[row[1]],
+                                             *row[2:])
+
+    @classmethod
+    def build(cls, blastfile, indexfile=None):
+        """
+        Parse `blastfile` once and write its columnar sidecar.
+        """
+        from array import array
+
+        indexfile = indexfile or get_index_name(blastfile)
+        ids, names = {}, []
+        columns = [array(x) for x in cls.typecodes]
+        nlines = 0
+        for row in must_open(blastfile):
+            if row[0] == '#' or not row.strip():
+                continue
+            atoms = row.split("\t")
+            for i in (0, 1):
+                name = atoms[i]
+                idx = ids.get(name)
+                if idx is None:
+                    idx = ids[name] = len(names)
+                    names.append(name)
+                columns[i].append(idx)
+            for i in xrange(2, 12):
+                c = columns[i]
+                c.append(float(atoms[i]) if c.typecode == "d" \
+                         else int(atoms[i]))
+            nlines += 1
+
+        # ids.npy goes last, so that an interrupted build stays outdated
+        mkdir(indexfile)
+        for i, (name, dtype) in enumerate(zip(cls.columns, cls.dtypes)):
+            np.save(op.join(indexfile, name + ".npy"),
+                    np.array(columns[i], dtype=dtype))
+            columns[i] = None
+        np.save(op.join(indexfile, "ids.npy"), np.array(names))
+        logging.debug("Index of {0} BLAST lines ({1} ids) written to `{2}`.".\
+                      format(nlines, len(names), indexfile))
+        return indexfile
+
+
+def get_index_name(blastfile):
+    return blastfile + ".idx"
+
+
+def load_index(blastfile):
+    """
+    Returns the BlastIndex of `blastfile` if its sidecar exists and is not
+    older than the text file, otherwise None.
+    """
+    indexfile = get_index_name(blastfile)
+    idsfile = op.join(indexfile, "ids.npy")
+    if not (op.isfile(blastfile) and op.exists(idsfile)):
+        return None
+    if need_update(blastfile, idsfile):
+        logging.debug("Index `{0}` is outdated, ignored.".format(indexfile))
+        return None
+    return BlastIndex(indexfile)
+
+
 class BlastSlow (LineFile):
     """
     Load entire blastfile into memory
     """
     def __init__(self, filename, sorted=False):
         super(BlastSlow, self).__init__(filename)
-        fp = must_open(filename)
-        for row in fp:
-            self.append(BlastLine(row))
+        index = load_index(filename)
+        if index is not None:
+            self.extend(index)
+        else:
+            fp = must_open(filename)
+            for row in fp:
+                self.append(BlastLine(row))
         self.sorted = sorted
         if not sorted:
             self.sort(key=lambda x: x.query)
@@ -121,16 +248,21 @@ class Blast (BaseFile):
     def __init__(self, filename):
         super(Blast, self).__init__(filename)
         self.fp = must_open(filename)
+        self.index = load_index(filename)
 
     def __iter__(self):
+        if self.index is not None:
+            for b in self.index:
+                yield b
+            return
+
         self.fp.seek(0)
         for row in self.fp:
             yield BlastLine(row)
 
     def iter_hits(self):
-        for query, blines in groupby(self.fp,
-                key=lambda x: BlastLine(x).query):
-            blines = [BlastLine(x) for x in blines]
+        for query, blines in groupby(self, key=lambda x: x.query):
+            blines = list(blines)
             blines.sort(key=lambda x: -x.score)  # descending score
             yield query, blines
 
@@ -142,9 +274,8 @@ class Blast (BaseFile):
         else:
             sys.exit("`ref` must be either `query` or `subject`.")
 
-        for bref, blines in groupby(self.fp,
-                key=lambda x: getattr(BlastLine(x), ref)):
-            blines = [BlastLine(x) for x in blines]
+        for bref, blines in groupby(self, key=lambda x: getattr(x, ref)):
+            blines = list(blines)
             blines.sort(key=lambda x: -x.score)
             counter = 0
             selected = set()
@@ -172,9 +303,142 @@ class Blast (BaseFile):
     @property
     def best_hits(self):
         """
-        returns a dict with query => best blasthit
+        returns a dict with query => best blasthit, input need not be sorted
         """
-        return dict(self.iter_best_hit())
+        return dict(iter_best_hits(self))
+
+
+def iter_best_hits(blasts, N=1, hsps=False, ref="query",
+                   maxrecords=5000000, tmpdir=None, depth=0):
+    """
+    Single-pass version of Blast.iter_best_hit() that does not require the
+    input to be grouped or sorted. Each `ref` keeps a bounded min-heap of its
+    top N lines by score (with --hsps, all lines of its hits are kept), so
+    running time is O(N log K). When more than `maxrecords` lines are held,
+    the retained lines and the rest of the input are spilled to disk in hash
+    partitions of `ref`, which are then processed one at a time.
+
+    Yields (ref, BlastLine) with refs in sorted order and hits by descending
+    score; ties are broken by input order.
+    """
+    from heapq import heappush, heappushpop
+
+    if ref == "query":
+        ref, hit = "query", "subject"
+    elif ref == "subject":
+        ref, hit = "subject", "query"
+    else:
+        sys.exit("`ref` must be either `query` or `subject`.")
+
+    start = time.time()
+    store = {}
+    nrecords = 0
+    nlines = [0]
+
+    def counted(blasts):
+        for b in blasts:
+            nlines[0] += 1
+            yield b
+
+    blasts = counted(blasts)
+    for b in blasts:
+        bref = getattr(b, ref)
+        item = (b.score, -nlines[0], b)
+        if hsps:
+            hits = store.setdefault(bref, {})
+            hits.setdefault(getattr(b, hit), []).append(item)
+            nrecords += 1
+        else:
+            heap = store.setdefault(bref, [])
+            if len(heap) < N:
+                heappush(heap, item)
+                nrecords += 1
+            elif item > heap[0]:
+                heappushpop(heap, item)
+
+        if nrecords > maxrecords and depth < 3:
+            break
+    else:
+        blasts = None
+
+    if blasts is not None:
+        # Memory ceiling reached, partition by `ref` on disk
+        for bref, b in spill_best_hits(store, blasts, N, hsps, ref,
+                                       maxrecords, tmpdir, depth):
+            yield bref, b
+    else:
+        for bref in sorted(store.keys()):
+            if hsps:
+                hits = store[bref].values()
+                hits.sort(key=max, reverse=True)
+                items = sorted((x for h in hits[:N] for x in h), reverse=True)
+            else:
+                items = sorted(store[bref], reverse=True)
+            for score, order, b in items:
+                yield bref, b
+
+    if depth == 0:
+        elapsed = max(time.time() - start, 1e-6)
+        logging.debug("Processed {0} BLAST lines in {1:.1f}s ({2:.0f} lines/sec).".\
+                      format(nlines[0], elapsed, nlines[0] / elapsed))
+
+
+def spill_best_hits(store, blasts, N, hsps, ref, maxrecords, tmpdir, depth,
+                    npartitions=16):
+    """
+    Write the lines retained in `store` and the remaining `blasts` into
+    `npartitions` temporary files by hash of `ref`, run iter_best_hits() on
+    each in turn and merge the results back into `ref` order.
+    """
+    import shutil
+    from heapq import merge
+    from tempfile import mkdtemp
+
+    workdir = mkdtemp(dir=tmpdir)
+    try:
+        filenames = [op.join(workdir, "part{0}.blast".format(i)) \
+                     for i in xrange(npartitions)]
+        fws = [open(x, "w") for x in filenames]
+        partition = lambda x: hash((x, depth)) % npartitions
+
+        for bref, items in store.iteritems():
+            if hsps:
+                items = [x for h in items.values() for x in h]
+            fw = fws[partition(bref)]
+            for score, order, b in sorted(items, key=lambda x: -x[1]):
+                print >> fw, b
+        store.clear()
+
+        nlines = 0
+        for b in blasts:
+            print >> fws[partition(getattr(b, ref))], b
+            nlines += 1
+        for fw in fws:
+            fw.close()
+        logging.debug("Spilled {0} BLAST lines into {1} partitions in `{2}`.".\
+                      format(nlines, npartitions, workdir))
+
+        # Reduce partitions one at a time, then merge their sorted results
+        bestfiles = []
+        for filename in filenames:
+            bestfile = filename + ".best"
+            fw = open(bestfile, "w")
+            for bref, b in iter_best_hits(Blast(filename), N=N, hsps=hsps,
+                                          ref=ref, maxrecords=maxrecords,
+                                          tmpdir=tmpdir, depth=depth + 1):
+                print >> fw, b
+            fw.close()
+            bestfiles.append(bestfile)
+
+        def partition_hits(bestfile, i):
+            for k, b in enumerate(Blast(bestfile)):
+                yield getattr(b, ref), i, k, b
+
+        for bref, i, k, b in merge(*[partition_hits(x, i) \
+                                     for i, x in enumerate(bestfiles)]):
+            yield bref, b
+    finally:
+        shutil.rmtree(workdir)
 
 
 class BlastLineByConversion (BlastLine):
@@ -296,10 +560,13 @@ def filter(args):
     if inverse:
         newblastfile += ".inverse"
     fw = must_open(newblastfile, "w")
+    start = time.time()
+    nlines = 0
     for row in fp:
         if row[0] == '#':
             continue
         c = BlastLine(row)
+        nlines += 1
 
         if ids:
             if c.query in ids and c.subject in ids:
@@ -323,6 +590,10 @@ def filter(args):
         if not remove:
             print >> fw, row.rstrip()
 
+    elapsed = max(time.time() - start, 1e-6)
+    logging.debug("Processed {0} BLAST lines in {1:.1f}s ({2:.0f} lines/sec).".\
+                  format(nlines, elapsed, nlines / elapsed))
+
     return newblastfile
 
 
@@ -348,11 +619,36 @@ def main():
         ('annotate', 'annotate overlap types in BLAST tabular file'),
         ('score', 'add up the scores for each query seq'),
         ('rbbh', 'find reciprocal-best blast hits'),
+        ('index', 'write columnar binary index to speed up loading'),
             )
     p = ActionDispatcher(actions)
     p.dispatch(globals())
 
 
+def index(args):
+    """
+    %prog index blastfile
+
+    Write columnar binary sidecar `blastfile.idx/`. Blast and BlastSlow
+    memory-map the sidecar instead of parsing the text whenever it is up to
+    date.
+    """
+    p = OptionParser(index.__doc__)
+    opts, args = p.parse_args(args)
+
+    if len(args) != 1:
+        sys.exit(not p.print_help())
+
+    blastfile, = args
+    indexfile = get_index_name(blastfile)
+    if need_update(blastfile, op.join(indexfile, "ids.npy")):
+        BlastIndex.build(blastfile, indexfile)
+    else:
+        logging.debug("Index `{0}` is up to date.".format(indexfile))
+
+    return indexfile
+
+
 def rbbh(args):
     """
     %prog rbbh A_vs_B.blast B_vs_A.blast
@@ -583,7 +879,7 @@ def sort(args):
     %prog sort <blastfile|coordsfile>
 
     Sort lines so that same query grouped together with scores descending. The
-    sort is 'in-place'.
+    sort is 'in-place', and merged on disk for large files.
     """
     p = OptionParser(sort.__doc__)
     p.add_option("--query", default=False, action="store_true",
@@ -594,7 +890,7 @@ def sort(args):
             help="Sort by reference name, then score descending [default: %default]")
     p.add_option("--coords", default=False, action="store_true",
             help="File is .coords generated by NUCMER [default: %default]")
-    p.set_tmpdir()
+    p.set_sort()
 
     opts, args = p.parse_args(args)
 
@@ -603,27 +899,27 @@ def sort(args):
 
     blastfile, = args
 
+    sep = "\t"
     if opts.coords:
+        sep = None
         if opts.query:
-            key = "-k13,13 -k3,3n"
+            key = [(12, "str"), (2, "int")]
         elif opts.ref:
-            key = "-k12,12 -k1,1n"
+            key = [(11, "str"), (0, "int")]
 
     else:
         if opts.query:
-            key = "-k1,1 -k7,7n"
+            key = [(0, "str"), (6, "int")]
         elif opts.ref:
-            key = "-k2,2 -k9,9n"
+            key = [(1, "str"), (8, "int")]
         elif opts.refscore:
-            key = "-k2,2 -k12,12gr"
+            key = [(1, "str"), (11, "-float")]
         else:
-            key = "-k1,1 -k12,12gr"
+            key = [(0, "str"), (11, "-float")]
 
-    cmd = "sort"
-    if opts.tmpdir:
-        cmd += " -T {0}".format(opts.tmpdir)
-    cmd += " {0} {1} -o {1}".format(key, blastfile)
-    sh(cmd)
+    external_sort(blastfile, blastfile, SortKey(key, sep=sep),
+                  memory=opts.memory * 1024 ** 2, tmpdir=opts.tmpdir,
+                  cpus=opts.cpus)
 
 
 def cscore(args):
@@ -931,45 +1227,45 @@ def covfilter(args):
 
     assert op.exists(blastfile)
 
+    # Single pass, accumulating the per-query (or per-pair) totals so that the
+    # BLAST file needs neither be sorted nor held in memory
+    store = {}
+    for b in Blast(blastfile):
+        query = (b.query, b.subject) if qspair else b.query
+        if scov:
+            s, start, stop = b.subject, b.sstart, b.sstop
+        else:
+            s, start, stop = b.query, b.qstart, b.qstop
+
+        # [covered, alignlen, mismatches, gaps, cov_id, ranges]
+        stats = store.get(query)
+        if stats is None:
+            stats = store[query] = [0, 0, 0, 0, s, []]
+        stats[4] = s
+
+        if b.pctid < pctid:
+            continue
+
+        stats[0] += abs(start - stop + 1)
+        stats[1] += b.hitlen
+        stats[2] += b.nmismatch
+        stats[3] += b.ngaps
+        if union:
+            stats[5].append(("1", start, stop))
+
     covered = 0
     mismatches = 0
     gaps = 0
     alignlen = 0
-    queries = set()
+    queries = set(store.keys())
     valid = set()
-    blast = BlastSlow(blastfile)
-    iterator = blast.iter_hits_pair if qspair else blast.iter_hits
-
     covidstore = {}
-    for query, blines in iterator():
-        blines = list(blines)
-        queries.add(query)
+    for query, stats in store.iteritems():
+        this_covered, this_alignlen, this_mismatches, this_gaps, \
+                cov_id, ranges = stats
 
-        # per gene report
-        this_covered = 0
-        this_alignlen = 0
-        this_mismatches = 0
-        this_gaps = 0
         this_identity = 0
-
-        ranges = []
-        for b in blines:
-            if scov:
-                s, start, stop = b.subject, b.sstart, b.sstop
-            else:
-                s, start, stop = b.query, b.qstart, b.qstop
-            cov_id = s
-
-            if b.pctid < pctid:
-                continue
-
-            this_covered += abs(start - stop + 1)
-            this_alignlen += b.hitlen
-            this_mismatches += b.nmismatch
-            this_gaps += b.ngaps
-            ranges.append(("1", start, stop))
-
-        if ranges:
+        if this_alignlen:
             this_identity = 100. - (this_mismatches + this_gaps) * 100. / this_alignlen
 
         if union:
@@ -1134,6 +1430,8 @@ def best(args):
             help="get best N hits [default: %default]")
     p.add_option("--nosort", default=False, action="store_true",
             help="assume BLAST is already sorted [default: %default]")
+    p.add_option("--maxrecords", default=5000000, type="int",
+            help="Spill to --tmpdir when holding more lines [default: %default]")
     p.add_option("--hsps", default=False, action="store_true",
             help="get all HSPs for the best pair [default: %default]")
     p.add_option("--subject", default=False, action="store_true",
@@ -1150,16 +1448,6 @@ def best(args):
     tmpdir = opts.tmpdir
     ref = "query" if not opts.subject else "subject"
 
-    if not opts.nosort:
-        sargs = [blastfile]
-        if tmpdir:
-            sargs += ["-T {0}".format(tmpdir)]
-        if ref != "query":
-            sargs += ["--refscore"]
-        sort(sargs)
-    else:
-        logging.debug("Assuming sorted BLAST")
-
     if not opts.subject:
         bestblastfile = blastfile + ".best"
     else:
@@ -1167,7 +1455,13 @@ def best(args):
     fw = open(bestblastfile, "w")
 
     b = Blast(blastfile)
-    for q, bline in b.iter_best_hit(N=n, hsps=hsps, ref=ref):
+    if opts.nosort:
+        logging.debug("Assuming sorted BLAST")
+        hits = b.iter_best_hit(N=n, hsps=hsps, ref=ref)
+    else:
+        hits = iter_best_hits(b, N=n, hsps=hsps, ref=ref,
+                              maxrecords=opts.maxrecords, tmpdir=tmpdir)
+    for q, bline in hits:
         print >> fw, bline
 
     return bestblastfile
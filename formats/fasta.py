@@ -6,11 +6,15 @@ import re
 import sys
 import os
 import os.path as op
+import mmap
 import shutil
 import logging
 import string
+import numpy as np
 
-from itertools import groupby, izip_longest
+from collections import defaultdict
+from itertools import groupby, izip, izip_longest
+from multiprocessing import Pool
 
 from Bio import SeqIO
 from Bio.Seq import Seq
@@ -26,15 +30,206 @@ from jcvi.apps.console import red, green
 from jcvi.apps.base import OptionParser, ActionDispatcher, need_update
 
 
-class Fasta (BaseFile, dict):
+class FastaIndex (BaseFile):
+    """
+    Random access into a plain FASTA file through a samtools-compatible .fai
+    index (name, length, offset, linebases, linewidth), reused if one is
+    already there and newer than the FASTA. The file is memory-mapped and
+    only the bytes of the requested region are read, so no SeqRecord is built
+    unless a whole record is asked for.
+    """
+    def __init__(self, filename, key_function=None):
+        super(FastaIndex, self).__init__(filename)
+        faifile = filename + ".fai"
+        if need_update(filename, faifile):
+            entries = list(self.build(filename))
+            try:
+                self.write(entries, faifile)
+            except IOError:
+                logging.debug("Cannot write index `{0}`.".format(faifile))
+        else:
+            entries = list(self.read(faifile))
+
+        self.names = []
+        self.entries = {}
+        for name, length, offset, linebases, linewidth in entries:
+            key = key_function(name) if key_function else name
+            self.names.append(key)
+            self.entries[key] = (name, length, offset, linebases, linewidth)
+
+        fp = open(filename, "rb")
+        self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) \
+                  if op.getsize(filename) else ""
+        fp.close()
+
+    @classmethod
+    def build(cls, filename):
+        """
+        Scan the FASTA once and yield the .fai entries. As with samtools, all
+        lines in a record but the last must have the same length.
+        """
+        fp = open(filename, "rb")
+        name = None
+        offset = 0
+        for line in fp:
+            size = len(line)
+            if line[0] == ">":
+                if name is not None:
+                    yield name, length, seqoffset, linebases, linewidth
+                name = line[1:].split(None, 1)[0] if line[1:].strip() else ""
+                seqoffset = offset + size
+                length = linebases = linewidth = 0
+                ended = False
+            elif name is not None:
+                bases = len(line.rstrip("\r\n"))
+                if (bases and ended) or (linewidth and bases > linebases):
+                    raise ValueError("Different line length in `{0}` of `{1}`"\
+                                     .format(name, filename))
+                if not linewidth:
+                    linebases, linewidth = bases, size
+                elif bases != linebases:
+                    ended = True
+                length += bases
+            offset += size
+
+        if name is not None:
+            yield name, length, seqoffset, linebases, linewidth
+        fp.close()
+
+    @classmethod
+    def read(cls, faifile):
+        for row in open(faifile):
+            atoms = row.rstrip("\n").split("\t")
+            yield (atoms[0],) + tuple(int(x) for x in atoms[1:5])
+
+    @classmethod
+    def write(cls, entries, faifile):
+        fw = open(faifile, "w")
+        for entry in entries:
+            print >> fw, "\t".join(str(x) for x in entry)
+        fw.close()
+        logging.debug("Index written to `{0}`.".format(faifile))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        """
+        Whole record as SeqRecord, with the header read back from the file.
+        """
+        name, length, offset, linebases, linewidth = self.entries[key]
+        start = self.mm.rfind(">", 0, offset)
+        description = self.mm[start + 1:offset].strip()
+        return SeqRecord(Seq(self.fetch(key)), id=name, name=name,
+                         description=description)
+
+    def keys(self):
+        return list(self.names)
+
+    def iterkeys(self):
+        return iter(self.names)
+
+    def size(self, key):
+        return self.entries[key][1]
+
+    def itersizes(self):
+        for k in self.names:
+            yield k, self.size(k)
+
+    def fetch(self, key, start=0, end=None):
+        """
+        Sequence string of `key` in 0-based half-open [start, end).
+        """
+        return fetch_region(self.mm, self.entries[key], start, end)
+
+    def subseq(self, key, start=None, stop=None, strand=None):
+        """
+        Same as Fasta.subseq(), but reads the region from the file.
+        """
+        name, length = self.entries[key][:2]
+        start, stop = fix_range(name, length, start, stop)
+        seq = Seq(self.fetch(key, start, stop))
+
+        if strand in (-1, '-1', '-'):
+            seq = seq.reverse_complement()
+
+        return seq
+
+
+def fetch_region(mm, entry, start=0, end=None):
+    """
+    Read [start, end) of the record described by .fai `entry` out of the
+    mapped FASTA `mm`, without line breaks.
+    """
+    name, length, offset, linebases, linewidth = entry
+    end = length if end is None else min(end, length)
+    start = max(start, 0)
+    if start >= end:
+        return ""
+
+    a = offset + start / linebases * linewidth + start % linebases
+    end -= 1
+    b = offset + end / linebases * linewidth + end % linebases + 1
+    return mm[a:b].translate(None, "\r\n")
+
+
+def fix_range(name, length, start=None, stop=None):
+    """
+    Convert 1-based inclusive start/stop (None for either end) into 0-based
+    slice coordinates, clipped to the sequence length.
+    """
+    start = start - 1 if start is not None else 0
+    stop = stop if stop is not None else length
+
+    if start < 0:
+        msg = "start ({0}) must > 0 of `{1}`. Reset to 1".\
+                    format(start + 1, name)
+        logging.error(msg)
+        start = 0
+
+    if stop > length:
+        msg = "stop ({0}) must be <= length of `{1}` ({2}). Reset to {2}.".\
+                    format(stop, name, length)
+        logging.error(msg)
+        stop = length
+
+    return start, stop
+
+
+def is_indexable(filename):
+    """
+    Only plain FASTA files on disk can be memory-mapped by FastaIndex.
+    """
+    return op.isfile(filename) and \
+           not filename.endswith(".gz") and not filename.endswith(".bz2")
+
 
-    def __init__(self, filename, index=False, key_function=None, lazy=False):
+class Fasta (BaseFile, dict):
+    """
+    Dict-like access to FASTA records. The records are all loaded into memory
+    by default, are parsed on access with `index`, or are read from the file
+    by region through a .fai index with `faidx`.
+    """
+    def __init__(self, filename, index=False, key_function=None, lazy=False,
+                 faidx=False):
         super(Fasta, self).__init__(filename)
         self.key_function = key_function
+        self.faidx = faidx and is_indexable(filename)
 
         if lazy:  # do not incur the overhead
             return
 
+        if self.faidx:
+            try:
+                self.index = FastaIndex(filename, key_function=key_function)
+                return
+            except ValueError, e:  # irregular line widths, cannot use .fai
+                logging.debug("{0}, .fai skipped.".format(e))
+                self.faidx = False
+
         if index:
             self.index = SeqIO.index(filename, "fasta",
                     key_function=key_function)
@@ -73,6 +268,11 @@ class Fasta (BaseFile, dict):
             yield k, self[k]
 
     def itersizes(self):
+        if self.faidx:
+            for k, size in self.index.itersizes():
+                yield k, size
+            return
+
         for k in self.iterkeys():
             yield k, len(self[k])
 
@@ -89,6 +289,11 @@ class Fasta (BaseFile, dict):
             yield k
 
     def itersizes_ordered(self):
+        if self.faidx:  # .fai entries are in file order
+            for k, size in self.index.itersizes():
+                yield k, size
+            return
+
         for k, rec in self.iteritems_ordered():
             yield k, len(rec)
 
@@ -108,21 +313,7 @@ class Fasta (BaseFile, dict):
         Take Bio.SeqRecord and slice "start:stop" from it, does proper
         index and error handling
         """
-        start = start - 1 if start is not None else 0
-        stop = stop if stop is not None else len(fasta)
-
-        if start < 0:
-            msg = "start ({0}) must > 0 of `{1}`. Reset to 1".\
-                        format(start + 1, fasta.id)
-            logging.error(msg)
-            start = 0
-
-        if stop > len(fasta):
-            msg = "stop ({0}) must be <= length of `{1}` ({2}). Reset to {2}.".\
-                        format(stop, fasta.id, len(fasta))
-            logging.error(msg)
-            stop = len(fasta)
-
+        start, stop = fix_range(fasta.id, len(fasta), start, stop)
         seq = fasta.seq[start:stop]
 
         if strand in (-1, '-1', '-'):
@@ -154,16 +345,93 @@ class Fasta (BaseFile, dict):
         assert name in self, "feature: %s not in `%s`" % \
                 (f, self.filename)
 
-        fasta = self[f['chr']]
-
-        seq = Fasta.subseq(fasta,
-                f.get('start'), f.get('stop'), f.get('strand'))
+        if self.faidx:
+            seq = self.index.subseq(self._key_function(name),
+                    f.get('start'), f.get('stop'), f.get('strand'))
+        else:
+            fasta = self[f['chr']]
+            seq = Fasta.subseq(fasta,
+                    f.get('start'), f.get('stop'), f.get('strand'))
 
         if asstring:
             return str(seq)
 
         return seq
 
+    def read_region(self, key, start, stop):
+        if self.faidx:
+            return self.index.fetch(key, start, stop)
+        return str(self.index[key].seq[start:stop])
+
+    def batch_sequences(self, features, asstring=True, window=1000000):
+        """
+        Same as sequence() on each of the features, yielded in the same order.
+        Features are grouped by seqid and sorted by start, and features less
+        than `window` bp apart are served from a single read of the region
+        spanning them; minus-strand features are sliced from the complement of
+        that region.
+        """
+        groups = defaultdict(list)
+        ranges = []
+        for i, f in enumerate(features):
+            assert 'chr' in f, "`chr` field required"
+            name = f['chr']
+            assert name in self, "feature: %s not in `%s`" % \
+                    (f, self.filename)
+
+            key = self._key_function(name)
+            length = self.index.size(key) if self.faidx \
+                     else len(self.index[key])
+            start, stop = fix_range(name, length, f.get('start'), f.get('stop'))
+            minus = f.get('strand') in (-1, '-1', '-')
+            ranges.append((start, max(start, stop), minus))
+            groups[key].append(i)
+
+        # serve seqids in order of first request, so results can be released
+        # as soon as all earlier features are done
+        results = {}
+        released = 0
+        for key, idx in sorted(groups.items(), key=lambda x: x[1][0]):
+            idx.sort(key=lambda i: ranges[i][0])
+            for cluster in cluster_ranges(idx, ranges, window):
+                lo = min(ranges[i][0] for i in cluster)
+                hi = max(ranges[i][1] for i in cluster)
+                region = self.read_region(key, lo, hi)
+                cregion = None
+                for i in cluster:
+                    start, stop, minus = ranges[i]
+                    seq = region[start - lo:stop - lo]
+                    if minus:
+                        if cregion is None:
+                            cregion = region.translate(COMPLEMENT)
+                        seq = cregion[start - lo:stop - lo][::-1]
+                    results[i] = seq if asstring else Seq(seq)
+
+            while released in results:
+                yield results.pop(released)
+                released += 1
+
+
+def cluster_ranges(idx, ranges, window):
+    """
+    Split `idx`, sorted by start, where the gap to the next range reaches
+    `window`, or where the region read for a cluster would pass 10 windows.
+    """
+    cluster = []
+    end = None
+    for i in idx:
+        start, stop, minus = ranges[i]
+        if cluster and (start - end >= window or \
+                        max(end, stop) - ranges[cluster[0]][0] > 10 * window):
+            yield cluster
+            cluster = []
+            end = None
+        cluster.append(i)
+        end = stop if end is None else max(end, stop)
+
+    if cluster:
+        yield cluster
+
 
 """
 Class derived from https://gist.github.com/933737
@@ -261,6 +529,117 @@ class ORFFinder (object):
         return orf
 
 
+def seq_stats(seq, start=0):
+    """
+    Residue counts of a sequence chunk, as [A, C, G, T, N, soft-masked], and
+    the N runs in it as 0-based half-open ranges offset by `start`.
+    """
+    a = np.frombuffer(seq, dtype=np.uint8)
+    bc = np.bincount(a, minlength=256)
+    counts = [bc[ord(x)] + bc[ord(x.lower())] for x in "ACGTN"]
+    counts.append(bc[ord('a'):ord('z') + 1].sum())
+
+    isn = np.zeros(len(a) + 2, dtype=np.int8)
+    isn[1:-1] = (a == ord('N')) | (a == ord('n'))
+    edges = np.flatnonzero(np.diff(isn))
+    runs = edges.reshape((-1, 2)) + start
+    return np.array(counts, dtype=np.int64), runs
+
+
+def seq_stats_worker(task):
+    filename, entry, start, end = task
+    fp = open(filename, "rb")
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    seq = fetch_region(mm, entry, start, end)
+    mm.close()
+    fp.close()
+    return seq_stats(seq, start)
+
+
+class FastaStats (BaseFile):
+    """
+    Length, residue counts (A, C, G, T, N, soft-masked) and N runs of each
+    record in a FASTA file, in file order.
+
+    Plain FASTA files are memory-mapped through their .fai and cut into chunks
+    of about `chunksize` bp, including within long records. The chunks are
+    counted with NumPy in a pool of `cpus` processes, which only send back
+    counts and N runs, and N runs across chunk boundaries are stitched back.
+    Other inputs, and files with unevenly wrapped lines, are parsed record by
+    record in this process.
+    """
+    def __init__(self, filename, cpus=1, chunksize=10000000):
+        super(FastaStats, self).__init__(filename)
+        self.names = []
+        self.sizes = {}
+        self.counts = {}
+        self.runs = {}
+
+        index = None
+        if is_indexable(filename):
+            try:
+                index = FastaIndex(filename)
+            except ValueError as e:  # irregular line widths, cannot use .fai
+                logging.debug("{0}, .fai skipped.".format(e))
+
+        if index is not None:
+            tasks, keys = [], []
+            for key in index.names:
+                entry = index.entries[key]
+                self.add(key, entry[1])
+                for start in xrange(0, entry[1], chunksize):
+                    tasks.append((filename, entry, start, start + chunksize))
+                    keys.append(key)
+
+            if cpus > 1 and len(tasks) > 1:
+                pool = Pool(cpus)
+                results = pool.imap(seq_stats_worker, tasks)
+            else:
+                pool = None
+                results = (seq_stats_worker(x) for x in tasks)
+
+            for key, (counts, runs) in izip(keys, results):
+                self.update(key, counts, runs)
+
+            if pool:
+                pool.close()
+                pool.join()
+        else:
+            for rec in SeqIO.parse(must_open(filename), "fasta"):
+                self.add(rec.id, len(rec))
+                self.update(rec.id, *seq_stats(str(rec.seq)))
+
+        for key in self.names:
+            runs = self.runs[key]
+            self.runs[key] = np.concatenate(runs) if runs else \
+                             np.zeros((0, 2), dtype=np.int64)
+
+    def add(self, key, size):
+        self.names.append(key)
+        self.sizes[key] = size
+        self.counts[key] = np.zeros(6, dtype=np.int64)
+        self.runs[key] = []
+
+    def update(self, key, counts, runs):
+        self.counts[key] += counts
+        allruns = self.runs[key]
+        if len(runs) and allruns and allruns[-1][-1, 1] == runs[0, 0]:
+            allruns[-1][-1, 1] = runs[0, 1]
+            runs = runs[1:]
+        if len(runs):
+            allruns.append(runs)
+
+    def iter_gaps(self, mingap=1):
+        """
+        N runs of at least `mingap` bp, as (seqid, start, end) in BED style.
+        """
+        for key in self.names:
+            runs = self.runs[key]
+            runs = runs[runs[:, 1] - runs[:, 0] >= mingap]
+            for start, end in runs.tolist():
+                yield key, start, end
+
+
 class SequenceInfo (object):
     """
     Emulate output from `sequence_info`:
@@ -283,34 +662,24 @@ class SequenceInfo (object):
       Average                            2641.25
       N50                                4791
     """
-    def __init__(self, filename, gapstats=False):
+    def __init__(self, filename, gapstats=False, cpus=1):
         from jcvi.utils.cbook import SummaryStats
         from jcvi.assembly.base import calculate_A50
 
-        f = Fasta(filename)
+        f = FastaStats(filename, cpus=cpus)
         self.filename = filename
         self.header = \
         "File|#_seqs|#_reals|#_Ns|Total|Min|Max|N50".split("|")
         if gapstats:
             self.header += ["Gaps"]
-        self.nseqs = len(f)
-        sizes = []
-        gaps = []
-        na = nc = ng = nt = 0
-        for k, s in f.iteritems():
-            s = str(s.seq).upper()
-            sizes.append(len(s))
-            na += s.count('A')
-            nc += s.count('C')
-            ng += s.count('G')
-            nt += s.count('T')
-            if gapstats:
-                gaps += list(self.iter_gap_len(s))
-        self.real = real = na + nc + ng + nt
+        self.nseqs = len(f.names)
+        sizes = [f.sizes[k] for k in f.names]
+        counts = sum(f.counts[k] for k in f.names)
+        self.real = real = int(counts[:4].sum()) if f.names else 0
         s = SummaryStats(sizes)
         self.sum = s.sum
         if gapstats:
-            self.gaps = len(gaps)
+            self.gaps = sum(1 for x in f.iter_gaps(mingap=10))
         self.nn = self.sum - real
         a50, l50, nn50 = calculate_A50(sizes)
         self.min = s.min
@@ -324,13 +693,10 @@ class SequenceInfo (object):
             self.data += [self.gaps]
         assert len(self.header) == len(self.data)
 
-    def iter_gap_len(self, seq, mingap=10):
-        for gap, seq in groupby(seq, lambda x: x == 'N'):
-            if not gap:
-                continue
-            gap_len = len(list(seq))
-            if gap_len >= mingap:
-                yield len(list(seq))
+
+# IUPAC complement used by Fasta.batch_sequences(), as in Bio.Seq
+COMPLEMENT = string.maketrans("ACGTUMRWSYKVHDBNXacgtumrwsykvhdbnx",
+                              "TGCAAKYWSRMBDHVNXtgcaakywsrmbdhvnx")
 
 
 def rc(s):
@@ -419,6 +785,7 @@ def info(args):
                  help="Count number of gaps [default: %default]")
     p.set_table()
     p.set_outfile()
+    p.set_cpus(cpus=1)
     opts, args = p.parse_args(args)
 
     if len(args) == 0:
@@ -427,7 +794,7 @@ def info(args):
     fastafiles = args
     data = []
     for f in fastafiles:
-        s = SequenceInfo(f, gapstats=opts.gaps)
+        s = SequenceInfo(f, gapstats=opts.gaps, cpus=opts.cpus)
         data.append(s.data)
     write_csv(s.header, data, sep=opts.sep,
               filename=opts.outfile, align=opts.align)
@@ -993,6 +1360,7 @@ def summary(args):
     p.add_option("--ids",
             help="write the ids that have >= 50% N's [default: %default]")
     p.set_outfile()
+    p.set_cpus(cpus=1)
 
     opts, args = p.parse_args(args)
 
@@ -1007,17 +1375,18 @@ def summary(args):
 
     data = []
     for fastafile in args:
-        for rec in SeqIO.parse(fastafile, "fasta"):
-            seqlen = len(rec)
-            nns = rec.seq.count('n') + rec.seq.count('N')
+        f = FastaStats(fastafile, cpus=opts.cpus)
+        for name in f.names:
+            seqlen = f.sizes[name]
+            nns = int(f.counts[name][4])
             reals = seqlen - nns
             pct = reals * 100. / seqlen
             pctreal = "{0:.1f}%".format(pct)
             if idsfile and pct < 50:
                 nids += 1
-                print >> idsfile, rec.id
+                print >> idsfile, name
 
-            data.append((rec.id, reals, nns, seqlen, pctreal))
+            data.append((name, reals, nns, seqlen, pctreal))
 
     data.sort(key=natsort_key)
     ids, reals, nns, seqlen, pctreal = zip(*data)
@@ -1696,7 +2065,7 @@ def extract(args):
 
     if opts.bed:
         fw = must_open(opts.outfile, "w")
-        f = Fasta(fastafile)
+        f = Fasta(fastafile, faidx=True)
         for accn in bedaccns:
             try:
                 rec = f[accn]
@@ -1763,7 +2132,7 @@ def extract(args):
             rec = SeqRecord(seq, id=newid, description=k)
             SeqIO.write([rec], fw, "fasta")
     else:
-        f = Fasta(fastafile)
+        f = Fasta(fastafile, faidx=True)
         try:
             seq = f.sequence(feature, asstring=False)
         except AssertionError as e:
@@ -2116,49 +2485,20 @@ def tidy(args):
     return tidyfastafile
 
 
-def write_gaps_worker(rec):
-    start = 0
-    seq = rec.seq.upper()
-    output = []
-    for gap, seq in groupby(seq, lambda x: x == 'N'):
-        seq = "".join(seq)
-        current_length = len(seq)
-        object_beg = start + 1
-        object_end = start + current_length
-        if gap:
-            s = "\t".join(str(x) for x in (rec.id,
-                object_beg - 1, object_end))
-            output.append(s)
-        start += current_length
-
-    return "\n".join(output)
-
-
 def write_gaps_bed(inputfasta, prefix, mingap, cpus):
-    from jcvi.apps.grid import WriteJobs
-    from jcvi.formats.bed import sort
+    from jcvi.utils.natsort import natsort_key
 
     bedfile = prefix + ".gaps.bed"
-    f = Fasta(inputfasta)
-    recs = list(rec for k, rec in f.iteritems())
-    pool = WriteJobs(write_gaps_worker, recs, bedfile, cpus=cpus)
-    pool.run()
-
-    sort([bedfile, "-i"])
-
-    bed = Bed(bedfile)
-    nbedfile = prefix + ".{0}N.bed".format(mingap)
-
-    gapnum = 0
-    fw = open(nbedfile, "w")
-    for b in bed:
-        if b.span < mingap:
-            continue
-        gapnum += 1
-        gapname = "gap.{0:05d}".format(gapnum)
-        print >> fw, "\t".join(str(x) for x in (b, gapname, b.span))
-
-    shutil.move(nbedfile, bedfile)
+    f = FastaStats(inputfasta, cpus=cpus)
+    gaps = sorted(f.iter_gaps(mingap=mingap),
+                  key=lambda x: (natsort_key(x[0]), x[1]))
+
+    fw = open(bedfile, "w")
+    for gapnum, (seqid, start, end) in enumerate(gaps):
+        gapname = "gap.{0:05d}".format(gapnum + 1)
+        print >> fw, "\t".join(str(x) for x in \
+                                (seqid, start, end, gapname, end - start))
+    fw.close()
     logging.debug("Write gap (>={0}bp) locations to `{1}`.".\
                   format(mingap, bedfile))
 
@@ -11,7 +11,9 @@ import re
 import logging
 import json
 
-from itertools import islice
+import numpy as np
+
+from itertools import izip
 
 from Bio import SeqIO
 from Bio.SeqIO.QualityIO import FastqGeneralIterator
@@ -42,34 +44,6 @@ class FastqLite (object):
         self.qual = self.qual[::-1]
 
 
-class FastqRecord (object):
-    def __init__(self, fh, offset=0, key=None):
-        self.name = self.header = fh.readline()
-        if not self.name:
-            return
-        self.name = self.name.split()[0]
-        self.seq = fh.readline().rstrip()
-        self.l3 = fh.readline().rstrip()
-        self.qual = fh.readline().rstrip()
-        if offset != 0:
-            self.qual = "".join(chr(ord(x) + offset) for x in self.qual)
-        self.length = len(self.seq)
-        assert self.length == len(self.qual), \
-                "length mismatch: seq(%s) and qual(%s)" % (self.seq, self.qual)
-        if key:
-            self.name = key(self.name)
-
-    def __str__(self):
-        return "\n".join((self.name, self.seq, "+", self.qual))
-
-    def __len__(self):
-        return self.length
-
-    @property
-    def quality(self):
-        return [ord(x) for x in self.qual]
-
-
 class FastqHeader(object):
 
     def __init__(self, row):
@@ -183,19 +157,261 @@ def pairspf(pp):
     return op.basename(op.commonprefix(pp).rstrip("._-"))
 
 
-def iter_fastq(filename, offset=0, key=None):
-    if isinstance(filename, str):
+FASTQ_BLOCKSIZE = 1 << 22   # 4Mb raw reads per block
+
+
+def decompress_cmd(filename):
+    """
+    Command that streams a gzipped file to stdout, prefer the parallel `pigz`.
+    """
+    prog = "pigz -dc" if which("pigz") else "gzip -dc"
+    return "{0} {1}".format(prog, filename)
+
+
+def open_fastq(filename):
+    """
+    Open fastq file for block reads, returns the file handle and the process
+    behind it, if any. Gzipped files are decompressed in a separate process,
+    which takes decompression off the parsing thread; its exit status is to
+    be checked at EOF.
+    """
+    from jcvi.apps.base import Popen
+
+    if not isinstance(filename, basestring):
+        return filename, None
+    if filename in ("-", "stdin"):
+        return sys.stdin, None
+    if filename.endswith(".gz"):
+        proc = Popen(decompress_cmd(filename))
+        return proc.stdout, proc
+    if filename.endswith(".bz2"):
+        return must_open(filename), None
+    return open(filename, "rb"), None
+
+
+def qual_table(offset):
+    """
+    Translation table that shifts quality chars by offset, '\\n' is left
+    intact so that the joined quals of a batch can be translated in one go.
+    """
+    table = [chr((i + offset) % 256) for i in xrange(256)]
+    table[ord("\n")] = "\n"
+    return "".join(table)
+
+
+class FastqRecord (object):
+
+    __slots__ = ("header", "name", "seq", "qual")
+
+    def __init__(self, header, seq, qual, key=None):
+        self.header = header
+        self.name = header.split(None, 1)[0]
+        self.seq = seq
+        self.qual = qual
+        if key:
+            self.name = key(self.name)
+
+    def __str__(self):
+        return "\n".join((self.name, self.seq, "+", self.qual))
+
+    def __len__(self):
+        return len(self.seq)
+
+    @property
+    def length(self):
+        return len(self.seq)
+
+    @property
+    def quality(self):
+        return [ord(x) for x in self.qual]
+
+
+class FastqBatch (object):
+    """
+    A block of fastq records held as three parallel lists, `headers` (full
+    header line, without the newline), `seqs` and `quals`.
+    """
+    __slots__ = ("headers", "seqs", "quals")
+
+    def __init__(self, headers=None, seqs=None, quals=None):
+        self.headers = headers or []
+        self.seqs = seqs or []
+        self.quals = quals or []
+
+    def __len__(self):
+        return len(self.headers)
+
+    def __add__(self, other):
+        return FastqBatch(self.headers + other.headers,
+                          self.seqs + other.seqs, self.quals + other.quals)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return FastqBatch(self.headers[i], self.seqs[i], self.quals[i])
+        return FastqRecord(self.headers[i], self.seqs[i], self.quals[i])
+
+    def __iter__(self):
+        for h, s, q in izip(self.headers, self.seqs, self.quals):
+            yield FastqRecord(h, s, q)
+
+    def records(self, key=None):
+        for h, s, q in izip(self.headers, self.seqs, self.quals):
+            yield FastqRecord(h, s, q, key=key)
+
+    @property
+    def lengths(self):
+        return np.array(map(len, self.seqs), dtype=np.int64)
+
+    def translate(self, offset):
+        """
+        Shift all quality chars by offset.
+        """
+        if not offset or not self.quals:
+            return
+        table = qual_table(offset)
+        self.quals = "\n".join(self.quals).translate(table).split("\n")
+
+    def select(self, mask):
+        """
+        Subset of the records where mask is True.
+        """
+        idx = np.flatnonzero(mask)
+        return FastqBatch([self.headers[i] for i in idx],
+                          [self.seqs[i] for i in idx],
+                          [self.quals[i] for i in idx])
+
+    def tostring(self):
+        n = len(self)
+        if not n:
+            return ""
+        lines = [None] * (4 * n)
+        lines[0::4] = self.headers
+        lines[1::4] = self.seqs
+        lines[2::4] = ["+"] * n
+        lines[3::4] = self.quals
+        return "\n".join(lines) + "\n"
+
+    def write(self, fw):
+        fw.write(self.tostring())
+
+
+def interleave(a, b):
+    """
+    Interleave two batches of equal size, i.e. a[0], b[0], a[1], b[1], ...
+    """
+    n = len(a)
+    assert n == len(b), "Batch size differ: {0} and {1}".format(n, len(b))
+    c = FastqBatch([None] * (2 * n), [None] * (2 * n), [None] * (2 * n))
+    for src, dst in ((a, 0), (b, 1)):
+        c.headers[dst::2] = src.headers
+        c.seqs[dst::2] = src.seqs
+        c.quals[dst::2] = src.quals
+    return c
+
+
+def parse_block(lines, nlines):
+    """
+    Build a batch from the first `nlines` (a multiple of 4) of lines.
+    """
+    headers = lines[0:nlines:4]
+    seqs = lines[1:nlines:4]
+    quals = lines[3:nlines:4]
+    if map(len, seqs) != map(len, quals):
+        for h, s, q in izip(headers, seqs, quals):
+            assert len(s) == len(q), \
+                "length mismatch: seq(%s) and qual(%s) in %s" % (s, q, h)
+    if headers and headers[0][:1] != "@":
+        raise ValueError("Malformed fastq record `{0}`".format(headers[0]))
+    return FastqBatch(headers, seqs, quals)
+
+
+def iter_fastq_batches(filename, offset=0, blocksize=FASTQ_BLOCKSIZE):
+    """
+    Read fastq file in blocks of `blocksize` bytes and yield FastqBatch. Each
+    block is split on newlines once; the incomplete record at the end of the
+    block is carried over to the next. A list of files is read in turn.
+    """
+    if isinstance(filename, list):
+        for f in filename:
+            for batch in iter_fastq_batches(f, offset=offset,
+                                            blocksize=blocksize):
+                yield batch
+        return
+
+    if isinstance(filename, basestring):
         logging.debug("Read file `{0}`".format(filename))
-        fh = must_open(filename)
-    else:
-        fh = filename
+    fh, proc = open_fastq(filename)
+
+    remainder = ""
+    while True:
+        buf = fh.read(blocksize)
+        if not buf:
+            break
+        if "\r" in buf:
+            buf = buf.replace("\r", "")
+        lines = (remainder + buf).split("\n")
+        nlines = (len(lines) - 1) / 4 * 4
+        remainder = "\n".join(lines[nlines:])
+        if not nlines:
+            continue
+        batch = parse_block(lines, nlines)
+        batch.translate(offset)
+        yield batch
+
+    if proc is not None:  # a corrupt gzip only shows in the exit status
+        retcode = proc.wait()
+        if retcode:
+            raise IOError("Decompressing `{0}` failed with exit status {1}".\
+                          format(filename, retcode))
+
+    if remainder.strip():
+        lines = remainder.rstrip("\n").split("\n")
+        if len(lines) % 4:
+            raise ValueError("Truncated fastq record `{0}`".format(lines[0]))
+        batch = parse_block(lines, len(lines))
+        batch.translate(offset)
+        yield batch
+
+
+def iter_paired_batches(read1, read2, offset=0, blocksize=FASTQ_BLOCKSIZE):
+    """
+    Yield pairs of batches of equal size from two fastq files, or from one
+    interleaved fastq file when read1 == read2.
+    """
+    if read1 == read2:
+        carry = FastqBatch()
+        for batch in iter_fastq_batches(read1, offset=offset,
+                                        blocksize=blocksize):
+            batch = carry + batch if carry else batch
+            n = len(batch) / 2 * 2
+            yield batch[0:n:2], batch[1:n:2]
+            carry = batch[n:]
+        assert not carry, "Odd number of reads in `{0}`".format(read1)
+        return
 
+    ia = iter_fastq_batches(read1, offset=offset, blocksize=blocksize)
+    ib = iter_fastq_batches(read2, offset=offset, blocksize=blocksize)
+    a, b = FastqBatch(), FastqBatch()
     while True:
-        rec = FastqRecord(fh, offset=offset, key=key)
-        if not rec.name:
+        if not a:
+            a = next(ia, None)
+        if not b:
+            b = next(ib, None)
+        if a is None or b is None:
             break
-        yield rec
-    yield None  # sentinel
+        n = min(len(a), len(b))
+        yield a[:n], b[:n]
+        a, b = a[n:], b[n:]
+
+    assert a is None and b is None, \
+        "Read counts differ in `{0}` and `{1}`".format(read1, read2)
+
+
+def iter_fastq(filename, offset=0, key=None, blocksize=FASTQ_BLOCKSIZE):
+    for batch in iter_fastq_batches(filename, offset=offset,
+                                    blocksize=blocksize):
+        for rec in batch.records(key=key):
+            yield rec
 
 
 def main():
@@ -241,13 +457,12 @@ def suffix(args):
     fastqfile, sf = args
     fw = must_open(opts.outfile, "w")
     nreads = nselected = 0
-    for rec in iter_fastq(fastqfile):
-        nreads += 1
-        if rec is None:
-            break
-        if rec.seq.endswith(sf):
-            print >> fw, rec
-            nselected += 1
+    for batch in iter_fastq_batches(fastqfile):
+        nreads += len(batch)
+        for rec in batch:
+            if rec.seq.endswith(sf):
+                print >> fw, rec
+                nselected += 1
     logging.debug("Selected reads with suffix {0}: {1}".\
                   format(sf, percentage(nselected, nreads)))
 
@@ -256,14 +471,11 @@ def calc_readlen(f, first):
     from jcvi.utils.cbook import SummaryStats
 
     L = []
-    ai = iter_fastq(f)
-    rec = ai.next()
-    while rec:
-        L.append(rec.length)
+    for batch in iter_fastq_batches(f):
+        L.extend(map(len, batch.seqs))
         if len(L) > first:
             break
-        rec = ai.next()
-    s = SummaryStats(L)
+    s = SummaryStats(L[:first + 1])
 
     return s
 
@@ -372,6 +584,19 @@ def isHighQv(qs, qvchar, pct=90):
     return highs >= cutoff
 
 
+def batch_high_qv(batch, qvchar, pct=90):
+    """
+    Vectorized isHighQv() over all records in a batch, returns a boolean mask.
+    """
+    lengths = np.array(map(len, batch.quals), dtype=np.int64)
+    q = np.fromstring("".join(batch.quals), dtype=np.uint8)
+    highs = np.zeros(len(q) + 1, dtype=np.int64)
+    np.cumsum(q >= ord(qvchar), out=highs[1:])
+    ends = np.cumsum(lengths)
+    highs = highs[ends] - highs[ends - lengths]
+    return highs >= lengths * pct / 100
+
+
 def filter(args):
     """
     %prog filter paired.fastq
@@ -405,19 +630,11 @@ def filter(args):
     outfile = r1.rsplit(".", 1)[0] + ".q{0}.paired.fastq".format(qv)
     fw = open(outfile, "w")
 
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
-
-        b = list(islice(p2fp, 4))
-        q1 = a[-1].rstrip()
-        q2 = b[-1].rstrip()
-
-        if isHighQv(q1, qvchar, pct=pct) and isHighQv(q2, qvchar, pct=pct):
-            fw.writelines(a)
-            fw.writelines(b)
+    for a, b in iter_paired_batches(r1, r2):
+        mask = batch_high_qv(a, qvchar, pct=pct) & \
+               batch_high_qv(b, qvchar, pct=pct)
+        interleave(a.select(mask), b.select(mask)).write(fw)
+    fw.close()
 
 
 def checkShuffleSizes(p1, p2, pairsfastq, extra=0):
@@ -448,30 +665,18 @@ def shuffle(args):
     pairsfastq = pairspf((p1, p2)) + ".fastq"
     tag = opts.tag
 
-    p1fp = must_open(p1)
-    p2fp = must_open(p2)
     pairsfw = must_open(pairsfastq, "w")
     nreads = 0
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
-
-        b = list(islice(p2fp, 4))
+    for a, b in iter_paired_batches(p1, p2):
         if tag:
-            name = a[0].rstrip()
-            a[0] = name + "/1\n"
-            b[0] = name + "/2\n"
-
-        pairsfw.writelines(a)
-        pairsfw.writelines(b)
-        nreads += 2
+            names = a.headers
+            a.headers = [x + "/1" for x in names]
+            b.headers = [x + "/2" for x in names]
+        interleave(a, b).write(pairsfw)
+        nreads += 2 * len(a)
 
     pairsfw.close()
-    extra = nreads * 2 if tag else 0
-    checkShuffleSizes(p1, p2, pairsfastq, extra=extra)
-
-    logging.debug("File `{0}` verified after writing {1} reads.".\
+    logging.debug("File `{0}` written with {1} reads.".\
                      format(pairsfastq, nreads))
     return pairsfastq
 
@@ -499,13 +704,14 @@ def split(args):
     p1 = pf + ".1.fastq"
     p2 = pf + ".2.fastq"
 
-    cmd = "zcat" if gz else "cat"
-    p1cmd = cmd + " {0} | sed -ne '1~8{{N;N;N;p}}'".format(pairsfastq)
-    p2cmd = cmd + " {0} | sed -ne '5~8{{N;N;N;p}}'".format(pairsfastq)
+    cmd = decompress_cmd(pairsfastq) if gz else "cat " + pairsfastq
+    p1cmd = cmd + " | sed -ne '1~8{N;N;N;p}'"
+    p2cmd = cmd + " | sed -ne '5~8{N;N;N;p}'"
 
     if gz:
-        p1cmd += " | gzip"
-        p2cmd += " | gzip"
+        compress = " | pigz" if which("pigz") else " | gzip"
+        p1cmd += compress
+        p2cmd += compress
         p1 += ".gz"
         p2 += ".gz"
 
@@ -549,10 +755,8 @@ def guessoffset(args):
         sys.exit(not p.print_help())
 
     fastqfile, = args
-    ai = iter_fastq(fastqfile)
-    rec = ai.next()
     offset = 64
-    while rec:
+    for rec in iter_fastq(fastqfile):
         quality = rec.quality
         lowcounts = len([x for x in quality if x < 59])
         highcounts = len([x for x in quality if x > 74])
@@ -562,7 +766,6 @@ def guessoffset(args):
         elif diff < -10:
             offset = 33
             break
-        rec = ai.next()
 
     if offset == 33:
         print >> sys.stderr, "Sanger encoding (offset=33)"
@@ -591,10 +794,8 @@ def format(args):
         sys.exit(not p.print_help())
 
     fastqfile, = args
-    ai = iter_fastq(fastqfile)
-    rec = ai.next()
     dialect = None
-    while rec:
+    for rec in iter_fastq(fastqfile):
         h = FastqHeader(rec.header)
         if not dialect:
             dialect = h.dialect
@@ -605,7 +806,6 @@ def format(args):
         rec.name = h.format_header(dialect=opts.convert, tag=opts.tag)
 
         print rec
-        rec = ai.next()
 
 
 def some(args):
@@ -626,22 +826,16 @@ def some(args):
 
     ids = DictFile(idsfile, valuepos=None)
 
-    ai = iter_fastq(open(afastq))
-    arec = ai.next()
-    if bfastq:
-        bi = iter_fastq(open(bfastq))
-        brec = bi.next()
+    ai = iter_fastq(afastq)
+    bi = iter_fastq(bfastq) if bfastq else None
 
-    while arec:
+    for arec in ai:
+        brec = next(bi) if bi else None
         if arec.name[1:] in ids:
             print arec
-            if bfastq:
+            if brec:
                 print brec
 
-        arec = ai.next()
-        if bfastq:
-            brec = bi.next()
-
 
 def trim(args):
     """
@@ -688,17 +882,14 @@ def catread(args):
         sys.exit(not p.print_help())
 
     r1, r2 = args
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
     outfile = pairspf((r1, r2)) + ".cat.fastq"
     fw = must_open(outfile, "w")
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
-        atitle, aseq, _, aqual = a
-        btitle, bseq, _, bqual = list(islice(p2fp, 4))
-        print >> fw, "\n".join((atitle.strip(), aseq.strip() + bseq.strip(), \
-                                "+", aqual.strip() + bqual.strip()))
+    for a, b in iter_paired_batches(r1, r2):
+        c = FastqBatch(a.headers,
+                       [x + y for x, y in izip(a.seqs, b.seqs)],
+                       [x + y for x, y in izip(a.quals, b.quals)])
+        c.write(fw)
+    fw.close()
 
 
 def splitread(args):
@@ -760,10 +951,9 @@ def size(args):
     total_size = 0
     total_numrecords = 0
     for f in args:
-        for rec in iter_fastq(f):
-            if rec:
-                total_numrecords += 1
-                total_size += len(rec)
+        for batch in iter_fastq_batches(f):
+            total_numrecords += len(batch)
+            total_size += sum(map(len, batch.seqs))
 
     print >>sys.stderr, "A total %d bases in %s sequences" % (total_size,
             total_numrecords)
@@ -820,8 +1010,6 @@ def pairinplace(args):
     records. If they match, print to bulk.pairs.fastq, else print to
     bulk.frags.fastq.
     """
-    from jcvi.utils.iter import pairwise
-
     p = OptionParser(pairinplace.__doc__)
     p.set_rclip()
     p.set_tag()
@@ -848,14 +1036,10 @@ def pairinplace(args):
     tag = opts.tag
     strip_name = (lambda x: x[:-N]) if N else None
 
-    fh_iter = iter_fastq(fastqfile, key=strip_name)
-    skipflag = False  # controls the iterator skip
-    for a, b in pairwise(fh_iter):
-        if b is None:  # hit the eof
-            break
-
-        if skipflag:
-            skipflag = False
+    a = None  # previous record still waiting for its mate
+    for b in iter_fastq(fastqfile, key=strip_name):
+        if a is None:
+            a = b
             continue
 
         if a.name == b.name:
@@ -864,14 +1048,18 @@ def pairinplace(args):
                 b.name += "/2"
             print >> pairsfw, a
             print >> pairsfw, b
-            skipflag = True
+            a = None
         else:
             print >> fragsfw, a
+            a = b
 
-    # don't forget the last one, when b is None
-    if not skipflag:
+    # don't forget the last one
+    if a is not None:
         print >> fragsfw, a
 
+    fragsfw.close()
+    pairsfw.close()
+
     logging.debug("Reads paired into `%s` and `%s`" % (pairs, frags))
     return pairs
 
@@ -7,12 +7,14 @@ import os
 import os.path as op
 import logging
 import re
+import numpy as np
 
 from collections import defaultdict
 from urllib import quote, unquote
 
 from jcvi.utils.cbook import AutoVivification
-from jcvi.formats.base import DictFile, LineFile, must_open, is_number
+from jcvi.formats.base import BaseFile, DictFile, LineFile, must_open, \
+            is_number, SortKey, external_sort
 from jcvi.formats.fasta import Fasta, SeqIO
 from jcvi.formats.bed import Bed, BedLine
 from jcvi.annotation.reformat import atg_name
@@ -55,7 +57,15 @@ safechars = " /:?~#+!$'@()*[]|"
 class GffLine (object):
     """
     Specification here (http://www.sequenceontology.org/gff3.shtml)
+
+    The attributes column is only decoded when `attributes` is first used;
+    `accn`, `name`, `parent` and get_attr() read single attributes straight
+    off the text until then.
     """
+    __slots__ = ("seqid", "source", "type", "start", "end", "score",
+                 "strand", "phase", "attributes_text", "_attributes",
+                 "keep_attr_order", "key", "gff3", "idx", "sign")
+
     def __init__(self, sline, key="ID", gff3=True, line_index=None, strict=True,
                  append_source=False, append_ftype=False, score_attrib=False,
                  keep_attr_order=True, compute_signature=False):
@@ -79,7 +89,8 @@ class GffLine (object):
         assert self.phase in Valid_phases, \
                 "phase must be one of {0}".format(Valid_phases)
         self.attributes_text = "" if len(args) <= 8 else args[8].strip()
-        self.attributes = make_attributes(self.attributes_text, gff3=gff3, keep_attr_order=keep_attr_order)
+        self._attributes = None
+        self.keep_attr_order = keep_attr_order
         # key is not in the gff3 field, this indicates the conversion to accn
         self.key = key  # usually it's `ID=xxxxx;`
         self.gff3 = gff3
@@ -122,11 +133,32 @@ class GffLine (object):
                 self.start, self.end, self.score, self.strand, self.phase,
                 self.attributes_text))
 
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = make_attributes(self.attributes_text,
+                    gff3=self.gff3, keep_attr_order=self.keep_attr_order)
+        return self._attributes
+
+    @attributes.setter
+    def attributes(self, attributes):
+        self._attributes = attributes
+
+    def get_values(self, key):
+        """
+        Values of one attribute, without decoding the whole column if it has
+        not been decoded yet.
+        """
+        if self._attributes is None and self.gff3:
+            return key_attributes(self.attributes_text, keys=(key,)).get(key)
+        return self.attributes.get(key)
+
     def get_attr(self, key, first=True):
-        if key in self.attributes:
+        values = self.get_values(key)
+        if values:
             if first:
-                return self.attributes[key][0]
-            return self.attributes[key]
+                return values[0]
+            return values
         return None
 
     def set_attr(self, key, value, update=False, append=False, dbtag=None):
@@ -178,10 +210,11 @@ class GffLine (object):
     @property
     def accn(self):
         if self.key:   # GFF3 format
-            if self.key not in self.attributes:
+            a = self.get_values(self.key)
+            if a is None:
                 a = "{0}_{1}".format(str(self.type).lower(), self.idx)
                 self.set_attr(self.key, a, update=True)
-            a = self.attributes[self.key]
+                a = self.attributes[self.key]
         else:          # GFF2 format
             a = self.attributes_text.split()
         return quote(",".join(a), safe=safechars)
@@ -190,11 +223,11 @@ class GffLine (object):
 
     @property
     def name(self):
-        return self.attributes["Name"][0] if "Name" in self.attributes else None
+        return self.get_attr("Name")
 
     @property
     def parent(self):
-        return self.attributes["Parent"][0] if "Parent" in self.attributes else None
+        return self.get_attr("Parent")
 
     @property
     def span(self):
@@ -590,11 +623,11 @@ def parents(args):
         sys.exit(not p.print_help())
 
     gff_file, idsfile = args
-    g = make_index(gff_file)
+    g = GffIndex(gff_file)
     fp = open(idsfile)
     for row in fp:
         cid = row.strip()
-        b = g.parents(cid, 1).next()
+        b = g.parents(cid, 1)[0]
         print "\t".join((cid, b.id))
 
 
@@ -1485,36 +1518,25 @@ def uniq(args):
 def populate_children(outfile, ids, gffile, iter="2"):
     fw = must_open(outfile, "w")
     logging.debug("A total of {0} features selected.".format(len(ids)))
-    logging.debug("Populate children. Iteration 1..")
-    gff = Gff(gffile)
-    children = set()
-    for g in gff:
-        if "Parent" not in g.attributes:
-            continue
-        for parent in g.attributes["Parent"]:
-            if parent in ids:
-                children.add(g.accn)
-
-    if iter == "2":
-        logging.debug("Populate grand children. Iteration 2..")
-        gff = Gff(gffile)
-        for g in gff:
-            if "Parent" not in g.attributes:
-                continue
-            for parent in g.attributes["Parent"]:
-                if parent in children:
-                    children.add(g.accn)
+    logging.debug("Populate children. Iterations: {0}..".format(iter))
+    index = GffIndex(gffile)
+    children = index.descendants(ids, level=int(iter))
 
     logging.debug("Filter gff file..")
+    # only the first line of each selected ID is written
+    lines = set()
+    for accn in set(ids) | children:
+        rows = index.rows(accn)
+        if rows:
+            lines.add(int(index.lines[rows[0]]))
+
     gff = Gff(gffile)
-    seen = set()
-    for g in gff:
-        accn = g.accn
-        if accn in seen:
+    for idx, row in enumerate(must_open(gffile)):
+        if idx not in lines:
             continue
-        if (accn in ids) or (accn in children):
-            seen.add(accn)
-            print >> fw, g
+        g = GffLine(row, key=gff.key, line_index=idx, gff3=gff.gff3)
+        g.accn  # features without ID get one, as in Gff iteration
+        print >> fw, g
     fw.close()
 
 
@@ -1522,8 +1544,9 @@ def sort(args):
     """
     %prog sort gffile
 
-    Sort gff file using plain old unix sort based on [chromosome, start coordinate].
-    or topologically based on hierarchy of features using the gt (genometools) toolkit
+    Sort gff file based on [chromosome, start coordinate], with chromosomes in
+    natural order and large files merged on disk ("unix"), or topologically
+    based on hierarchy of features using the gt (genometools) toolkit ("topo")
     """
     valid_sort_methods = ("unix", "topo")
 
@@ -1532,7 +1555,7 @@ def sort(args):
                  help="Specify sort method [default: %default]")
     p.add_option("-i", dest="inplace", default=False, action="store_true",
                  help="If doing a unix sort, perform sort inplace [default: %default]")
-    p.set_tmpdir()
+    p.set_sort()
     p.set_outfile()
     p.set_home("gt")
     opts, args = p.parse_args(args)
@@ -1549,14 +1572,11 @@ def sort(args):
             sys.exit()
 
     if opts.method == "unix":
-        cmd = "sort"
-        cmd += " -k1,1 -k4,4n {0}".format(gffile)
-        if opts.tmpdir:
-            cmd += " -T {0}".format(opts.tmpdir)
         if opts.inplace:
-            cmd += " -o {0}".gffile
-            sortedgff = None
-        sh(cmd, outfile=sortedgff)
+            sortedgff = gffile
+        key = SortKey([(0, "natural"), (3, "int")])
+        external_sort(gffile, sortedgff, key, memory=opts.memory * 1024 ** 2,
+                      tmpdir=opts.tmpdir, cpus=opts.cpus)
     elif opts.method == "topo":
         GT_HOME = opts.gt_home
         if not op.isdir(GT_HOME):
@@ -2082,6 +2102,267 @@ def bed(args):
                     format(len(b), ",".join(type), key))
 
 
+def key_attributes(s, keys=("ID", "Parent"), gff3=True):
+    """
+    Values of only the given attributes, same as make_attributes() would
+    return them, without decoding the rest of the column.
+
+    >>> sorted(key_attributes("ID=cds1;Parent=mRNA1,mRNA2;Note=a%20b").items())
+    [('ID', ['cds1']), ('Parent', ['mRNA1', 'mRNA2'])]
+    """
+    if not gff3:
+        d = make_attributes(s, gff3=False, keep_attr_order=False)
+        return dict((k, d[k]) for k in keys if k in d)
+
+    d = {}
+    for item in re.split("[;&]", s):
+        key, sep, val = item.partition("=")
+        if not (sep and val) or key not in keys:
+            continue
+        val = unquote(unquote(val).replace('"', ''))
+        d.setdefault(key, []).extend(val.split(","))
+    return d
+
+
+class GffFeature (object):
+    """
+    Light-weight feature returned by GffIndex, with the same field names as
+    GffLine for the columns it keeps.
+    """
+    __slots__ = ("seqid", "type", "start", "end", "strand", "accn", "row")
+
+    def __init__(self, seqid, type, start, end, strand, accn, row):
+        self.seqid = seqid
+        self.type = type
+        self.start = start
+        self.end = end
+        self.strand = strand
+        self.accn = accn
+        self.row = row
+
+    @property
+    def id(self):
+        return self.accn
+
+    @property
+    def span(self):
+        return self.end - self.start + 1
+
+
+class GffIndex (BaseFile):
+    """
+    Native index of a GFF file built in one pass, without gffutils/sqlite:
+    columns of seqid, type, coordinates, strand and line number per feature,
+    interned seqids/types/IDs, and the parent-child graph as CSR arrays (for
+    each ID, the rows that name it as Parent). With `cache`, the arrays are
+    kept in `gffile.idx.npz`, and rebuilt when the GFF is newer.
+
+    Features are identified like GffLine.accn, so features without an ID are
+    named after their type and line number. Parent values are encoded the
+    same way, so that they match the IDs.
+    """
+    strand_codes = ("+", "-", "?", ".")
+
+    def __init__(self, filename, cache=False):
+        super(GffIndex, self).__init__(filename)
+        cachefile = filename + ".idx.npz"
+        if cache and op.exists(cachefile) and \
+                not need_update(filename, cachefile):
+            self.load(cachefile)
+        else:
+            self.build(filename)
+            if cache and filename not in ("-", "stdin"):
+                try:
+                    self.save(cachefile)
+                except IOError:
+                    logging.debug("Cannot write index `{0}`.".format(cachefile))
+
+        self.idmap = dict((x, i) for i, x in enumerate(self.ids))
+        self.typemap = dict((x, i) for i, x in enumerate(self.types))
+
+    def build(self, filename):
+        seqids, types, ids = {}, {}, {}
+        seqidx, typeidx, starts, ends, strands, lines = [], [], [], [], [], []
+        idcodes, pcodes, prows = [], [], []
+        strand_codes = dict((x, i) for i, x in enumerate(self.strand_codes))
+        gff3 = None
+        for idx, row in enumerate(must_open(filename)):
+            row = row.strip()
+            if row == "":
+                continue
+            if row[0] == '#':
+                if row == FastaTag:
+                    break
+                continue
+
+            args = row.split("\t")
+            if len(args) != 9:
+                args = row.split()
+            text = args[8].strip() if len(args) > 8 else ""
+            if gff3 is None:
+                gff3 = "=" in text
+            attrs = key_attributes(text, gff3=gff3)
+            ftype = args[2]
+            if "ID" in attrs:
+                accn = quote(",".join(attrs["ID"]), safe=safechars)
+            else:
+                accn = quote("{0}_{1}".format(ftype.lower(), idx),
+                             safe=safechars)
+
+            i = len(lines)
+            seqidx.append(seqids.setdefault(args[0], len(seqids)))
+            typeidx.append(types.setdefault(ftype, len(types)))
+            starts.append(int(args[3]))
+            ends.append(int(args[4]))
+            strands.append(strand_codes.get(args[6], 3))
+            lines.append(idx)
+            idcodes.append(ids.setdefault(accn, len(ids)))
+            for parent in attrs.get("Parent", []):
+                parent = quote(parent, safe=safechars)
+                pcodes.append(ids.setdefault(parent, len(ids)))
+                prows.append(i)
+
+        self.seqids = sorted(seqids, key=seqids.get)
+        self.types = sorted(types, key=types.get)
+        self.ids = sorted(ids, key=ids.get)
+        self.seqidx = np.array(seqidx, dtype=np.int32)
+        self.typeidx = np.array(typeidx, dtype=np.int32)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.ends = np.array(ends, dtype=np.int64)
+        self.strands = np.array(strands, dtype=np.int8)
+        self.lines = np.array(lines, dtype=np.int64)
+        self.idcodes = np.array(idcodes, dtype=np.int32)
+        nids = len(self.ids)
+        self.rowptr, self.rowidx = csr(self.idcodes,
+                                       np.arange(len(lines)), nids)
+        self.childptr, self.childidx = csr(np.array(pcodes, dtype=np.int32),
+                                           np.array(prows, dtype=np.int64), nids)
+        self.parentptr, self.parentidx = csr(np.array(prows, dtype=np.int64),
+                                   np.array(pcodes, dtype=np.int32), len(lines))
+        logging.debug("Indexed {0} features ({1} ids) in `{2}`.".\
+                        format(len(lines), nids, filename))
+
+    arrays = ("seqidx", "typeidx", "starts", "ends", "strands", "lines",
+              "idcodes", "rowptr", "rowidx", "childptr", "childidx",
+              "parentptr", "parentidx")
+    tables = ("seqids", "types", "ids")
+
+    def save(self, cachefile):
+        data = dict((x, getattr(self, x)) for x in self.arrays)
+        for x in self.tables:
+            data[x] = np.array(getattr(self, x))
+        np.savez(cachefile, **data)
+        logging.debug("Index written to `{0}`.".format(cachefile))
+
+    def load(self, cachefile):
+        data = np.load(cachefile)
+        for x in self.arrays:
+            setattr(self, x, data[x])
+        for x in self.tables:
+            setattr(self, x, data[x].tolist())
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, id):
+        return id in self.idmap and self.rowptr[self.idmap[id] + 1] > \
+                                    self.rowptr[self.idmap[id]]
+
+    def __getitem__(self, id):
+        return self.feature(self.rows(id)[0])
+
+    def feature(self, i):
+        return GffFeature(self.seqids[self.seqidx[i]],
+                          self.types[self.typeidx[i]],
+                          int(self.starts[i]), int(self.ends[i]),
+                          self.strand_codes[self.strands[i]],
+                          self.ids[self.idcodes[i]], int(i))
+
+    def rows(self, id):
+        """
+        Rows of the features with this ID, in file order.
+        """
+        code = self.idmap.get(id)
+        if code is None:
+            return []
+        return self.rowidx[self.rowptr[code]:self.rowptr[code + 1]].tolist()
+
+    def child_rows(self, codes):
+        rows = set()
+        for code in codes:
+            rows.update(self.childidx[self.childptr[code]:\
+                                      self.childptr[code + 1]].tolist())
+        return sorted(rows)
+
+    def children(self, id, level=1, featuretype=None):
+        """
+        Features `level` steps below `id` in the tree, in file order.
+        """
+        code = self.idmap.get(id)
+        if code is None:
+            return []
+        rows = []
+        codes = [code]
+        for i in xrange(level):
+            rows = self.child_rows(codes)
+            codes = set(self.idcodes[rows].tolist())
+
+        if featuretype is not None:
+            if featuretype not in self.typemap:
+                return []
+            t = self.typemap[featuretype]
+            rows = [x for x in rows if self.typeidx[x] == t]
+        return [self.feature(x) for x in rows]
+
+    def parents(self, id, level=1):
+        """
+        Features `level` steps above `id`, one per parent ID.
+        """
+        rows = self.rows(id)
+        for i in xrange(level):
+            codes = set()
+            for row in rows:
+                codes.update(self.parentidx[self.parentptr[row]:\
+                                            self.parentptr[row + 1]].tolist())
+            rows = sorted(self.rowidx[self.rowptr[x]] for x in codes \
+                          if self.rowptr[x + 1] > self.rowptr[x])
+        return [self.feature(x) for x in rows]
+
+    def features_of_type(self, featuretype):
+        """
+        Features of a type, the first row of each ID, in file order.
+        """
+        if featuretype not in self.typemap:
+            return []
+        rows = np.flatnonzero(self.typeidx == self.typemap[featuretype])
+        first = self.rowidx[self.rowptr[self.idcodes[rows]]]
+        rows = rows[rows == first]
+        return [self.feature(x) for x in rows.tolist()]
+
+    def descendants(self, ids, level=2):
+        """
+        IDs of all features up to `level` steps below the given IDs.
+        """
+        codes = set(self.idmap[x] for x in ids if x in self.idmap)
+        found = set()
+        for i in xrange(level):
+            rows = self.child_rows(codes)
+            codes = set(self.idcodes[rows].tolist()) - found
+            found |= codes
+        return set(self.ids[x] for x in found)
+
+
+def csr(keys, values, nkeys):
+    """
+    Group `values` by integer `keys` in 0..nkeys-1 as CSR arrays, keeping
+    their order within each key: values of key k are idx[ptr[k]:ptr[k + 1]].
+    """
+    order = np.argsort(keys, kind="mergesort")
+    ptr = np.zeros(nkeys + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(keys, minlength=nkeys)) if len(keys) else 0
+    return ptr, np.asarray(values)[order]
+
+
 def make_index(gff_file):
     """
     Make a sqlite database for fast retrieval of features.
@@ -2125,7 +2406,7 @@ def children(args):
         sys.exit(not p.print_help())
 
     gff_file, = args
-    g = make_index(gff_file)
+    g = GffIndex(gff_file)
     parents = set(opts.parents.split(','))
 
     for feat in get_parents(gff_file, parents):
@@ -2135,7 +2416,7 @@ def children(args):
             continue
 
         print "\t".join(str(x) for x in \
-                    (feat.id, feat.start, feat.stop, "|".join(cc)))
+                    (feat.id, feat.start, feat.end, "|".join(cc)))
 
 
 def load(args):
@@ -2217,14 +2498,17 @@ def load(args):
     desc_attr = opts.desc_attribute
     sep = opts.sep
 
-    g = make_index(gff_file)
-    f = Fasta(fasta_file, index=False)
+    g = GffIndex(gff_file)
+    f = Fasta(fasta_file, faidx=True)
     seqlen = {}
     for seqid, size in f.itersizes():
         seqlen[seqid] = size
 
     fw = must_open(opts.outfile, "w")
 
+    # collect the pieces of every record first, so that all sequences are
+    # fetched in one batch over the genome
+    records, pieces = [], []
     for feat in get_parents(gff_file, parents):
         desc = ",".join(feat.attributes[desc_attr]) \
                 if desc_attr and desc_attr in feat.attributes else ""
@@ -2255,8 +2539,8 @@ def load(args):
             if not upstream_start or not upstream_stop:
                 continue
 
-            feat_seq = f.sequence(dict(chr=feat.seqid, start=upstream_start,
-                stop=upstream_stop, strand=feat.strand))
+            children = [dict(chr=feat.seqid, start=upstream_start,
+                stop=upstream_stop, strand=feat.strand)]
 
             (s, e) = (upstream_start, upstream_stop) \
                     if feat.strand == "+" else \
@@ -2268,27 +2552,26 @@ def load(args):
             children = []
             if not skipChildren:
                 for c in g.children(feat.id, 1):
-                    if c.featuretype not in children_list:
+                    if c.type not in children_list:
                         continue
-                    child = f.sequence(dict(chr=c.chrom, start=c.start, stop=c.stop,
-                        strand=c.strand))
-                    children.append((child, c))
+                    child = dict(chr=c.seqid, start=c.start, stop=c.end,
+                        strand=c.strand)
+                    children.append(child)
 
                 if not children:
                     print >>sys.stderr, "[warning] %s has no children with type %s" \
                                             % (feat.id, ','.join(children_list))
                     continue
             else:
-                child = f.sequence(dict(chr=feat.seqid, start=feat.start, stop=feat.end,
-                    strand=feat.strand))
-                children.append((child, feat))
+                child = dict(chr=feat.seqid, start=feat.start, stop=feat.end,
+                    strand=feat.strand)
+                children.append(child)
 
             # sort children in incremental position
-            children.sort(key=lambda x: x[1].start)
+            children.sort(key=lambda x: x['start'])
             # reverse children if negative strand
             if feat.strand == '-':
                 children.reverse()
-            feat_seq = ''.join(x[0] for x in children)
 
         desc = desc.replace("\"", "")
 
@@ -2296,6 +2579,12 @@ def load(args):
                 and feat.attributes[id_attr] else \
                 feat.id
 
+        records.append((id, desc, len(children)))
+        pieces.extend(children)
+
+    seqs = f.batch_sequences(pieces)
+    for id, desc, npieces in records:
+        feat_seq = ''.join(next(seqs) for i in xrange(npieces))
         rec = SeqRecord(Seq(feat_seq), id=id, description=desc)
         SeqIO.write([rec], fw, "fasta")
         fw.flush()
@@ -2342,13 +2631,13 @@ def get_upstream_coords(uSite, uLen, seqlen, feat, children_list, gffdb):
     """
     Subroutine takes upstream site, length, reference sequence length,
     parent mRNA feature (GffLine object), list of child feature types
-    and a GFFutils.GFFDB object as the input
+    and a GffIndex object as the input
 
     If upstream of TSS is requested, use the parent feature coords
     to extract the upstream sequence
 
     If upstream of TrSS is requested,  iterates through all the
-    children (CDS features stored in the sqlite GFFDB) and use child
+    children (CDS features stored in the GffIndex) and use child
     feature coords to extract the upstream sequence
 
     If success, returns the upstream start and stop coordinates
@@ -2363,9 +2652,9 @@ def get_upstream_coords(uSite, uLen, seqlen, feat, children_list, gffdb):
         children = []
         for c in gffdb.children(feat.id, 1):
 
-            if c.featuretype not in children_list:
+            if c.type not in children_list:
                 continue
-            children.append((c.start, c.stop))
+            children.append((c.start, c.end))
 
         if not children:
             print >>sys.stderr, "[warning] %s has no children with type %s" \
@@ -2430,14 +2719,14 @@ def bed12(args):
     parent, block, thick = opts.parent, opts.block, opts.thick
     outfile = opts.outfile
 
-    g = make_index(gffile)
+    g = GffIndex(gffile)
     fw = must_open(outfile, "w")
 
     for f in g.features_of_type(parent):
 
-        chrom = f.chrom
+        chrom = f.seqid
         chromStart = f.start - 1
-        chromEnd = f.stop
+        chromEnd = f.end
         name = f.id
         score = 0
         strand = f.strand
@@ -2447,14 +2736,14 @@ def bed12(args):
 
         for c in g.children(name, 1):
 
-            cstart, cend = c.start - 1, c.stop
+            cstart, cend = c.start - 1, c.end
 
-            if c.featuretype == block:
+            if c.type == block:
                 blockStart = cstart - chromStart
                 blockSize = cend - cstart
                 blocks.append((blockStart, blockSize))
 
-            elif c.featuretype == thick:
+            elif c.type == thick:
                 thickStart = min(thickStart, cstart)
                 thickEnd = max(thickEnd, cend)
 
@@ -35,7 +35,7 @@ class Sizes (LineFile):
                 else:
                     from jcvi.formats.fasta import Fasta
 
-                    f = Fasta(filename)
+                    f = Fasta(filename, faidx=True)
                     fw = open(sizesname, "w")
                     for k, size in f.itersizes_ordered():
                         print >> fw, "\t".join((k, str(size)))
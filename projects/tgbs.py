@@ -136,8 +136,6 @@ def weblogo(args):
             pr.update(k)
         if k > nreads:
             break
-        if rec is None:
-            break
         s = str(rec.seq)
         for i, a in enumerate(s[:N]):
             if a in p:
@@ -104,6 +104,209 @@ class Grouper(object):
         return sum(len(x) for x in self)
 
 
+DELETED = 2  # ArrayGrouper node state, besides 0 (absent) and 1 (member)
+
+
+class ArrayGrouper(object):
+    """
+    Same interface as Grouper, but stored as a disjoint-set forest in compact
+    integer arrays, with path compression and union by rank. Keys are
+    interned into consecutive integer ids; when `size` is given, the keys are
+    taken to be integers in range(size) and are used as ids directly, so no
+    mapping is kept at all. A key deleted from a sized grouper cannot be
+    joined again, doing so raises KeyError.
+
+    >>> g = ArrayGrouper()
+    >>> g.join('a', 'b')
+    >>> g.join('b', 'c')
+    >>> g.join('d', 'e')
+    >>> list(g)
+    [['a', 'b', 'c'], ['d', 'e']]
+    >>> g.joined('a', 'c')
+    True
+    >>> g.joined('a', 'd')
+    False
+    >>> del g['b']
+    >>> list(g)
+    [['a', 'c'], ['d', 'e']]
+    >>> h = ArrayGrouper(size=6)
+    >>> h.join(4, 1)
+    >>> h.join(2, 4)
+    >>> list(h), len(h), h[2]
+    ([[1, 2, 4]], 1, (1, 2, 4))
+    >>> del h[2]
+    >>> list(h), h.joined(1, 4), 2 in h
+    ([[1, 4]], True, False)
+    >>> h.join(2, 3)
+    Traceback (most recent call last):
+    ...
+    KeyError: 'Key 2 was deleted from sized ArrayGrouper'
+    """
+    def __init__(self, init=[], size=None):
+        from array import array
+
+        self.size = size
+        if size is None:
+            self._index = {}
+            self._keys = []
+            self._parent = array('l')
+            self._rank = array('B')
+            self._alive = array('B')
+        else:
+            self._index = None
+            self._keys = None
+            self._parent = array('l', xrange(size))
+            self._rank = array('B', [0]) * size
+            self._alive = array('B', [0]) * size
+        for x in init:
+            self._id(x)
+
+    def _id(self, key):
+        """
+        Returns the integer id of key, adding it as a new singleton if needed.
+        """
+        if self._index is None:
+            if self._alive[key] == DELETED:
+                raise KeyError("Key {0} was deleted from sized ArrayGrouper".\
+                                format(key))
+            self._alive[key] = 1
+            return key
+
+        i = self._index.get(key)
+        if i is None:
+            i = self._index[key] = len(self._keys)
+            self._keys.append(key)
+            self._parent.append(i)
+            self._rank.append(0)
+            self._alive.append(1)
+        return i
+
+    def _get(self, key):
+        if self._index is None:
+            if 0 <= key < self.size and self._alive[key] == 1:
+                return key
+            raise KeyError(key)
+        return self._index[key]
+
+    def _find(self, i):
+        parent = self._parent
+        root = i
+        while parent[root] != root:
+            root = parent[root]
+        while parent[i] != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    def join(self, a, *args):
+        """
+        Join given arguments into the same set. Accepts one or more arguments.
+        """
+        parent, rank = self._parent, self._rank
+        ra = self._find(self._id(a))
+        for arg in args:
+            rb = self._find(self._id(arg))
+            if ra == rb:
+                continue
+            if rank[ra] < rank[rb]:
+                ra, rb = rb, ra
+            parent[rb] = ra
+            if rank[ra] == rank[rb]:
+                rank[ra] += 1
+
+    def joined(self, a, b):
+        """
+        Returns True if a and b are members of the same set.
+        """
+        try:
+            return self._find(self._get(a)) == self._find(self._get(b))
+        except KeyError:
+            return False
+
+    def _groups(self):
+        groups = {}
+        order = []
+        alive = self._alive
+        keys = self._keys
+        for i in xrange(len(self._parent)):
+            if alive[i] != 1:
+                continue
+            root = self._find(i)
+            group = groups.get(root)
+            if group is None:
+                group = groups[root] = []
+                order.append(root)
+            group.append(i if keys is None else keys[i])
+        return groups, order
+
+    def __iter__(self):
+        """
+        Returns an iterator returning each of the disjoint sets as a list.
+        """
+        groups, order = self._groups()
+        for root in order:
+            yield groups[root]
+
+    def __getitem__(self, key):
+        """
+        Returns the set that a certain key belongs.
+        """
+        root = self._find(self._get(key))
+        alive = self._alive
+        keys = self._keys
+        return tuple(i if keys is None else keys[i] \
+                     for i in xrange(len(self._parent)) \
+                     if alive[i] == 1 and self._find(i) == root)
+
+    def __contains__(self, key):
+        try:
+            self._get(key)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._groups()[1])
+
+    def __delitem__(self, key):
+        # The node stays in the forest so that the rest of its set remains
+        # connected through it, but it is no longer reported as a member.
+        # Integer keys map to fixed nodes, so they cannot be re-added later.
+        if self._index is None:
+            i = self._get(key)
+            self._alive[i] = DELETED
+            return
+        i = self._index.pop(key)
+        self._alive[i] = 0
+
+    @property
+    def num_members(self):
+        return self._alive.count(1)
+
+
+def benchmark(njoins=10000000, nkeys=1000000, seed=666):
+    """
+    Time `njoins` random joins among `nkeys` integer keys, followed by one
+    full iteration over the sets, on Grouper and ArrayGrouper.
+    """
+    import random
+    import time
+
+    random.seed(seed)
+    pairs = [(random.randrange(nkeys), random.randrange(nkeys)) \
+             for x in xrange(njoins)]
+    for name, g in (("Grouper", Grouper()),
+                    ("ArrayGrouper", ArrayGrouper()),
+                    ("ArrayGrouper(size)", ArrayGrouper(size=nkeys))):
+        start = time.time()
+        for a, b in pairs:
+            g.join(a, b)
+        joined = time.time()
+        nsets = sum(1 for x in g)
+        print "{0}: {1} joins in {2:.1f}s, {3} sets in {4:.1f}s".\
+                format(name, njoins, joined - start, nsets,
+                       time.time() - joined)
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -7,18 +7,21 @@ Deconvolute fastq files according to barcodes.
 
 import os.path as op
 import sys
+import time
 import logging
 
-from itertools import product, groupby, islice
+import numpy as np
+
+from itertools import product, groupby, izip, combinations
 from multiprocessing import Pool
-from collections import namedtuple
+from collections import namedtuple, defaultdict, deque
 
 from Bio.Data.IUPACData import ambiguous_dna_values
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
 
 from jcvi.utils.iter import flatten
-from jcvi.formats.base import FileMerger, must_open
-from jcvi.formats.fastq import FastqPairedIterator
+from jcvi.utils.cbook import percentage
+from jcvi.formats.base import FileMerger
+from jcvi.formats.fastq import iter_fastq_batches, iter_paired_batches
 from jcvi.apps.base import OptionParser, ActionDispatcher, mkdir, glob
 
 
@@ -43,88 +46,248 @@ def unpack_ambiguous(s):
     return ["".join(x) for x in list(product(*sd))]
 
 
-def is_barcode_sample(seq, barcode, excludebarcode, trim):
-    if seq[:trim] != barcode.seq:
-        return False
-    hasexclude = any(seq.startswith(x.seq) for x in excludebarcode)
-    if hasexclude:
-        return False
-    return True
-
-
-def split_barcode_paired(t):
-
-    barcode, excludebarcode, outdir, inputfile = t
-    trim = len(barcode.seq)
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
+class BarcodeMatcher (object):
+    """
+    Hash of all barcode sequences, keyed by barcode length. Sequences within
+    `mismatch` substitutions of a barcode are kept in a separate table, and
+    variants that are shared by two barcodes are marked ambiguous (-1).
+    Reads are matched against exact barcodes first, longest first, so a read
+    that starts with a longer barcode is never assigned to its prefix.
+    """
+    def __init__(self, barcodes, mismatch=0):
+        self.barcodes = barcodes
+        self.mismatch = mismatch
+        self.exact = {}
+        self.fuzzy = {}
+        for i, bc in enumerate(barcodes):
+            table = self.exact.setdefault(len(bc.seq), {})
+            j = table.setdefault(bc.seq, i)
+            assert barcodes[j].id == bc.id, \
+                "{0} and {1} share the same sequence".format(bc, barcodes[j])
+
+        ambiguous = 0
+        for i, bc in enumerate(barcodes):
+            exact = self.exact[len(bc.seq)]
+            table = self.fuzzy.setdefault(len(bc.seq), {})
+            for s in mismatch_variants(bc.seq, mismatch):
+                if s in exact:
+                    continue
+                j = table.setdefault(s, i)
+                if j != i and j != -1:
+                    table[s] = -1
+                    ambiguous += 1
+
+        if ambiguous:
+            logging.debug("{0} mismatch variants shared by barcodes ignored.".\
+                            format(ambiguous))
+        self.lengths = sorted(self.exact.keys(), reverse=True)
+
+    def __len__(self):
+        return len(self.barcodes)
+
+    def prefixes(self):
+        """
+        Pairs of barcodes where one is a prefix of the other.
+        """
+        for a in self.barcodes:
+            for b in self.barcodes:
+                if a.id != b.id and len(b.seq) > len(a.seq) \
+                        and b.seq.startswith(a.seq):
+                    yield a, b
+
+    def match(self, seq):
+        """
+        Index of the barcode that seq starts with, -1 if none.
+        """
+        for L in self.lengths:
+            i = self.exact[L].get(seq[:L])
+            if i is not None:
+                return i
+        if not self.mismatch:
+            return -1
+        for L in self.lengths:
+            i = self.fuzzy[L].get(seq[:L])
+            if i is not None:
+                return i
+        return -1
+
+
+def mismatch_variants(seq, mismatch):
+    """
+    All sequences within `mismatch` substitutions of seq, N counts as a
+    mismatch.
 
-    r1, r2 = inputfile
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    fw = open(outfastq, "w")
-    while True:
-        a = list(islice(p1fp, 4))
-        if not a:
-            break
+    >>> sorted(mismatch_variants("AC", 1))[:4]
+    ['AA', 'AC', 'AG', 'AN']
+    """
+    variants = set([seq])
+    for k in xrange(1, mismatch + 1):
+        for pos in combinations(xrange(len(seq)), k):
+            alts = [[b for b in "ACGTN" if b != seq[p]] for p in pos]
+            for sub in product(*alts):
+                s = list(seq)
+                for p, b in zip(pos, sub):
+                    s[p] = b
+                variants.add("".join(s))
+    return variants
 
-        b = list(islice(p2fp, 4))
-        title, seq, plus, qual = a
-        title, seq, qual = title.strip(), seq.strip(), qual.strip()
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
-            continue
 
-        print >> fw, "{0}\n{1}\n+\n{2}".format(title, seq[trim:], qual[trim:])
-        fw.writelines(b)
+demux_state = {}
 
-    fw.close()
 
+def demux_init(matcher, queues, paired, append):
+    demux_state.update(matcher=matcher, queues=queues,
+                       paired=paired, append=append)
 
-def append_barcode_paired(t):
 
-    barcode, excludebarcode, outdir, inputfile = t
-    bs = barcode.seq
-    trim = len(bs)
-    fake_qual = len(bs) * "#"
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
+def demux_chunk(args):
+    """
+    Assign a chunk of reads to barcodes, hand the formatted records over to
+    the writers and return the counts per barcode (last one is unmatched).
+    """
+    chunkid, reads = args
+    matcher = demux_state["matcher"]
+    queues = demux_state["queues"]
+    paired = demux_state["paired"]
+    append = demux_state["append"]
+    barcodes = matcher.barcodes
+    nbc = len(barcodes)
 
-    r1, r2 = inputfile
-    p1fp, p2fp = FastqPairedIterator(r1, r2)
-    fw = open(outfastq, "w")
+    counts = [0] * (nbc + 1)
+    out = defaultdict(list)
+    match = matcher.match
+    if paired:
+        (h1, s1, q1), (h2, s2, q2) = reads
+        for ah, aseq, aq, bh, bseq, bq in izip(h1, s1, q1, h2, s2, q2):
+            i = match(aseq)
+            counts[i] += 1
+            if i < 0:
+                continue
+            bs = barcodes[i].seq
+            trim = len(bs)
+            if append:
+                rec = "{0}\n{1}\n+\n{2}\n{3}\n{4}\n+\n{5}\n".format(ah, aseq,
+                        aq, bh, bs + bseq, trim * "#" + bq)
+            else:
+                rec = "{0}\n{1}\n+\n{2}\n{3}\n{4}\n+\n{5}\n".format(ah,
+                        aseq[trim:], aq[trim:], bh, bseq, bq)
+            out[i].append(rec)
+    else:
+        headers, seqs, quals = reads
+        for h, seq, q in izip(headers, seqs, quals):
+            i = match(seq)
+            counts[i] += 1
+            if i < 0:
+                continue
+            trim = len(barcodes[i].seq)
+            out[i].append("{0}\n{1}\n+\n{2}\n".format(h, seq[trim:], q[trim:]))
+
+    nwriters = len(queues)
+    texts = [{} for x in queues]
+    for i, recs in out.iteritems():
+        texts[i % nwriters][i] = "".join(recs)
+    for queue, text in zip(queues, texts):
+        queue.put((chunkid, text))
+
+    return counts
+
+
+def demux_writer(queue, outfiles):
+    """
+    Own the output files for a subset of barcodes, write chunks in input
+    order until a None is received.
+    """
+    fws = dict((i, open(f, "w")) for i, f in outfiles.items())
+    pending = {}
+    expected = 0
     while True:
-        a = list(islice(p1fp, 4))
-        if not a:
+        msg = queue.get()
+        if msg is None:
             break
+        chunkid, text = msg
+        pending[chunkid] = text
+        while expected in pending:
+            for i, t in pending.pop(expected).iteritems():
+                fws[i].write(t)
+            expected += 1
 
-        title, seq, plus, qual = a
-        seq = seq.strip()
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
-            continue
-
-        fw.writelines(a)
+    for fw in fws.values():
+        fw.close()
 
-        title, seq, plus, qual = list(islice(p2fp, 4))
-        title, seq, qual = title.strip(), seq.strip(), qual.strip()
-        # append barcode
-        seq = bs + seq
-        qual = fake_qual + qual
-        print >> fw, "{0}\n{1}\n+\n{2}".format(title, seq, qual)
 
-    fw.close()
+def iter_chunks(fastqfile, paired):
+    if paired:
+        r1, r2 = fastqfile
+        for a, b in iter_paired_batches(r1, r2):
+            yield ((a.headers, a.seqs, a.quals), (b.headers, b.seqs, b.quals))
+    else:
+        for a in iter_fastq_batches(fastqfile):
+            yield (a.headers, a.seqs, a.quals)
 
 
-def split_barcode(t):
+def wait_result(result, procs, timeout=1):
+    """
+    Value of an apply_async() result. Fails if a writer process dies in the
+    meantime, since workers would then block on its full queue forever.
+    """
+    from multiprocessing import TimeoutError
 
-    barcode, excludebarcode, outdir, inputfile = t
-    trim = len(barcode.seq)
-    outfastq = op.join(outdir, "{0}.{1}.fastq".format(barcode.id, barcode.seq))
+    while True:
+        try:
+            return result.get(timeout)
+        except TimeoutError:
+            for w in procs:
+                assert w.is_alive(), "Writer {0} exited with code {1}".\
+                                     format(w.name, w.exitcode)
 
-    fp = must_open(inputfile)
-    fw = open(outfastq, "w")
-    for title, seq, qual in FastqGeneralIterator(fp):
-        if not is_barcode_sample(seq, barcode, excludebarcode, trim):
-            continue
-        print >> fw, "@{0}\n{1}\n+\n{2}".format(title, seq[trim:], qual[trim:])
 
-    fw.close()
+def demultiplex(matcher, fastqfile, outfiles, paired=False, append=False,
+                cpus=1, writers=2):
+    """
+    Reads are parsed in the main process, matched in a pool of `cpus` worker
+    processes, and written by `writers` processes that each own a share of
+    the output files. Writer queues are bounded, so that workers wait when the
+    writers fall behind. Returns counts per barcode, last one being unmatched.
+    """
+    from multiprocessing import Process, Queue
+
+    nbc = len(matcher)
+    writers = max(1, min(writers, nbc))
+    queues = [Queue(maxsize=2 * cpus) for x in xrange(writers)]
+    procs = []
+    for k, queue in enumerate(queues):
+        owned = dict((i, f) for i, f in enumerate(outfiles) if i % writers == k)
+        w = Process(target=demux_writer, args=(queue, owned))
+        w.start()
+        procs.append(w)
+
+    pool = Pool(cpus, initializer=demux_init,
+                initargs=(matcher, queues, paired, append))
+    counts = np.zeros(nbc + 1, dtype=np.int64)
+    pending = deque()
+    try:
+        for chunkid, reads in enumerate(iter_chunks(fastqfile, paired)):
+            pending.append(pool.apply_async(demux_chunk, ((chunkid, reads),)))
+            if len(pending) > 2 * cpus:  # keep the reader from running ahead
+                counts += wait_result(pending.popleft(), procs)
+        while pending:
+            counts += wait_result(pending.popleft(), procs)
+    except:
+        pool.terminate()
+        for w in procs:
+            w.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    for queue in queues:
+        queue.put(None)
+    for w in procs:
+        w.join()
+        assert w.exitcode == 0, "Writer {0} exited with code {1}".\
+                                format(w.name, w.exitcode)
+
+    return counts
 
 
 def split(args):
@@ -140,16 +303,24 @@ def split(args):
 
     When --paired is set, the number of input fastqfiles must be two. Output
     file (the deconvoluted reads) will be in interleaved format.
+
+    Each read goes to the longest barcode it starts with; with --mismatch,
+    reads without an exact match are assigned to the barcode within the
+    given number of substitutions, unless more than one barcode qualifies.
     """
     p = OptionParser(split.__doc__)
     p.add_option("--outdir", default="deconv",
                  help="Output directory [default: %default]")
     p.add_option("--nocheckprefix", default=False, action="store_true",
-                 help="Don't check shared prefix [default: %default]")
+                 help="Don't report shared prefix [default: %default]")
     p.add_option("--paired", default=False, action="store_true",
                  help="Paired-end data [default: %default]")
     p.add_option("--append", default=False, action="store_true",
                  help="Append barcode to 2nd read [default: %default]")
+    p.add_option("--mismatch", default=0, type="int",
+                 help="Mismatches allowed in barcode [default: %default]")
+    p.add_option("--writers", default=2, type="int",
+                 help="Number of writer processes [default: %default]")
     p.set_cpus()
     opts, args = p.parse_args(args)
 
@@ -174,46 +345,40 @@ def split(args):
 
     nbc = len(barcodes)
     logging.debug("Imported {0} barcodes (ambiguous codes expanded).".format(nbc))
-    checkprefix = not opts.nocheckprefix
-
-    if checkprefix:
-        # Sanity check of shared prefix
-        excludebarcodes = []
-        for bc in barcodes:
-            exclude = []
-            for s in barcodes:
-                if bc.id == s.id:
-                    continue
-
-                assert bc.seq != s.seq
-                if s.seq.startswith(bc.seq) and len(s.seq) > len(bc.seq):
-                    logging.error("{0} shares same prefix as {1}.".format(s, bc))
-                    exclude.append(s)
-            excludebarcodes.append(exclude)
-    else:
-        excludebarcodes = nbc * [[]]
-
-    outdir = opts.outdir
-    mkdir(outdir)
+    matcher = BarcodeMatcher(barcodes, mismatch=opts.mismatch)
 
-    cpus = opts.cpus
-    logging.debug("Create a pool of {0} workers.".format(cpus))
-    pool = Pool(cpus)
+    if not opts.nocheckprefix:
+        for a, b in matcher.prefixes():
+            logging.error("{0} shares same prefix as {1}.".format(b, a))
 
     if paired:
         assert nfiles == 2, "You asked for --paired, but sent in {0} files".\
                             format(nfiles)
-        split_fun = append_barcode_paired if append else split_barcode_paired
-        mode = "paired"
+        mode = "paired, barcode appended" if append else "paired"
     else:
-        split_fun = split_barcode
         mode = "single"
-
     logging.debug("Mode: {0}".format(mode))
 
-    pool.map(split_fun, \
-             zip(barcodes, excludebarcodes,
-             nbc * [outdir], nbc * [fastqfile]))
+    outdir = opts.outdir
+    mkdir(outdir)
+    outfiles = [op.join(outdir, "{0}.{1}.fastq".format(bc.id, bc.seq)) \
+                    for bc in barcodes]
+
+    cpus = opts.cpus
+    logging.debug("Create a pool of {0} workers.".format(cpus))
+    start = time.time()
+    counts = demultiplex(matcher, fastqfile, outfiles, paired=paired,
+                         append=append, cpus=cpus, writers=opts.writers)
+    elapsed = time.time() - start
+
+    nreads = counts.sum()
+    logging.debug("Processed {0} reads in {1:.1f} seconds ({2:.0f} reads/sec).".\
+                  format(nreads, elapsed, nreads / max(elapsed, 1e-6)))
+    for bc, c in zip(barcodes, counts):
+        print >> sys.stderr, "\t".join((bc.id, bc.seq, str(c)))
+    if nreads:
+        print >> sys.stderr, "Assigned: {0}".\
+                    format(percentage(nreads - counts[-1], nreads))
 
 
 def merge(args):